@@ -0,0 +1,38 @@
+"""
+gunicorn settings. By default the WSGI application runs on threaded
+workers, so the usual start command keeps working:
+
+    gunicorn waterconnect.wsgi:application
+
+Set GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker and start without
+an application argument to serve the ASGI application instead, so async
+views (map data, click tracking, payments, the live map stream) run on each
+worker's event loop:
+
+    gunicorn -c gunicorn.conf.py
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+ASGI_WORKER = 'uvicorn' in worker_class.lower()
+wsgi_app = 'waterconnect.asgi:application' if ASGI_WORKER else 'waterconnect.wsgi:application'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Only used by the gthread worker class.
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
+
+
+def on_starting(server):
+    # An application given on the command line replaces wsgi_app above; a
+    # WSGI callable under uvicorn (or the reverse) would fail every request.
+    app = server.app.app_uri or ''
+    if app.startswith('waterconnect.asgi') != ASGI_WORKER:
+        raise RuntimeError(
+            f"{app} cannot be served by the {worker_class} worker class: use waterconnect.asgi:application "
+            "with uvicorn.workers.UvicornWorker and waterconnect.wsgi:application otherwise."
+        )
@@ -1,7 +1,10 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import render
 from django.urls import path
+from django.utils import timezone
 from .models import (
     WaterSource, 
     IssueReport, 
@@ -10,16 +13,22 @@ from .models import (
     WaterOrder, 
     VendorClickLog, 
     MpesaTransaction,
-    VendorReview     
+    MpesaCallback,
+    VendorReview,
+    VendorDailyStats,
+    OutboundEmail,
+    WaterSourceStatusEvent
 )
 from . import views 
+from .imports import DEDUPE_METERS, ImportFileError, import_sources
 from .forms import (
     RepairLogForm, 
     WaterSourceForm, 
     IssueReportForm, 
     AdminRepairLogForm, 
     AdminWaterSourceForm, 
-    AdminIssueReportForm
+    AdminIssueReportForm,
+    SourceImportForm
 )
 
 original_get_urls = admin.site.get_urls
@@ -28,18 +37,61 @@ def get_admin_urls():
     urls = original_get_urls()
     custom_urls = [
         path('export/issues/', views.export_issues_csv, name='export_issues_csv'),
+        path('export/data/<str:dataset>/', views.export_data, name='export_data'),
     ]
     return custom_urls + urls
 
 admin.site.get_urls = get_admin_urls
 
 
+class StatusEventInline(admin.TabularInline):
+    model = WaterSourceStatusEvent
+    fields = ('at', 'previous_status', 'status')
+    readonly_fields = fields
+    ordering = ('-at', '-id')
+    extra = 0
+    max_num = 0
+    can_delete = False
+
+
 @admin.register(WaterSource)
 class WaterSourceAdmin(admin.ModelAdmin):
     form = AdminWaterSourceForm
-    list_display = ('name', 'source_type', 'status', 'is_verified', 'last_updated')
-    list_filter = ('status', 'source_type', 'is_verified')
+    inlines = [StatusEventInline]
+    list_display = ('name', 'source_type', 'status', 'is_verified', 'open_issue_count', 'max_open_priority', 'last_updated')
+    list_filter = ('status', 'source_type', 'is_verified', 'max_open_priority')
     search_fields = ('name', 'description')
+    change_list_template = 'admin/waterapp/watersource/change_list.html'
+
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='waterapp_watersource_import'),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        result = None
+        form = SourceImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            try:
+                result = import_sources(upload, upload.name, request.user)
+            except ImportFileError as e:
+                form.add_error('file', str(e))
+            else:
+                messages.success(request, f"Imported {result.created + result.updated} of {result.rows} rows.")
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': "Import water sources",
+            'opts': self.model._meta,
+            'form': form,
+            'result': result,
+            'problems': result.problems[:500] if result else [],
+            'dedupe_meters': DEDUPE_METERS,
+        }
+        return render(request, 'admin/waterapp/watersource/import_sources.html', context)
 
 
 
@@ -98,11 +150,36 @@ class VendorClickLogAdmin(admin.ModelAdmin):
     list_display = ('vendor', 'timestamp')
     list_filter = ('timestamp', 'vendor')
 
+@admin.register(VendorDailyStats)
+class VendorDailyStatsAdmin(admin.ModelAdmin):
+    list_display = ('vendor', 'date', 'clicks')
+    list_filter = ('date', 'vendor')
+
 @admin.register(MpesaTransaction)
 class MpesaTransactionAdmin(admin.ModelAdmin):
-    list_display = ('transaction_code', 'phone_number', 'amount', 'vendor', 'status', 'created_at')
+    list_display = ('transaction_code', 'phone_number', 'amount', 'vendor', 'status', 'receipt_number', 'created_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('transaction_code', 'phone_number', 'receipt_number')
+
+@admin.register(MpesaCallback)
+class MpesaCallbackAdmin(admin.ModelAdmin):
+    list_display = ('id', 'received_at', 'processed_at', 'outcome')
+    list_filter = ('outcome', 'received_at')
+    search_fields = ('body',)
+    readonly_fields = ('body', 'received_at', 'processed_at', 'outcome')
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipient', 'status', 'attempts', 'next_attempt_at', 'sent_at')
     list_filter = ('status', 'created_at')
-    search_fields = ('transaction_code', 'phone_number')
+    search_fields = ('recipient', 'subject')
+    actions = ['retry_now']
+
+    @admin.action(description="Retry selected emails now")
+    def retry_now(self, request, queryset):
+        queryset.exclude(status=OutboundEmail.SENT).update(
+            status=OutboundEmail.PENDING, attempts=0, next_attempt_at=timezone.now()
+        )
 
 @admin.register(VendorReview)
 class VendorReviewAdmin(admin.ModelAdmin):
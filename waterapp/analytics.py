@@ -0,0 +1,230 @@
+"""
+Uptime and repair analytics for water sources.
+
+``refresh_analytics`` materializes per-source, per-day facts into
+SourceDailyStats and sums them per source type into SourceTypeDailyStats.
+The analytics view and API read only those two tables, so their cost
+depends on the date range asked for, not on how much history exists.
+
+The job is incremental: it resumes from its watermark (re-doing the last
+REFRESH_OVERLAP_DAYS) and always runs through today. Sources that are still
+down keep accruing downtime on the current day, and resolving an issue only
+touches the day it is resolved, so older days only change when history is
+edited (a back-dated repair log, a deleted issue); ``since`` re-rolls those.
+
+Downtime is the time a source spent in a non-operational status, from the
+WaterSourceStatusEvent log. Issues resolved before ``resolved_at`` was
+recorded have no known resolution time and are left out of MTTR.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .models import (
+    IssueReport, RepairLog, RollupWatermark, SourceDailyStats, SourceTypeDailyStats, WaterSource,
+    WaterSourceStatusEvent,
+)
+from .status_log import down_intervals
+
+WATERMARK = 'source-analytics'
+REFRESH_OVERLAP_DAYS = 1
+DEFAULT_RANGE_DAYS = 30
+MAX_RANGE_DAYS = 366
+TOP_SOURCES = 10
+
+FACT_FIELDS = (
+    'downtime_hours', 'issues_opened', 'issues_resolved', 'resolution_hours', 'repairs', 'repair_cost',
+)
+
+
+class AnalyticsQueryError(ValueError):
+    """Raised for a malformed date range or source type."""
+
+
+def _midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _hours(delta):
+    return delta.total_seconds() / 3600
+
+
+def _split_by_day(start, end):
+    """Yields (local date, hours) for the part of [start, end) on each day."""
+    while start < end:
+        day = timezone.localdate(start)
+        boundary = min(_midnight(day + timedelta(days=1)), end)
+        yield day, _hours(boundary - start)
+        start = boundary
+
+
+def compute_source_facts(start, end):
+    """{(source_id, day): {fact: value}} for the days start..end inclusive."""
+    lo, hi = _midnight(start), _midnight(end + timedelta(days=1))
+    facts = defaultdict(lambda: dict.fromkeys(FACT_FIELDS, 0))
+
+    for source_id, spans in down_intervals(lo, hi).items():
+        for span_start, span_end in spans:
+            for day, hours in _split_by_day(max(span_start, lo), min(span_end, hi)):
+                facts[source_id, day]['downtime_hours'] += hours
+
+    opened = IssueReport.objects.filter(
+        water_source__isnull=False, reported_at__gte=lo, reported_at__lt=hi,
+    ).values_list('water_source_id', 'reported_at')
+    for source_id, reported_at in opened:
+        facts[source_id, timezone.localdate(reported_at)]['issues_opened'] += 1
+
+    resolved = IssueReport.objects.filter(
+        water_source__isnull=False, resolved_at__gte=lo, resolved_at__lt=hi,
+    ).values_list('water_source_id', 'reported_at', 'resolved_at')
+    for source_id, reported_at, resolved_at in resolved:
+        bucket = facts[source_id, timezone.localdate(resolved_at)]
+        bucket['issues_resolved'] += 1
+        bucket['resolution_hours'] += _hours(resolved_at - reported_at)
+
+    repairs = (
+        RepairLog.objects.filter(repair_date__range=(start, end))
+        .values('water_source_id', 'repair_date')
+        .annotate(count=Count('pk'), cost=Sum('cost'))
+        .order_by()
+    )
+    for row in repairs:
+        bucket = facts[row['water_source_id'], row['repair_date']]
+        bucket['repairs'] = row['count']
+        bucket['repair_cost'] = row['cost'] or Decimal('0.00')
+    return facts
+
+
+def _last_rolled_day():
+    watermark = RollupWatermark.objects.filter(name=WATERMARK).first()
+    return watermark.rolled_through if watermark else None
+
+
+def _first_history_day():
+    first_issue = IssueReport.objects.filter(water_source__isnull=False).order_by('reported_at').first()
+    first_repair = RepairLog.objects.order_by('repair_date').first()
+    days = [timezone.localdate(first_issue.reported_at)] if first_issue else []
+    days += [first_repair.repair_date] if first_repair else []
+    first_event = WaterSourceStatusEvent.objects.order_by('at').first()
+    days += [timezone.localdate(first_event.at)] if first_event else []
+    return min(days, default=None)
+
+
+def refresh_analytics(since=None, until=None):
+    """
+    Re-materializes the rollups for since..until (default: from the
+    watermark, or the start of history on the first run, through today).
+    Returns the (start, end) days rolled up, or None when there is no
+    history yet.
+    """
+    end = until or timezone.localdate()
+    if since is None:
+        last = _last_rolled_day()
+        since = last - timedelta(days=REFRESH_OVERLAP_DAYS) if last else _first_history_day()
+        if since is None:
+            return None
+    start = min(since, end)
+
+    facts = compute_source_facts(start, end)
+    source_types = dict(
+        WaterSource.objects.filter(pk__in={source_id for source_id, _ in facts}).values_list('pk', 'source_type')
+    )
+    with transaction.atomic():
+        SourceDailyStats.objects.filter(day__range=(start, end)).delete()
+        SourceDailyStats.objects.bulk_create(
+            [
+                SourceDailyStats(source_id=source_id, source_type=source_types[source_id], day=day, **values)
+                for (source_id, day), values in facts.items() if source_id in source_types
+            ],
+            batch_size=1000,
+        )
+        SourceTypeDailyStats.objects.filter(day__range=(start, end)).delete()
+        per_type = (
+            SourceDailyStats.objects.filter(day__range=(start, end))
+            .values('source_type', 'day')
+            .annotate(sources=Count('pk'), **{name: Sum(name) for name in FACT_FIELDS})
+            .order_by()
+        )
+        SourceTypeDailyStats.objects.bulk_create([SourceTypeDailyStats(**row) for row in per_type], batch_size=1000)
+        if end >= (_last_rolled_day() or end):
+            RollupWatermark.objects.update_or_create(name=WATERMARK, defaults={'rolled_through': end})
+    return start, end
+
+
+def parse_analytics_query(params):
+    """Reads ``start``/``end`` (YYYY-MM-DD, default the last 30 days) and ``type``."""
+    today = timezone.localdate()
+    try:
+        end = datetime.strptime(params['end'], '%Y-%m-%d').date() if params.get('end') else today
+        start = (
+            datetime.strptime(params['start'], '%Y-%m-%d').date() if params.get('start')
+            else end - timedelta(days=DEFAULT_RANGE_DAYS - 1)
+        )
+    except ValueError:
+        raise AnalyticsQueryError("start and end must be dates in YYYY-MM-DD format.")
+    if start > end or (end - start).days >= MAX_RANGE_DAYS:
+        raise AnalyticsQueryError(f"start must not be after end, and the range is limited to {MAX_RANGE_DAYS} days.")
+
+    source_type = params.get('type') or None
+    if source_type and source_type not in dict(WaterSource.SOURCE_TYPES):
+        raise AnalyticsQueryError(f"Unknown source type '{source_type}'.")
+    return {'start': start, 'end': end, 'source_type': source_type}
+
+
+def _facts(row):
+    resolved = row['issues_resolved'] or 0
+    return {
+        'downtime_hours': round(row['downtime_hours'] or 0, 2),
+        'issues_opened': row['issues_opened'] or 0,
+        'issues_resolved': resolved,
+        'mttr_hours': round(row['resolution_hours'] / resolved, 2) if resolved else None,
+        'repairs': row['repairs'] or 0,
+        'repair_cost': float(row['repair_cost'] or 0),
+    }
+
+
+def analytics_summary(start, end, source_type=None):
+    """The analytics payload for start..end, read from the rollups only."""
+    sums = {name: Sum(name) for name in FACT_FIELDS}
+    per_type = SourceTypeDailyStats.objects.filter(day__range=(start, end))
+    per_source = SourceDailyStats.objects.filter(day__range=(start, end))
+    if source_type:
+        per_type = per_type.filter(source_type=source_type)
+        per_source = per_source.filter(source_type=source_type)
+
+    days = {row['day']: row for row in per_type.values('day').annotate(**sums).order_by()}
+    empty = dict.fromkeys(FACT_FIELDS, 0)
+    series = []
+    day = start
+    while day <= end:
+        series.append({'day': day.isoformat(), **_facts(days.get(day, empty))})
+        day += timedelta(days=1)
+
+    type_names = dict(WaterSource.SOURCE_TYPES)
+    by_type = [
+        {'type': row['source_type'], 'label': type_names.get(row['source_type'], row['source_type']), **_facts(row)}
+        for row in per_type.values('source_type').annotate(**sums).order_by('source_type')
+    ]
+    worst = (
+        per_source.values('source_id', 'source__name')
+        .annotate(**sums)
+        .filter(downtime_hours__gt=0)
+        .order_by('-downtime_hours', 'source_id')[:TOP_SOURCES]
+    )
+    rolled_through = _last_rolled_day()
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'type': source_type,
+        'totals': _facts(per_type.aggregate(**sums)),
+        'series': series,
+        'by_type': by_type,
+        'worst_sources': [
+            {'id': row['source_id'], 'name': row['source__name'], **_facts(row)} for row in worst
+        ],
+        'rolled_through': rolled_through.isoformat() if rolled_through else None,
+    }
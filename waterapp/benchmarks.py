@@ -0,0 +1,851 @@
+"""
+Benchmarks run with ``python manage.py benchmark <scenario>``.
+
+Every scenario seeds its own data inside a transaction that is rolled back
+at the end, so it is safe to run against a development database.
+"""
+import asyncio
+import csv
+import io
+import json
+import random
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import statistics
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.db import close_old_connections, transaction
+from django.test import RequestFactory
+from django.utils import timezone
+
+from . import geo
+from .caching import refresh_versions
+from .analytics import analytics_summary, compute_source_facts, refresh_analytics
+from .clicks import ClickBuffer, add_daily_clicks, click_chart
+from .map_data import rebuild_clusters
+from .exports import export_response
+from .fake_daraja import FakeDaraja
+from .imports import import_sources
+from .payment_callbacks import parse_callback, process_callbacks, result_status
+from .payments import DarajaGateway
+from .nearest import SOURCE_FIELDS, k_nearest
+from .search import rebuild_index, search
+from .models import (
+    IssueReport, MpesaCallback, MpesaTransaction, RepairLog, VendorClickLog, WaterSource, WaterSourceStatusEvent,
+    WaterVendor,
+)
+
+SCENARIOS = {}
+
+# Rough bounding box of Kenya, used to scatter seeded points.
+SEED_BOX = (-4.7, 33.9, 5.0, 41.9)
+NAIROBI_BBOX = '36.75,-1.35,36.90,-1.22'
+
+
+def scenario(name):
+    """Registers a function as a benchmark scenario."""
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+@contextmanager
+def rolled_back():
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+def median_ms(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def seed_sources(count, rng):
+    """Bulk-inserts count random sources, filling in the derived columns save() would."""
+    south, west, north, east = SEED_BOX
+    statuses = [code for code, _ in WaterSource.STATUS_CHOICES]
+    types = [code for code, _ in WaterSource.SOURCE_TYPES]
+    batch = []
+    for i in range(count):
+        lat = Decimal(f"{rng.uniform(south, north):.6f}")
+        lon = Decimal(f"{rng.uniform(west, east):.6f}")
+        batch.append(WaterSource(
+            name=f"Bench Source {i}",
+            source_type=rng.choice(types),
+            latitude=lat,
+            longitude=lon,
+            geokey=geo.encode(lat, lon),
+            status=rng.choice(statuses),
+        ))
+    WaterSource.objects.bulk_create(batch, batch_size=1000)
+
+
+def grow_to(size, rng):
+    missing = size - WaterSource.objects.count()
+    if missing > 0:
+        seed_sources(missing, rng)
+        rebuild_clusters()
+
+
+@scenario('map_bbox')
+def map_bbox(out, sizes, repeat):
+    """Full map payload vs. a city-sized viewport as the table grows."""
+    from . import views
+    water_source_map_data = async_to_sync(views.water_source_map_data)
+
+    factory = RequestFactory()
+    rng = random.Random(42)
+    full = factory.get('/api/map-data/')
+    bbox = factory.get('/api/map-data/', {'bbox': NAIROBI_BBOX})
+    radius = factory.get('/api/map-data/', {'lat': -1.29, 'lon': 36.82, 'radius': 10})
+
+    out.write(f"{'sources':>10} {'full ms':>10} {'bbox ms':>10} {'radius ms':>10}")
+    with rolled_back():
+        for size in sizes:
+            grow_to(size, rng)
+            full_ms = median_ms(lambda: water_source_map_data(full), repeat)
+            bbox_ms = median_ms(lambda: water_source_map_data(bbox), repeat)
+            radius_ms = median_ms(lambda: water_source_map_data(radius), repeat)
+            out.write(f"{size:>10} {full_ms:>10.1f} {bbox_ms:>10.1f} {radius_ms:>10.1f}")
+
+
+@scenario('map_clusters')
+def map_clusters(out, sizes, repeat):
+    """Whole-country view as raw points vs. server-side clusters."""
+    from . import views
+    water_source_map_data = async_to_sync(views.water_source_map_data)
+
+    factory = RequestFactory()
+    rng = random.Random(42)
+    kenya = '33.9,-4.7,41.9,5.0'
+    points = factory.get('/api/map-data/', {'bbox': kenya})
+    clusters = factory.get('/api/map-data/', {'bbox': kenya, 'zoom': 6})
+
+    out.write(f"{'sources':>10} {'points ms':>10} {'points KB':>10} {'cluster ms':>11} {'cluster KB':>11}")
+    with rolled_back():
+        for size in sizes:
+            grow_to(size, rng)
+            points_ms = median_ms(lambda: water_source_map_data(points), repeat)
+            cluster_ms = median_ms(lambda: water_source_map_data(clusters), repeat)
+            points_kb = len(water_source_map_data(points).content) / 1024
+            cluster_kb = len(water_source_map_data(clusters).content) / 1024
+            out.write(f"{size:>10} {points_ms:>10.1f} {points_kb:>10.0f} {cluster_ms:>11.1f} {cluster_kb:>11.0f}")
+
+
+def requests_per_second(func, seconds=2.0):
+    done = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        func()
+        done += 1
+    return done / (time.perf_counter() - start)
+
+
+@scenario('map_cache')
+def map_cache(out, sizes, repeat):
+    """Throughput of the full map payload: rebuilt every time, cached, and 304s."""
+    from . import views
+    water_source_map_data = async_to_sync(views.water_source_map_data)
+
+    factory = RequestFactory()
+    rng = random.Random(42)
+    request = factory.get('/api/map-data/', HTTP_ACCEPT_ENCODING='gzip')
+
+    def cold():
+        refresh_versions('map')
+        water_source_map_data(request)
+
+    out.write(f"{'sources':>10} {'cold req/s':>11} {'warm req/s':>11} {'304 req/s':>11}")
+    with rolled_back():
+        for size in sizes:
+            grow_to(size, rng)
+            cold_rps = requests_per_second(cold)
+            etag = water_source_map_data(request)['ETag']
+            warm_rps = requests_per_second(lambda: water_source_map_data(request))
+            revalidate = factory.get('/api/map-data/', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag)
+            not_modified_rps = requests_per_second(lambda: water_source_map_data(revalidate))
+            out.write(f"{size:>10} {cold_rps:>11.1f} {warm_rps:>11.1f} {not_modified_rps:>11.1f}")
+
+
+def seed_vendor(name='bench-vendor'):
+    user = User.objects.create(username=name)
+    return WaterVendor.objects.create(
+        user=user, business_name=f"Bench Vendor {name}", phone_number="0700000000",
+        location_name="Nairobi", latitude=Decimal('-1.29'), longitude=Decimal('36.82'),
+        is_verified=True
+    )
+
+
+@scenario('vendor_clicks')
+def vendor_clicks(out, sizes, repeat):
+    """Vendor dashboard chart: seven COUNT(*) date-cast queries vs. the daily rollup."""
+    def count_per_day(vendor):
+        today = timezone.localdate()
+        return [
+            VendorClickLog.objects.filter(vendor=vendor, timestamp__date=today - timedelta(days=i)).count()
+            for i in range(6, -1, -1)
+        ]
+
+    rng = random.Random(42)
+    out.write(f"{'clicks':>10} {'raw count ms':>13} {'rollup ms':>10}")
+    with rolled_back():
+        vendor = seed_vendor()
+        now = timezone.now()
+        seeded = 0
+        for size in sizes:
+            logs = [VendorClickLog(vendor=vendor) for _ in range(size - seeded)]
+            created = VendorClickLog.objects.bulk_create(logs, batch_size=2000)
+            # auto_now_add stamps "now"; spread the clicks over the last 90 days.
+            for log in created:
+                log.timestamp = now - timedelta(minutes=rng.randrange(90 * 24 * 60))
+            VendorClickLog.objects.bulk_update(created, ['timestamp'], batch_size=2000)
+            add_daily_clicks(Counter((vendor.pk, timezone.localdate(log.timestamp)) for log in created))
+            seeded = size
+
+            raw_ms = median_ms(lambda: count_per_day(vendor), repeat)
+            rollup_ms = median_ms(lambda: click_chart(vendor), repeat)
+            out.write(f"{size:>10} {raw_ms:>13.1f} {rollup_ms:>10.2f}")
+
+
+@contextmanager
+def committed_vendor(name):
+    """A vendor visible to other threads (so not rolled back), deleted afterwards."""
+    vendor = seed_vendor(name)
+    try:
+        yield vendor
+    finally:
+        vendor.user.delete()
+
+
+@scenario('click_storm')
+def click_storm(out, sizes, repeat):
+    """Concurrent 'Order Now' taps: one INSERT per request vs. the click buffer."""
+    from unittest import mock
+    from django.shortcuts import get_object_or_404
+    from . import views
+
+    def unbuffered(request, vendor_id):
+        # The old per-request path: a click log INSERT and a rollup increment.
+        vendor = get_object_or_404(WaterVendor, pk=vendor_id)
+        with transaction.atomic():
+            VendorClickLog.objects.create(vendor=vendor)
+            add_daily_clicks({(vendor.pk, timezone.localdate()): 1})
+
+    def storm(view, vendor_id, clicks, threads=16):
+        factory = RequestFactory()
+        errors = Counter()
+
+        def tap(_):
+            try:
+                view(factory.get(f'/api/track-click/{vendor_id}/'), vendor_id)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            finally:
+                close_old_connections()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(tap, range(clicks)))
+        return clicks / (time.perf_counter() - start), sum(errors.values())
+
+    out.write(f"{'clicks':>8} {'direct req/s':>13} {'errors':>7} {'buffered req/s':>15} {'errors':>7} {'drain ms':>9}")
+    with committed_vendor('bench-click-storm') as vendor:
+        for size in sizes:
+            direct_rps, direct_errors = storm(unbuffered, vendor.pk, size)
+
+            buffer = ClickBuffer()
+            with mock.patch.object(views, 'click_buffer', buffer):
+                buffered_rps, buffered_errors = storm(async_to_sync(views.track_vendor_click), vendor.pk, size)
+            start = time.perf_counter()
+            buffer.close()
+            drain_ms = (time.perf_counter() - start) * 1000
+            buffered_errors += buffer.stats()['dropped'] + buffer.stats()['failed']
+
+            out.write(
+                f"{size:>8} {direct_rps:>13.0f} {direct_errors:>7} "
+                f"{buffered_rps:>15.0f} {buffered_errors:>7} {drain_ms:>9.0f}"
+            )
+
+
+def peak_memory(func):
+    """Runs func and returns (seconds, peak traced allocation in KB)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        func()
+        return time.perf_counter() - start, tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+@scenario('export')
+def export(out, sizes, repeat):
+    """Issue export: whole report built in memory vs. the streaming engine."""
+    rng = random.Random(42)
+
+    def in_memory():
+        # What export_issues_csv used to do.
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for issue in IssueReport.objects.select_related('water_source', 'vendor'):
+            target = issue.water_source.name if issue.water_source else issue.vendor.business_name
+            writer.writerow([issue.pk, target, issue.priority_level, issue.description, issue.reported_at])
+        return buffer.getvalue()
+
+    def streamed(export_format):
+        def consume():
+            response = export_response('issues', export_format)
+            # Not response.close(): that fires request_finished, which would
+            # close the connection holding the rolled-back seed data.
+            for _ in response.streaming_content:
+                pass
+        return consume
+
+    out.write(f"{'issues':>10} {'memory s':>9} {'memory KB':>10} {'csv s':>7} {'csv KB':>8} {'xlsx s':>7} {'xlsx KB':>8}")
+    with rolled_back():
+        grow_to(100, rng)
+        sources = list(WaterSource.objects.values_list('pk', flat=True)[:100])
+        for size in sizes:
+            missing = size - IssueReport.objects.count()
+            IssueReport.objects.bulk_create(
+                [
+                    IssueReport(water_source_id=rng.choice(sources), description=f"Bench issue {i} " * 4,
+                                priority_level=rng.randint(1, 3))
+                    for i in range(max(missing, 0))
+                ],
+                batch_size=2000,
+            )
+            results = [peak_memory(func) for func in (in_memory, streamed('csv'), streamed('xlsx'))]
+            out.write(f"{size:>10} " + " ".join(f"{secs:>{w}.1f} {kb:>{k}.0f}" for (secs, kb), w, k in zip(
+                results, (9, 7, 7), (10, 8, 8)
+            )))
+
+
+@scenario('search')
+def search_sources(out, sizes, repeat):
+    """Source search: leading-wildcard LIKE vs. the trigram index."""
+    from django.db.models import Q
+
+    rng = random.Random(42)
+
+    def like(query):
+        return list(WaterSource.objects.filter(Q(name__icontains=query) | Q(description__icontains=query))[:50])
+
+    out.write(f"{'sources':>10} {'LIKE ms':>9} {'hits':>5} {'index ms':>9} {'hits':>5} {'typo LIKE':>10} {'typo index':>11}")
+    with rolled_back():
+        for name in ("Kibera Borehole", "Kibera Kiosk", "Kibera Tap 3"):
+            WaterSource.objects.create(name=name, source_type='BH', latitude=-1.31, longitude=36.79)
+        for size in sizes:
+            grow_to(size, rng)
+            rebuild_index(['source'])
+            like_ms = median_ms(lambda: like("kibera"), repeat)
+            index_ms = median_ms(lambda: search('source', "kibera"), repeat)
+            out.write(
+                f"{size:>10} {like_ms:>9.1f} {len(like('kibera')):>5} {index_ms:>9.1f} "
+                f"{len(search('source', 'kibera')):>5} {len(like('kibra')):>10} {len(search('source', 'kibra')):>11}"
+            )
+
+
+@scenario('nearest')
+def nearest(out, sizes, repeat):
+    """Five nearest operational sources: scanning every row vs. the growing geokey box."""
+    rng = random.Random(42)
+    lat, lon = -1.2921, 36.8219
+
+    def scan_all():
+        rows = WaterSource.objects.filter(status='O').values_list('latitude', 'longitude', *SOURCE_FIELDS)
+        return sorted(rows, key=lambda row: geo.haversine_km(lat, lon, float(row[0]), float(row[1])))[:5]
+
+    def indexed():
+        return k_nearest(WaterSource.objects.filter(status='O'), lat, lon, 5, SOURCE_FIELDS)
+
+    out.write(f"{'sources':>10} {'scan ms':>9} {'index ms':>9}")
+    with rolled_back():
+        for size in sizes:
+            grow_to(size, rng)
+            assert [row[2] for row in scan_all()] == [row[2] for row, _ in indexed()]
+            out.write(f"{size:>10} {median_ms(scan_all, repeat):>9.1f} {median_ms(indexed, repeat):>9.1f}")
+
+
+@scenario('import')
+def import_throughput(out, sizes, repeat):
+    """Survey file import throughput, CSV and XLSX, into a table of the same size."""
+    from openpyxl import Workbook
+
+    rng = random.Random(42)
+    south, west, north, east = SEED_BOX
+    types = [label for _, label in WaterSource.SOURCE_TYPES]
+
+    def survey(count):
+        rows = [['name', 'source_type', 'latitude', 'longitude', 'description']]
+        rows += [
+            [f"Survey Point {i}", rng.choice(types), f"{rng.uniform(south, north):.7f}",
+             f"{rng.uniform(west, east):.7f}", "Recorded by county survey"]
+            for i in range(count)
+        ]
+        return rows
+
+    def as_csv(rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return io.BytesIO(buffer.getvalue().encode())
+
+    def as_xlsx(rows):
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        for row in rows:
+            sheet.append(row)
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        buffer.seek(0)
+        return buffer
+
+    out.write(f"{'rows':>8} {'csv rows/s':>11} {'xlsx rows/s':>12} {'rejected':>9}")
+    for size in sizes:
+        rows = survey(size)
+        rates = []
+        for name, build in (('survey.csv', as_csv), ('survey.xlsx', as_xlsx)):
+            with rolled_back():
+                grow_to(size, rng)
+                result = import_sources(build(rows), name)
+            rates.append(result.rows_per_second)
+        out.write(f"{size:>8} {rates[0]:>11.0f} {rates[1]:>12.0f} {len(result.problems):>9}")
+
+
+@scenario('analytics')
+def analytics(out, sizes, repeat):
+    """A year of uptime analytics: computed live from issues/repairs vs. read from the rollups."""
+    rng = random.Random(42)
+    today = timezone.localdate()
+    start = today - timedelta(days=364)
+    now = timezone.now()
+
+    def seed_history(count):
+        # Two years of issues (a third high priority) and one repair per five issues.
+        issues, repairs = [], []
+        for i in range(count):
+            reported = now - timedelta(hours=rng.uniform(0, 2 * 365 * 24))
+            resolved = reported + timedelta(hours=rng.expovariate(1 / 36))
+            issues.append(IssueReport(
+                water_source_id=rng.choice(sources), description="Bench issue", priority_level=rng.randint(1, 3),
+                is_resolved=resolved < now, resolved_at=resolved if resolved < now else None,
+            ))
+            if i % 5 == 0:
+                repairs.append(RepairLog(water_source_id=rng.choice(sources), work_done="Bench repair",
+                                         repair_date=timezone.localdate(resolved), cost=rng.randint(500, 20000)))
+        created = IssueReport.objects.bulk_create(issues, batch_size=2000)
+        RepairLog.objects.bulk_create(repairs, batch_size=2000)
+        # reported_at is auto_now_add; spread it out afterwards.
+        for issue in created:
+            issue.reported_at = issue.resolved_at - timedelta(hours=1) if issue.resolved_at else now - timedelta(days=1)
+        IssueReport.objects.bulk_update(created, ['reported_at'], batch_size=2000)
+        # High-priority issues take their source down until resolved.
+        WaterSourceStatusEvent.objects.bulk_create(
+            [
+                WaterSourceStatusEvent(source_id=issue.water_source_id, status=status, at=at)
+                for issue in created if issue.priority_level == 3
+                for status, at in (('M', issue.reported_at), ('O', issue.resolved_at)) if at
+            ],
+            batch_size=2000,
+        )
+
+    out.write(f"{'issues':>10} {'live ms':>9} {'rollup ms':>10} {'full roll s':>12} {'nightly ms':>11}")
+    with rolled_back():
+        grow_to(2000, rng)
+        sources = list(WaterSource.objects.values_list('pk', flat=True)[:2000])
+        for size in sizes:
+            seed_history(size - IssueReport.objects.count())
+            begin = time.perf_counter()
+            refresh_analytics(since=today - timedelta(days=2 * 366))
+            full_s = time.perf_counter() - begin
+            live_ms = median_ms(lambda: compute_source_facts(start, today), repeat)
+            rollup_ms = median_ms(lambda: analytics_summary(start, today), repeat)
+            nightly_ms = median_ms(refresh_analytics, repeat)
+            out.write(f"{size:>10} {live_ms:>9.1f} {rollup_ms:>10.1f} {full_s:>12.1f} {nightly_ms:>11.1f}")
+
+
+@scenario('stk_push')
+def stk_push(out, sizes, repeat):
+    """STK pushes against a local fake Daraja (50 ms per push): client per payment vs. shared gateway vs. worker pool."""
+
+    def gateway(url):
+        return DarajaGateway(url, 'key', 'secret', '174379', 'passkey', 'http://localhost/callback/')
+
+    def run(label, daraja, count, send):
+        daraja.counters.clear()
+        start = time.perf_counter()
+        send(count)
+        elapsed = time.perf_counter() - start
+        out.write(
+            f"{count:>8} {label:>14} {count / elapsed:>10.1f} {daraja.counters['tokens']:>7} "
+            f"{daraja.counters['connections']:>6}"
+        )
+
+    out.write(f"{'pushes':>8} {'mode':>14} {'pushes/s':>10} {'tokens':>7} {'conns':>6}")
+    with FakeDaraja(latency=0.05) as daraja:
+        shared = gateway(daraja.url)
+
+        def per_payment(count):
+            # The old per-payment path: a new client, token and connection each time.
+            for _ in range(count):
+                gateway(daraja.url).stk_push('254712345678', 10, 'Bench', 'Bench')
+
+        def serial(count):
+            for _ in range(count):
+                shared.stk_push('254712345678', 10, 'Bench', 'Bench')
+
+        def pooled(count):
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(lambda _: shared.stk_push('254712345678', 10, 'Bench', 'Bench'), range(count)))
+
+        for size in sizes:
+            run('per-payment', daraja, size, per_payment)
+            run('shared', daraja, size, serial)
+            run('8 workers', daraja, size, pooled)
+
+
+def stk_callback_body(checkout_request_id, n):
+    return json.dumps({'Body': {'stkCallback': {
+        'MerchantRequestID': f'merchant-{n}', 'CheckoutRequestID': checkout_request_id,
+        'ResultCode': 0, 'ResultDesc': 'The service request is processed successfully.',
+        'CallbackMetadata': {'Item': [
+            {'Name': 'Amount', 'Value': 10}, {'Name': 'MpesaReceiptNumber', 'Value': f'BENCH{n:05d}'},
+        ]},
+    }}})
+
+
+@scenario('mpesa_callbacks')
+def mpesa_callbacks(out, sizes, repeat):
+    """Callback acknowledgements per second, then applying them per row vs. in batches."""
+    from .views import mpesa_callback
+    factory = RequestFactory()
+
+    def seed(size):
+        MpesaTransaction.objects.bulk_create(
+            [
+                MpesaTransaction(transaction_code=f'ws_CO_bench{n}', phone_number='254712345678', amount=10,
+                                 status='Pending (STK Sent)')
+                for n in range(size)
+            ],
+            batch_size=1000,
+        )
+        bodies = [stk_callback_body(f'ws_CO_bench{n}', n) for n in range(size)]
+        start = time.perf_counter()
+        for body in bodies:
+            mpesa_callback(factory.post('/api/mpesa/callback/', body, content_type='application/json'))
+        return size / (time.perf_counter() - start)
+
+    def per_row():
+        # A handler that looks up and saves each payment as its callback arrives.
+        for callback in MpesaCallback.objects.filter(processed_at__isnull=True).order_by('pk'):
+            code, result_code, description, receipt = parse_callback(callback.body)
+            payment = MpesaTransaction.objects.get(transaction_code=code)
+            payment.status, payment.result_description = result_status(result_code), description
+            payment.receipt_number = receipt
+            payment.save()
+            callback.processed_at, callback.outcome = timezone.now(), MpesaCallback.APPLIED
+            callback.save()
+
+    out.write(f"{'callbacks':>10} {'acks/s':>9} {'per-row/s':>10} {'batched/s':>10}")
+    for size in sizes:
+        rates = {}
+        for label, apply in (('per-row', per_row), ('batched', process_callbacks)):
+            with rolled_back():
+                acks = seed(size)
+                start = time.perf_counter()
+                apply()
+                rates[label] = size / (time.perf_counter() - start)
+        out.write(f"{size:>10} {acks:>9.0f} {rates['per-row']:>10.0f} {rates['batched']:>10.0f}")
+
+
+@scenario('source_list')
+def source_list(out, sizes, repeat):
+    """Water source list: the old all-rows GROUP BY query vs. a keyset page, rendered and cached."""
+    from django.contrib.auth.models import AnonymousUser
+    from django.db.models import Count, Q
+    from .pagination import encode_cursor
+    from .views import SOURCE_ORDERING, water_source_list
+
+    factory = RequestFactory()
+    rng = random.Random(42)
+
+    def get(params=None):
+        request = factory.get('/sources/', params or {})
+        request.user = AnonymousUser()
+        return water_source_list(request)
+
+    def grouped():
+        list(WaterSource.objects.annotate(num_open_issues=Count('issues', filter=Q(issues__is_resolved=False))))
+
+    def cold(params=None):
+        refresh_versions('sources')
+        get(params)
+
+    out.write(f"{'sources':>10} {'grouped ms':>11} {'page ms':>9} {'deep ms':>9} {'cached ms':>10}")
+    with rolled_back():
+        for size in sizes:
+            grow_to(size, rng)
+            middle = WaterSource.objects.order_by(*SOURCE_ORDERING)[size // 2]
+            deep = {'cursor': encode_cursor([middle.name, middle.pk])}
+            grouped_ms = median_ms(grouped, max(1, repeat // 5))
+            page_ms = median_ms(cold, repeat)
+            deep_ms = median_ms(lambda: cold(deep), repeat)
+            get()
+            cached_ms = median_ms(get, repeat)
+            out.write(f"{size:>10} {grouped_ms:>11.1f} {page_ms:>9.1f} {deep_ms:>9.1f} {cached_ms:>10.1f}")
+
+
+@scenario('public_pages')
+def public_pages(out, sizes, repeat):
+    """Anonymous requests per second for the public pages, rendered each time vs. served from the page cache."""
+    from django.core.cache import cache
+    from django.test import Client
+    from .page_cache import fragment_key
+
+    client = Client(HTTP_HOST='localhost')
+    rng = random.Random(42)
+    pages = [
+        ('/', 'index', ('dashboard', 'sources', 'vendors')),
+        ('/vendors/', 'vendor_list', ('vendors',)),
+        ('/about/', 'about', ()),
+        ('/legal/terms/', 'legal_page', ()),
+    ]
+
+    def cold(path, view, namespaces):
+        cache.delete(fragment_key(f'page:{view}', namespaces, path))
+        client.get(path)
+
+    out.write(f"{'sources':>10} {'page':<14} {'cold req/s':>11} {'cached req/s':>13}")
+    with rolled_back():
+        for i in range(20):
+            seed_vendor(f'bench-public-{i}')
+        for size in sizes:
+            grow_to(size, rng)
+            for page in pages:
+                path = page[0]
+                cold_rps = requests_per_second(lambda: cold(*page))
+                client.get(path)
+                cached_rps = requests_per_second(lambda: client.get(path))
+                out.write(f"{size:>10} {path:<14} {cold_rps:>11.1f} {cached_rps:>13.1f}")
+
+
+BENCH_PHONE = '0799000000'
+
+
+class PooledWSGIServer(WSGIServer):
+    """wsgiref serving requests from a fixed pool of threads, like gunicorn's sync workers."""
+
+    def __init__(self, address, workers):
+        super().__init__(address, QuietWSGIRequestHandler)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            close_old_connections()
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def wsgi_server(workers):
+    from django.core.wsgi import get_wsgi_application
+
+    server = PooledWSGIServer(('127.0.0.1', 0), workers)
+    server.set_app(get_wsgi_application())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.pool.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def asgi_server():
+    import uvicorn
+    from django.core.asgi import get_asgi_application
+
+    server = uvicorn.Server(uvicorn.Config(
+        get_asgi_application(), host='127.0.0.1', port=0, lifespan='off', log_level='warning',
+    ))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f'http://127.0.0.1:{server.servers[0].sockets[0].getsockname()[1]}'
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+async def mixed_load(base_url, clients, requests_each):
+    """
+    ``clients`` concurrent visitors each making ``requests_each`` requests:
+    every fifth a donation (an STK push), the rest map-data. Returns the
+    map-data latencies in ms, the elapsed seconds and the error count.
+    """
+    import asyncio
+    import re
+    import httpx
+
+    latencies, errors = [], Counter()
+
+    async def visitor():
+        async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+            form = await client.get('/donate/')
+            token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', form.text).group(1)
+            for i in range(requests_each):
+                start = time.perf_counter()
+                try:
+                    if i % 5 == 4:
+                        response = await client.post(
+                            '/donate/', data={'phone': BENCH_PHONE, 'amount': '10', 'csrfmiddlewaretoken': token},
+                        )
+                        ok = response.status_code == 302
+                    else:
+                        response = await client.get('/api/map-data/', headers={'Accept-Encoding': 'gzip'})
+                        ok = response.status_code == 200
+                        latencies.append((time.perf_counter() - start) * 1000)
+                except httpx.HTTPError as e:
+                    ok = False
+                    errors[type(e).__name__] += 1
+                if not ok:
+                    errors['failed'] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(visitor() for _ in range(clients)))
+    return latencies, time.perf_counter() - start, sum(errors.values())
+
+
+def _run_mixed_load(*args):
+    import asyncio
+    return asyncio.run(mixed_load(*args))
+
+
+def run_load(*args):
+    """Runs ``mixed_load`` in a forked process, so the client does not compete with the server for the GIL."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as pool:
+        return pool.submit(_run_mixed_load, *args).result()
+
+
+@scenario('asgi_stack')
+def asgi_stack(out, sizes, repeat):
+    """
+    Concurrent visitors against the app served by 4 sync WSGI worker threads
+    vs. one uvicorn event loop, with Daraja answering each push in 500 ms.
+    ``sizes`` are the numbers of concurrent visitors.
+    """
+    from django.test import override_settings
+    from .payments import STATUS_QUEUED, normalize_phone, reset_gateway
+
+    def percentile(samples, fraction):
+        samples = sorted(samples)
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    started = timezone.now()
+    payments = MpesaTransaction.objects.filter(phone_number=normalize_phone(BENCH_PHONE), created_at__gte=started)
+    queued = payments.filter(status=STATUS_QUEUED)
+    out.write(f"{'visitors':>9} {'stack':>6} {'req/s':>8} {'map p50 ms':>11} {'map p95 ms':>11} {'errors':>7}")
+    with FakeDaraja(latency=0.5) as daraja, override_settings(
+        MPESA_API_BASE_URL=daraja.url, MPESA_CONSUMER_KEY='key', MPESA_CONSUMER_SECRET='secret',
+    ):
+        try:
+            for size in sizes:
+                for label, server in (('wsgi', lambda: wsgi_server(4)), ('asgi', asgi_server)):
+                    reset_gateway()
+                    with server() as url:
+                        latencies, elapsed, errors = run_load(url, size, repeat * 4)
+                        # Let in-flight pushes finish before the server stops.
+                        deadline = time.monotonic() + 30
+                        while queued.exists() and time.monotonic() < deadline:
+                            time.sleep(0.1)
+                    out.write(
+                        f"{size:>9} {label:>6} {size * repeat * 4 / elapsed:>8.1f} "
+                        f"{percentile(latencies, 0.5):>11.1f} {percentile(latencies, 0.95):>11.1f} {errors:>7}"
+                    )
+        finally:
+            reset_gateway()
+            payments.delete()
+
+
+@scenario('live_map')
+def live_map_fanout(out, sizes, repeat):
+    """
+    Idle live map subscribers held by one process: memory each, and the time
+    from publishing a status change to every subscriber having it.
+    ``sizes`` are the numbers of subscribers.
+    """
+    from .live_map import Event, LiveMapBroker
+
+    async def measure(size):
+        broker = LiveMapBroker(poll_seconds=3600)
+        tracemalloc.start()
+        subscribers = [broker.subscribe() for _ in range(size)]
+        received = 0
+        done = asyncio.Event()
+
+        async def consume(subscriber):
+            nonlocal received
+            while True:
+                await subscriber.queue.get()
+                received += 1
+                if received == size:
+                    done.set()
+
+        consumers = [asyncio.create_task(consume(subscriber)) for subscriber in subscribers]
+        await asyncio.sleep(0)
+        memory_kb = tracemalloc.get_traced_memory()[0] / 1024
+        tracemalloc.stop()
+
+        samples = []
+        for i in range(repeat):
+            received = 0
+            done.clear()
+            start = time.perf_counter()
+            broker.publish([Event('source', i, timezone.now(), {'id': i, 'status': 'Operational', 'color': 'success'})])
+            await done.wait()
+            samples.append((time.perf_counter() - start) * 1000)
+        for consumer in consumers:
+            consumer.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+        await broker.aclose()
+        return memory_kb / size, statistics.median(samples)
+
+    broker = LiveMapBroker()
+    poll_ms = median_ms(broker.poll, repeat)
+    out.write(f"poll of both status logs: {poll_ms:.2f} ms")
+    out.write(f"{'subscribers':>12} {'KB each':>8} {'fan-out ms':>11}")
+    for size in sizes:
+        per_subscriber_kb, fanout_ms = async_to_sync(measure)(size)
+        out.write(f"{size:>12} {per_subscriber_kb:>8.2f} {fanout_ms:>11.2f}")
@@ -0,0 +1,60 @@
+"""
+Version tokens for cached data.
+
+Each namespace (e.g. ``'map'``) has a version token stored in the cache.
+Everything derived from that data is cached under a key containing the
+token, so bumping the version invalidates all of it at once, across every
+worker sharing the cache, without having to know which keys exist.
+"""
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+def _version_key(namespace):
+    return f"version:{namespace}"
+
+
+def get_version(namespace):
+    """Returns the current version token of a namespace, creating one if needed."""
+    key = _version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        version = uuid4().hex[:16]
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+async def aget_version(namespace):
+    """``get_version`` for async views."""
+    key = _version_key(namespace)
+    version = await cache.aget(key)
+    if version is None:
+        version = uuid4().hex[:16]
+        if not await cache.aadd(key, version, None):
+            version = await cache.aget(key, version)
+    return version
+
+
+def get_versions(*namespaces):
+    """Returns the version tokens of several namespaces, in one cache read once they exist."""
+    found = cache.get_many([_version_key(namespace) for namespace in namespaces])
+    return [found.get(_version_key(namespace)) or get_version(namespace) for namespace in namespaces]
+
+
+def refresh_versions(*namespaces):
+    """Gives each namespace a fresh version token immediately."""
+    cache.set_many({_version_key(namespace): uuid4().hex[:16] for namespace in namespaces}, None)
+
+
+def bump_version(*namespaces):
+    """
+    Invalidates the namespaces once the current transaction commits, so no
+    reader can cache the old data under the new version.
+
+    Fresh random tokens (rather than a counter) mean two concurrent bumps
+    can never land on the same version.
+    """
+    transaction.on_commit(lambda: refresh_versions(*namespaces))
@@ -0,0 +1,224 @@
+"""
+Vendor 'Order Now' click counting.
+
+Raw clicks are kept in VendorClickLog for a limited time; the numbers the
+dashboards show come from the VendorDailyStats rollup, which is incremented
+as clicks are recorded.
+
+Clicks from the map arrive in bursts, so the track-click API does not write
+them on the request thread: it hands them to ``click_buffer``, which writes
+them in batches from a background thread.
+"""
+import atexit
+import logging
+import queue
+import threading
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import VendorClickLog, VendorDailyStats, WaterVendor
+
+logger = logging.getLogger(__name__)
+
+RAW_CLICK_RETENTION_DAYS = 30
+
+
+def add_daily_clicks(counts):
+    """
+    Adds click counts to the rollup. ``counts`` maps (vendor_id, date) to the
+    number of clicks; each bucket is one atomic ``F()`` increment, with an
+    insert when the bucket does not exist yet.
+    """
+    for (vendor_id, date), clicks in counts.items():
+        bucket = VendorDailyStats.objects.filter(vendor_id=vendor_id, date=date)
+        if bucket.update(clicks=F('clicks') + clicks):
+            continue
+        try:
+            with transaction.atomic():
+                VendorDailyStats.objects.create(vendor_id=vendor_id, date=date, clicks=clicks)
+        except IntegrityError:
+            # Another request created the bucket first.
+            bucket.update(clicks=F('clicks') + clicks)
+
+
+def write_clicks(clicks):
+    """
+    Bulk-writes (vendor_id, timestamp) click events and their rollup
+    increments in one transaction. Clicks for vendors that no longer exist
+    are skipped. Returns the number of clicks written.
+    """
+    known = set(
+        WaterVendor.objects.filter(pk__in={vendor_id for vendor_id, _ in clicks}).values_list('pk', flat=True)
+    )
+    clicks = [(vendor_id, at) for vendor_id, at in clicks if vendor_id in known]
+    with transaction.atomic():
+        VendorClickLog.objects.bulk_create(
+            [VendorClickLog(vendor_id=vendor_id, timestamp=at) for vendor_id, at in clicks],
+            batch_size=500,
+        )
+        add_daily_clicks(Counter((vendor_id, timezone.localdate(at)) for vendor_id, at in clicks))
+    return len(clicks)
+
+
+class ClickBuffer:
+    """
+    A bounded in-process queue of click events, flushed with ``write_clicks``
+    by a background thread once ``batch_size`` clicks are waiting or every
+    ``flush_interval`` seconds, and once more when the process exits.
+
+    When ``max_pending`` clicks are already waiting, new ones are dropped
+    rather than blocking the request; ``stats()`` reports how many.
+    """
+
+    def __init__(self, batch_size=200, flush_interval=2.0, max_pending=10000, autostart=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.autostart = autostart
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._counters = Counter()
+
+    def add(self, vendor_id):
+        """Queues one click; returns False if it was dropped because the buffer is full."""
+        try:
+            self._queue.put_nowait((vendor_id, timezone.now()))
+        except queue.Full:
+            self._counters['dropped'] += 1
+            return False
+        self._counters['accepted'] += 1
+        if self.autostart:
+            self._ensure_worker()
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def flush(self):
+        """Writes every click queued so far; returns how many were written."""
+        with self._flush_lock:
+            written = 0
+            while True:
+                batch = self._take(self.batch_size * 10)
+                if not batch:
+                    return written
+                try:
+                    count = write_clicks(batch)
+                except Exception:
+                    self._counters['failed'] += len(batch)
+                    logger.exception("Could not write %d buffered vendor clicks", len(batch))
+                    continue
+                written += count
+                self._counters['written'] += count
+                self._counters['unknown_vendor'] += len(batch) - count
+                self._counters['batches'] += 1
+
+    def stats(self):
+        """Counters since start, plus the number of clicks still pending."""
+        stats = {
+            key: self._counters[key]
+            for key in ('accepted', 'dropped', 'written', 'unknown_vendor', 'failed', 'batches')
+        }
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+    def close(self):
+        """Stops the worker and writes whatever is still queued."""
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        if self._counters['dropped']:
+            logger.warning("Click buffer closed; %s", self.stats())
+
+    def _take(self, limit):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _ensure_worker(self):
+        if self._thread is not None or self._closed:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='click-buffer', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            close_old_connections()
+
+
+click_buffer = ClickBuffer(
+    batch_size=getattr(settings, 'CLICK_BUFFER_BATCH_SIZE', 200),
+    flush_interval=getattr(settings, 'CLICK_BUFFER_FLUSH_INTERVAL', 2.0),
+    max_pending=getattr(settings, 'CLICK_BUFFER_MAX_PENDING', 10000),
+)
+
+
+def click_chart(vendor, days=7):
+    """
+    Returns (labels, counts) for the last ``days`` days, oldest first, from
+    a single range query on the (vendor, date) index.
+    """
+    today = timezone.localdate()
+    dates = [today - timedelta(days=i) for i in range(days - 1, -1, -1)]
+    clicks = dict(
+        VendorDailyStats.objects.filter(vendor=vendor, date__range=(dates[0], today))
+        .values_list('date', 'clicks')
+    )
+    return [d.strftime('%a') for d in dates], [clicks.get(d, 0) for d in dates]
+
+
+def daily_counts_from_logs(logs):
+    """Folds a VendorClickLog queryset into {(vendor_id, local date): clicks}."""
+    rows = (
+        logs.annotate(date=TruncDate('timestamp'))
+        .values('vendor_id', 'date')
+        .annotate(clicks=Count('pk'))
+        .order_by()
+    )
+    return Counter({(row['vendor_id'], row['date']): row['clicks'] for row in rows})
+
+
+def compact_click_logs(keep_days=RAW_CLICK_RETENTION_DAYS, rebuild=False):
+    """
+    Deletes raw click logs from before the last ``keep_days`` whole days.
+    The rollup already counts them, so nothing is lost.
+
+    With ``rebuild``, the rollup buckets for the retained days are first
+    recomputed from the raw logs, repairing any drift.
+    Returns (rebuilt buckets, deleted logs).
+    """
+    cutoff_date = timezone.localdate() - timedelta(days=keep_days)
+    cutoff = timezone.make_aware(datetime.combine(cutoff_date, time.min))
+
+    rebuilt = 0
+    with transaction.atomic():
+        if rebuild:
+            counts = daily_counts_from_logs(VendorClickLog.objects.filter(timestamp__gte=cutoff))
+            VendorDailyStats.objects.filter(date__gte=cutoff_date).delete()
+            VendorDailyStats.objects.bulk_create(
+                [VendorDailyStats(vendor_id=v, date=d, clicks=n) for (v, d), n in counts.items()],
+                batch_size=1000,
+            )
+            rebuilt = len(counts)
+        deleted, _ = VendorClickLog.objects.filter(timestamp__lt=cutoff).delete()
+    return rebuilt, deleted
@@ -0,0 +1,208 @@
+"""
+Streaming data exports for staff.
+
+Rows are read with ``values_list`` projections through ``.iterator()``, so
+neither model instances nor the whole result set are ever held in memory.
+CSV is streamed to the client as it is produced; XLSX is written with
+openpyxl's write-only workbook to a temporary file and streamed from disk.
+"""
+import csv
+import io
+import tempfile
+from dataclasses import dataclass, field
+from datetime import date, datetime, time, timedelta
+
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from openpyxl import Workbook
+
+from .models import IssueReport, MpesaTransaction, RepairLog, WaterOrder
+
+CHUNK_SIZE = 2000
+# CSV rows are joined into blocks of about this many bytes per write.
+STREAM_BLOCK_BYTES = 64 * 1024
+
+FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+class ExportError(ValueError):
+    """Raised for an unknown dataset, format or malformed filter."""
+
+
+@dataclass(frozen=True)
+class Dataset:
+    model: type
+    # (header, field name or expression) pairs, in output order.
+    columns: tuple
+    date_field: str
+    # status filter value -> Q(); empty when the dataset has no status.
+    statuses: dict = field(default_factory=dict)
+    ordering: tuple = ('pk',)
+
+    def queryset(self, start=None, end=None, status=None):
+        rows = self.model.objects.all()
+        if start:
+            rows = rows.filter(**{f'{self.date_field}__gte': self._bound(start)})
+        if end:
+            rows = rows.filter(**{f'{self.date_field}__lt': self._bound(end + timedelta(days=1))})
+        if status:
+            if status not in self.statuses:
+                raise ExportError(f"Unknown status '{status}'; expected one of: {', '.join(self.statuses) or 'none'}.")
+            rows = rows.filter(self.statuses[status])
+        return rows.order_by(*self.ordering).values_list(*(column for _, column in self.columns))
+
+    def _bound(self, day):
+        # Whole local days, as a plain range on the column so its index applies.
+        if self.model._meta.get_field(self.date_field).get_internal_type() == 'DateTimeField':
+            return timezone.make_aware(datetime.combine(day, time.min))
+        return day
+
+    @property
+    def headers(self):
+        return [header for header, _ in self.columns]
+
+
+DATASETS = {
+    'issues': Dataset(
+        IssueReport,
+        (
+            ('ID', 'pk'),
+            ('Source', Coalesce('water_source__name', 'vendor__business_name')),
+            ('Priority', 'priority_level'),
+            ('Resolved', 'is_resolved'),
+            ('Reporter', 'reporter__username'),
+            ('Description', 'description'),
+            ('Reported At', 'reported_at'),
+        ),
+        'reported_at',
+        {'open': Q(is_resolved=False), 'resolved': Q(is_resolved=True)},
+    ),
+    'repairs': Dataset(
+        RepairLog,
+        (
+            ('ID', 'pk'),
+            ('Source', 'water_source__name'),
+            ('Technician', 'technician__username'),
+            ('Repair Date', 'repair_date'),
+            ('Work Done', 'work_done'),
+            ('Cost', 'cost'),
+        ),
+        'repair_date',
+    ),
+    'orders': Dataset(
+        WaterOrder,
+        (
+            ('ID', 'pk'),
+            ('Vendor', 'vendor__business_name'),
+            ('Customer', 'customer__username'),
+            ('Quantity', 'quantity'),
+            ('Total Cost', 'total_cost'),
+            ('Status', 'status'),
+            ('Phone', 'customer_phone'),
+            ('Delivery Address', 'delivery_address'),
+            ('Created At', 'created_at'),
+        ),
+        'created_at',
+        {code.lower(): Q(status=code) for code, _ in WaterOrder.ORDER_STATUS},
+    ),
+    'payments': Dataset(
+        MpesaTransaction,
+        (
+            ('ID', 'pk'),
+            ('Transaction Code', 'transaction_code'),
+            ('Phone', 'phone_number'),
+            ('Amount', 'amount'),
+            ('Status', 'status'),
+            ('Vendor', 'vendor__business_name'),
+            ('Created At', 'created_at'),
+        ),
+        'created_at',
+        # By prefix, so 'pending' also covers 'Pending (STK Sent)'.
+        {code.lower(): Q(status__istartswith=code) for code, _ in MpesaTransaction.STATUSES},
+    ),
+}
+
+
+def parse_filters(params):
+    """Reads ``start``/``end`` (YYYY-MM-DD) and ``status`` from request parameters."""
+    filters = {}
+    for key in ('start', 'end'):
+        if params.get(key):
+            try:
+                filters[key] = parse_date(params[key])
+            except ValueError:
+                filters[key] = None
+            if filters[key] is None:
+                raise ExportError(f"'{key}' must be a date in YYYY-MM-DD format.")
+    if params.get('status'):
+        filters['status'] = params['status'].lower()
+    return filters
+
+
+def _plain(value):
+    if isinstance(value, datetime):
+        return timezone.localtime(value).replace(tzinfo=None) if timezone.is_aware(value) else value
+    return value
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return _plain(value).strftime('%Y-%m-%d %H:%M')
+    if isinstance(value, date):
+        return value.isoformat()
+    return '' if value is None else value
+
+
+def csv_chunks(headers, rows):
+    """Yields the CSV in blocks of roughly STREAM_BLOCK_BYTES."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        if buffer.tell() >= STREAM_BLOCK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def write_xlsx(headers, rows, title):
+    """Writes an XLSX workbook to a temporary file and returns it rewound."""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=title)
+    sheet.append(headers)
+    for row in rows:
+        sheet.append([_plain(value) for value in row])
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+
+def export_response(name, export_format='csv', filename=None, **filters):
+    """Builds the streaming response for one dataset; raises ExportError for bad input."""
+    if name not in DATASETS:
+        raise ExportError(f"Unknown export '{name}'; expected one of: {', '.join(DATASETS)}.")
+    if export_format not in FORMATS:
+        raise ExportError(f"Unknown format '{export_format}'; expected one of: {', '.join(FORMATS)}.")
+
+    dataset = DATASETS[name]
+    rows = dataset.queryset(**filters).iterator(chunk_size=CHUNK_SIZE)
+    filename = f"{filename or name}.{export_format}"
+
+    if export_format == 'xlsx':
+        return FileResponse(
+            write_xlsx(dataset.headers, rows, name), as_attachment=True, filename=filename,
+            content_type=FORMATS['xlsx'],
+        )
+
+    response = StreamingHttpResponse(csv_chunks(dataset.headers, rows), content_type=FORMATS['csv'])
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
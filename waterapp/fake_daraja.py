@@ -0,0 +1,129 @@
+"""
+A local stand-in for the Safaricom Daraja API, for tests and benchmarks.
+
+    with FakeDaraja(latency=0.05) as daraja:
+        with override_settings(MPESA_API_BASE_URL=daraja.url):
+            ...
+
+It serves the OAuth, STK push and STK query endpoints over HTTP/1.1
+keep-alive, each taking ``latency`` seconds, and counts token requests,
+STK pushes and queries and TCP connections, so callers can check that
+tokens and connections are reused. Pushes to REJECTED_PHONE fail the way
+Daraja rejects a bad request; queries answer from ``results``.
+"""
+import base64
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+
+REJECTED_PHONE = '254700000000'
+TOKEN_SECONDS = 3599
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.daraja.counters['connections'] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        daraja = self.server.daraja
+        if not self.path.startswith('/oauth/v1/generate'):
+            return self._reply(404, {'errorMessage': 'Not found'})
+        expected = base64.b64encode(f"{daraja.consumer_key}:{daraja.consumer_secret}".encode()).decode()
+        if self.headers.get('Authorization') != f'Basic {expected}':
+            return self._reply(400, {'errorMessage': 'Invalid credentials'})
+        time.sleep(daraja.latency)
+        daraja.counters['tokens'] += 1
+        token = f"token-{daraja.counters['tokens']}"
+        daraja.tokens.add(token)
+        self._reply(200, {'access_token': token, 'expires_in': str(daraja.token_seconds)})
+
+    def do_POST(self):
+        daraja = self.server.daraja
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path not in ('/mpesa/stkpush/v1/processrequest', '/mpesa/stkpushquery/v1/query'):
+            return self._reply(404, {'errorMessage': 'Not found'})
+        token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+        if token not in daraja.tokens:
+            return self._reply(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+
+        time.sleep(daraja.latency)
+        if self.path == '/mpesa/stkpushquery/v1/query':
+            daraja.counters['stk_queries'] += 1
+            result = daraja.results.get(payload.get('CheckoutRequestID'))
+            if result is None:
+                return self._reply(500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'})
+            return self._reply(200, {
+                'ResponseCode': '0', 'CheckoutRequestID': payload['CheckoutRequestID'],
+                'ResultCode': str(result[0]), 'ResultDesc': result[1],
+            })
+
+        daraja.counters['stk_pushes'] += 1
+        daraja.pushes.append(payload)
+        if payload.get('PhoneNumber') == REJECTED_PHONE:
+            return self._reply(400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid PhoneNumber'})
+        number = next(daraja.ids)
+        self._reply(200, {
+            'MerchantRequestID': f'merchant-{number}',
+            'CheckoutRequestID': f'ws_CO_{number:08d}',
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        })
+
+
+class FakeDaraja:
+    def __init__(self, latency=0.0, consumer_key='key', consumer_secret='secret', token_seconds=TOKEN_SECONDS):
+        self.latency = latency
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.token_seconds = token_seconds
+        self.counters = Counter()
+        self.tokens = set()
+        self.pushes = []
+        # CheckoutRequestID -> (ResultCode, ResultDesc) answered by STK queries.
+        self.results = {}
+        self.ids = count(1)
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.daraja = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/'
+
+    def expire_tokens(self):
+        self.tokens.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-daraja', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -18,6 +18,18 @@ class WaterSourceForm(forms.ModelForm):
         for field in self.fields:
             self.fields[field].widget.attrs.update({'class': 'form-control', 'placeholder': field.title()})
 
+    def clean_latitude(self):
+        latitude = self.cleaned_data.get('latitude')
+        if latitude is not None and not -90 <= latitude <= 90:
+            raise ValidationError("Latitude must be between -90 and 90.")
+        return latitude
+
+    def clean_longitude(self):
+        longitude = self.cleaned_data.get('longitude')
+        if longitude is not None and not -180 <= longitude <= 180:
+            raise ValidationError("Longitude must be between -180 and 180.")
+        return longitude
+
 class AdminWaterSourceForm(WaterSourceForm):
     """Special form for Admins that allows verifying sources."""
     class Meta(WaterSourceForm.Meta):
@@ -28,6 +40,16 @@ class AdminWaterSourceForm(WaterSourceForm):
         if 'is_verified' in self.fields:
             self.fields['is_verified'].widget.attrs.update({'class': 'form-check-input'})
 
+class SourceImportForm(forms.Form):
+    """Admin upload of a water source survey file."""
+    file = forms.FileField(help_text="A .csv or .xlsx file")
+
+    def clean_file(self):
+        upload = self.cleaned_data['file']
+        if not upload.name.lower().endswith(('.csv', '.xlsx')):
+            raise ValidationError("Only .csv and .xlsx files can be imported.")
+        return upload
+
 class IssueReportForm(forms.ModelForm):
     """Form for residents to report an issue."""
     class Meta:
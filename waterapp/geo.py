@@ -0,0 +1,149 @@
+"""
+Spatial helpers for the map.
+
+Coordinates are stored as an integer geohash (a Z-order / Morton key): the
+latitude and longitude are each quantized to GEOKEY_BITS bits and their bits
+are interleaved. Every geohash "cell" at a given level is then a contiguous
+integer range, so a bounding box becomes a handful of ``BETWEEN`` lookups on
+an ordinary B-tree index (works the same on SQLite and PostgreSQL).
+"""
+import math
+
+import numpy as np
+
+GEOKEY_BITS = 26
+EARTH_RADIUS_KM = 6371.0088
+
+_SCALE = 1 << GEOKEY_BITS
+
+
+def _quantize(value, low, span):
+    index = int((value - low) / span * _SCALE)
+    return min(max(index, 0), _SCALE - 1)
+
+
+def _spread(v):
+    """Insert a zero bit between each of the low 32 bits of v."""
+    v &= 0xFFFFFFFF
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+def _interleave(lat_index, lon_index):
+    return (_spread(lon_index) << 1) | _spread(lat_index)
+
+
+def encode(latitude, longitude):
+    """
+    Returns the geokey for a coordinate pair, or None if either is missing.
+    """
+    if latitude is None or longitude is None:
+        return None
+    lat_index = _quantize(float(latitude), -90.0, 180.0)
+    lon_index = _quantize(float(longitude), -180.0, 360.0)
+    return _interleave(lat_index, lon_index)
+
+
+def cell_of(geokey, level):
+    """The id of the cell containing geokey at the given level (0..GEOKEY_BITS)."""
+    return geokey >> (2 * (GEOKEY_BITS - level))
+
+
+def cell_range(cell, level):
+    """The half-open geokey range [low, high) covered by a cell."""
+    shift = 2 * (GEOKEY_BITS - level)
+    return cell << shift, (cell + 1) << shift
+
+
+def _cells_per_axis(south, west, north, east, level):
+    cells = 1 << level
+    lat_lo = min(int((south + 90.0) / 180.0 * cells), cells - 1)
+    lat_hi = min(int((north + 90.0) / 180.0 * cells), cells - 1)
+    lon_lo = min(int((west + 180.0) / 360.0 * cells), cells - 1)
+    lon_hi = min(int((east + 180.0) / 360.0 * cells), cells - 1)
+    return max(lat_lo, 0), max(lat_hi, 0), max(lon_lo, 0), max(lon_hi, 0)
+
+
+def covering_cells(south, west, north, east, max_cells=32):
+    """
+    Picks the finest level at which the box is covered by at most max_cells
+    cells and returns (level, [cell ids]).
+
+    The box must not cross the antimeridian; see ``cover_bbox``.
+    """
+    level = GEOKEY_BITS
+    while level > 0:
+        lat_lo, lat_hi, lon_lo, lon_hi = _cells_per_axis(south, west, north, east, level)
+        if (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) <= max_cells:
+            break
+        level -= 1
+    lat_lo, lat_hi, lon_lo, lon_hi = _cells_per_axis(south, west, north, east, level)
+    cells = [
+        _interleave(i, j)
+        for i in range(lat_lo, lat_hi + 1)
+        for j in range(lon_lo, lon_hi + 1)
+    ]
+    return level, sorted(cells)
+
+
+def cover_bbox(south, west, north, east, max_cells=32):
+    """
+    Returns a short list of half-open geokey ranges that together cover the
+    bounding box. Adjacent cells are merged into a single range.
+    """
+    if west > east:
+        return (cover_bbox(south, west, north, 180.0, max_cells)
+                + cover_bbox(south, -180.0, north, east, max_cells))
+
+    level, cells = covering_cells(south, west, north, east, max_cells)
+    ranges = []
+    for cell in cells:
+        low, high = cell_range(cell, level)
+        if ranges and ranges[-1][1] == low:
+            ranges[-1] = (ranges[-1][0], high)
+        else:
+            ranges.append((low, high))
+    return ranges
+
+
+def bbox_around(latitude, longitude, radius_km):
+    """The (south, west, north, east) box enclosing a circle on the sphere."""
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    south = max(latitude - lat_delta, -90.0)
+    north = min(latitude + lat_delta, 90.0)
+    if south == -90.0 or north == 90.0:
+        return south, -180.0, north, 180.0
+
+    lon_delta = math.degrees(radius_km / (EARTH_RADIUS_KM * math.cos(math.radians(latitude))))
+    if lon_delta >= 180.0:
+        return south, -180.0, north, 180.0
+    west = longitude - lon_delta
+    east = longitude + lon_delta
+    if west < -180.0:
+        west += 360.0
+    if east > 180.0:
+        east -= 360.0
+    return south, west, north, east
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in kilometres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def haversine_km_many(latitude, longitude, latitudes, longitudes):
+    """Distances in km from one point to arrays of points, vectorized."""
+    phi1 = math.radians(latitude)
+    phi2 = np.radians(np.asarray(latitudes, dtype=float))
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(np.asarray(longitudes, dtype=float) - longitude)
+    a = np.sin(d_phi / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
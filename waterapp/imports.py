@@ -0,0 +1,300 @@
+"""
+Bulk import of water source inventories (CSV or XLSX).
+
+Files are read row by row (openpyxl in read-only mode for XLSX), validated
+in batches with WaterSourceForm, and written with ``bulk_create`` /
+``bulk_update``, one transaction per batch. A row within DEDUPE_METERS of
+a source already in the database updates that source; one within
+DEDUPE_METERS of an earlier row of the same file is reported as a
+duplicate. Bulk writes skip ``save()`` and the signals, so the map
+clusters, search index, status history and cache versions are refreshed
+explicitly.
+
+The whole file is read once before the first batch is written, so a file
+that turns out to be unreadable halfway (bad encoding, a corrupt
+workbook) raises ImportFileError without leaving part of it imported.
+"""
+import csv
+import io
+import math
+import time
+import zipfile
+from collections import defaultdict
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import transaction
+from django.utils import timezone
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+
+from . import geo
+from .caching import bump_version
+from .forms import WaterSourceForm
+from .map_data import rebuild_clusters, within_bbox
+from .models import WaterSource
+from .search import index_many
+from .status_log import record_status_changes
+
+BATCH_SIZE = 1000
+DEDUPE_METERS = 25
+METERS_PER_DEGREE = 111_320
+
+HEADER_ALIASES = {
+    'lat': 'latitude',
+    'lng': 'longitude',
+    'lon': 'longitude',
+    'long': 'longitude',
+    'type': 'source_type',
+    'source': 'name',
+    'source_name': 'name',
+}
+REQUIRED_COLUMNS = {'name', 'source_type', 'latitude', 'longitude'}
+UPDATED_FIELDS = ['name', 'source_type', 'status', 'description', 'last_updated']
+
+
+class ImportFileError(ValueError):
+    """Raised for a file that cannot be read (bad type, header or content)."""
+
+
+@dataclass
+class ImportResult:
+    rows: int = 0
+    created: int = 0
+    updated: int = 0
+    # (row number, message) for every row that was not written.
+    problems: list = field(default_factory=list)
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def write_report(self, stream):
+        writer = csv.writer(stream)
+        writer.writerow(['row', 'problem'])
+        writer.writerows(self.problems)
+
+
+def _header(name):
+    name = str(name or '').strip().lower().replace(' ', '_')
+    return HEADER_ALIASES.get(name, name)
+
+
+def _headers(names):
+    headers = [_header(name) for name in names]
+    missing = REQUIRED_COLUMNS.difference(headers)
+    if missing:
+        raise ImportFileError(f"Missing column(s): {', '.join(sorted(missing))}.")
+    return headers
+
+
+def _xlsx_rows(file):
+    try:
+        workbook = load_workbook(file, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError, OSError) as e:
+        raise ImportFileError(f"Not a readable .xlsx workbook ({e}).")
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        headers = _headers(next(rows, ()))
+        for number, values in enumerate(rows, start=2):
+            if any(value not in (None, '') for value in values):
+                yield number, dict(zip(headers, values))
+    finally:
+        workbook.close()
+
+
+def _csv_rows(file):
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='') if isinstance(file.read(0), bytes) else file
+    reader = csv.reader(text)
+    try:
+        headers = _headers(next(reader, ()))
+        for number, values in enumerate(reader, start=2):
+            if any(value.strip() for value in values):
+                yield number, dict(zip(headers, values))
+    except UnicodeDecodeError:
+        raise ImportFileError("The file is not UTF-8 text; save it as UTF-8 CSV.")
+    except csv.Error as e:
+        raise ImportFileError(f"Row {reader.line_num} is not valid CSV ({e}).")
+    finally:
+        if text is not file:
+            # Leave the caller's file open.
+            text.detach()
+
+
+def read_rows(file, filename):
+    """
+    Yields (row number, {column: value}) from a CSV or XLSX file object,
+    where row 1 is the header.
+    """
+    if filename.lower().endswith('.xlsx'):
+        return _xlsx_rows(file)
+    if filename.lower().endswith('.csv'):
+        return _csv_rows(file)
+    raise ImportFileError("Only .csv and .xlsx files can be imported.")
+
+
+def check_readable(file, filename):
+    """Reads the whole file, raising ImportFileError if it cannot be, and rewinds it."""
+    for _ in read_rows(file, filename):
+        pass
+    file.seek(0)
+
+
+def _choice(value, choices):
+    """Accepts a choice code or its label ('BH' or 'Borehole')."""
+    value = str(value).strip()
+    for code, label in choices:
+        if value.lower() in (code.lower(), label.lower()):
+            return code
+    return value
+
+
+def _coordinate(value):
+    # Survey GPS exports often carry more decimals than the column stores.
+    try:
+        return str(Decimal(str(value).strip()).quantize(Decimal('0.000001')))
+    except InvalidOperation:
+        return value
+
+
+def form_data(raw):
+    """Maps a file row onto WaterSourceForm's fields."""
+    data = {
+        'name': str(raw.get('name') or '').strip(),
+        'source_type': _choice(raw.get('source_type') or '', WaterSource.SOURCE_TYPES),
+        'status': _choice(raw.get('status') or 'O', WaterSource.STATUS_CHOICES),
+        'description': str(raw.get('description') or '').strip(),
+    }
+    for name in ('latitude', 'longitude'):
+        value = raw.get(name)
+        data[name] = '' if value in (None, '') else _coordinate(value)
+    return data
+
+
+class PointGrid:
+    """
+    Points bucketed into square cells about ``meters`` wide, so finding one
+    within ``meters`` of a location only looks at the neighbouring cells.
+    """
+
+    def __init__(self, meters=DEDUPE_METERS):
+        self.meters = meters
+        self.step = meters / METERS_PER_DEGREE
+        self.cells = defaultdict(list)
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.step), math.floor(lon / self.step)
+
+    def add(self, lat, lon, payload):
+        self.cells[self._cell(lat, lon)].append((lat, lon, payload))
+
+    def find(self, lat, lon):
+        """The payload of a point within ``meters``, or None."""
+        row, col = self._cell(lat, lon)
+        # A degree of longitude shrinks towards the poles.
+        span = math.ceil(1 / max(math.cos(math.radians(lat)), 0.01))
+        for d_row in (-1, 0, 1):
+            for d_col in range(-span, span + 1):
+                for other_lat, other_lon, payload in self.cells.get((row + d_row, col + d_col), ()):
+                    if geo.haversine_km(lat, lon, other_lat, other_lon) * 1000 <= self.meters:
+                        return payload
+        return None
+
+
+class SourceImporter:
+    def __init__(self, user=None, batch_size=BATCH_SIZE, dedupe_meters=DEDUPE_METERS):
+        self.user = user
+        self.batch_size = batch_size
+        self.grid = PointGrid(dedupe_meters)
+        self.known_ids = set()
+        self.result = ImportResult()
+
+    def run(self, rows):
+        start = time.perf_counter()
+        rows = iter(rows)
+        while batch := list(islice(rows, self.batch_size)):
+            self.result.rows += len(batch)
+            self._import_batch(batch)
+        self.result.problems.sort()
+        if self.result.created or self.result.updated:
+            rebuild_clusters()
+            bump_version('dashboard', 'sources')
+        self.result.seconds = time.perf_counter() - start
+        return self.result
+
+    def _validate(self, batch):
+        valid = []
+        for number, raw in batch:
+            form = WaterSourceForm(data=form_data(raw))
+            if form.is_valid():
+                valid.append((number, form.cleaned_data))
+            else:
+                message = '; '.join(f"{name}: {' '.join(errors)}" for name, errors in form.errors.items())
+                self.result.problems.append((number, message))
+        return valid
+
+    def _load_existing(self, valid):
+        """Adds the stored sources around this batch to the grid."""
+        lats = [float(data['latitude']) for _, data in valid]
+        lons = [float(data['longitude']) for _, data in valid]
+        lat_pad = self.grid.step
+        lon_pad = lat_pad / max(math.cos(math.radians(max(map(abs, lats)))), 0.01)
+        existing = within_bbox(
+            WaterSource.objects.all(),
+            max(min(lats) - lat_pad, -90.0), max(min(lons) - lon_pad, -180.0),
+            min(max(lats) + lat_pad, 90.0), min(max(lons) + lon_pad, 180.0),
+        )
+        for pk, lat, lon in existing.values_list('pk', 'latitude', 'longitude'):
+            if pk not in self.known_ids:
+                self.known_ids.add(pk)
+                self.grid.add(float(lat), float(lon), ('existing', pk))
+
+    def _import_batch(self, batch):
+        valid = self._validate(batch)
+        if not valid:
+            return
+        self._load_existing(valid)
+
+        creates, updates, updated_by = [], {}, {}
+        for number, data in valid:
+            lat, lon = float(data['latitude']), float(data['longitude'])
+            match = self.grid.find(lat, lon)
+            if match is None:
+                source = WaterSource(**data, created_by=self.user, geokey=geo.encode(data['latitude'], data['longitude']))
+                creates.append(source)
+                self.grid.add(lat, lon, ('row', number))
+            elif match[0] == 'row':
+                self.result.problems.append((number, f"Duplicate of row {match[1]} (within {self.grid.meters} m)."))
+            elif match[1] in updated_by:
+                self.result.problems.append((number, f"Duplicate of row {updated_by[match[1]]} (within {self.grid.meters} m)."))
+            else:
+                updates[match[1]] = data
+                updated_by[match[1]] = number
+
+        with transaction.atomic():
+            WaterSource.objects.bulk_create(creates)
+            changed = list(WaterSource.objects.filter(pk__in=updates)) if updates else []
+            now = timezone.now()
+            previous_status = {source.pk: source.status for source in changed}
+            for source in changed:
+                for name in UPDATED_FIELDS[:-1]:
+                    setattr(source, name, updates[source.pk][name])
+                source.last_updated = now
+            WaterSource.objects.bulk_update(changed, UPDATED_FIELDS)
+            index_many('source', creates + changed)
+            record_status_changes(
+                [(source, None) for source in creates] + [(source, previous_status[source.pk]) for source in changed]
+            )
+        # Already in the grid as rows of this file.
+        self.known_ids.update(source.pk for source in creates)
+
+        self.result.created += len(creates)
+        self.result.updated += len(changed)
+
+
+def import_sources(file, filename, user=None, batch_size=BATCH_SIZE, dedupe_meters=DEDUPE_METERS):
+    """Imports a seekable CSV/XLSX file object; returns an ImportResult."""
+    check_readable(file, filename)
+    return SourceImporter(user, batch_size, dedupe_meters).run(read_rows(file, filename))
@@ -0,0 +1,117 @@
+"""
+Denormalized open-issue counters.
+
+WaterSource carries its number of unresolved issues in total and per
+priority, plus the highest open priority, so the list, detail page, map
+and dashboard read them instead of aggregating IssueReport. Issue saves and
+deletes move the counters with one atomic F() UPDATE in the same
+transaction as the issue row; ``reconcile`` finds and fixes any drift.
+"""
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import GreaterThan
+from django.utils import timezone
+
+from .models import IssueReport, WaterSource
+
+PRIORITY_FIELDS = {1: 'open_low_count', 2: 'open_medium_count', 3: 'open_high_count'}
+
+
+def _max_priority(counts):
+    """CASE picking the highest priority whose (new) count is positive."""
+    return Case(
+        *[When(GreaterThan(counts[priority], 0), then=Value(priority)) for priority in sorted(counts, reverse=True)],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def adjust_open_issues(source_id, deltas):
+    """Applies {priority: delta} to a source's counters in one UPDATE."""
+    deltas = {priority: delta for priority, delta in deltas.items() if delta}
+    if source_id is None or not deltas:
+        return
+    counts = {
+        priority: F(field) + deltas[priority] if priority in deltas else F(field)
+        for priority, field in PRIORITY_FIELDS.items()
+    }
+    WaterSource.objects.filter(pk=source_id).update(
+        open_issue_count=F('open_issue_count') + sum(deltas.values()),
+        max_open_priority=_max_priority(counts),
+        # Counters show on the map, so delta-sync clients must see the change.
+        last_updated=timezone.now(),
+        **{PRIORITY_FIELDS[priority]: counts[priority] for priority in deltas},
+    )
+
+
+def clear_open_issues(source_id):
+    """Zeroes the counters of a source whose open issues were all resolved."""
+    WaterSource.objects.filter(pk=source_id).update(
+        open_issue_count=0, max_open_priority=0, **dict.fromkeys(PRIORITY_FIELDS.values(), 0)
+    )
+
+
+def _open_key(values):
+    if not values or values['is_resolved'] or values['water_source_id'] is None:
+        return None
+    return values['water_source_id'], values['priority_level']
+
+
+def issue_changed(previous, current):
+    """
+    Moves an issue's contribution from ``previous`` to ``current`` values
+    (dicts of IssueReport.TRACKED_FIELDS; None when created or deleted).
+    """
+    before, after = _open_key(previous), _open_key(current)
+    if before == after:
+        return
+    if before and after and before[0] == after[0]:
+        adjust_open_issues(before[0], {before[1]: -1, after[1]: 1})
+        return
+    if before:
+        adjust_open_issues(before[0], {before[1]: -1})
+    if after:
+        adjust_open_issues(after[0], {after[1]: 1})
+
+
+def actual_counts():
+    """{counter field: expression} recounting a source's open issues from IssueReport."""
+    issues = IssueReport.objects.filter(water_source=OuterRef('pk'), is_resolved=False).order_by().values('water_source')
+
+    def count(queryset):
+        return Coalesce(Subquery(queryset.annotate(n=Count('pk')).values('n')), 0)
+
+    counts = {priority: count(issues.filter(priority_level=priority)) for priority in PRIORITY_FIELDS}
+    expressions = {PRIORITY_FIELDS[priority]: counts[priority] for priority in PRIORITY_FIELDS}
+    expressions['open_issue_count'] = count(issues)
+    expressions['max_open_priority'] = _max_priority(counts)
+    return expressions
+
+
+def drifted_sources(sources=None):
+    """Sources whose stored counters differ from a recount, annotated with ``actual_<field>``."""
+    sources = WaterSource.objects.all() if sources is None else sources
+    expressions = actual_counts()
+    drifted = sources.annotate(**{f'actual_{field}': expression for field, expression in expressions.items()})
+    condition = Q()
+    for field in expressions:
+        condition |= ~Q(**{f'actual_{field}': F(field)})
+    return drifted.filter(condition)
+
+
+def reconcile(fix=True):
+    """
+    Recounts every source and, with ``fix``, rewrites the drifted ones.
+    Returns the list of drifted source ids.
+    """
+    drifted = list(drifted_sources().values_list('pk', flat=True))
+    if fix and drifted:
+        for start in range(0, len(drifted), 500):
+            WaterSource.objects.filter(pk__in=drifted[start:start + 500]).update(**actual_counts())
+    return drifted
+
+
+def recompute_open_issue_counts(sources=None):
+    """Rewrites the counters from the issues table in one UPDATE; returns the row count."""
+    sources = WaterSource.objects.all() if sources is None else sources
+    return sources.update(**actual_counts())
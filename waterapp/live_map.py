@@ -0,0 +1,264 @@
+"""
+Live map updates as Server-Sent Events (``/api/map-data/stream/``).
+
+Changes reach the stream through the append-only status logs:
+WaterSourceStatusEvent (source status changes) and VendorStatusEvent
+(vendors opening and closing). Each worker process runs one
+``LiveMapBroker`` that polls both logs every POLL_SECONDS, or straight away
+when a change commits in the same process, and fans new events out to its
+subscribers. Reading the logs rather than passing events in memory is what
+gets a change made on one worker to clients connected to another.
+
+A subscriber is a queue of at most QUEUE_SIZE events, so an idle connection
+costs one queue and one pending ``get`` and a process can hold thousands. A
+client too slow to keep its queue from filling is disconnected rather than
+buffered without bound; the browser reconnects with ``Last-Event-ID`` and
+the missed events are replayed from the logs (past REPLAY_LIMIT it is told
+to reload the map instead).
+
+Event ids are '<source event id>-<vendor event id>' cursors. Ids are
+assigned before commit, so a transaction can commit an id lower than one
+already read; the broker re-reads the last LATE_COMMIT_SECONDS of each log
+to pick those up.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import VendorStatusEvent, WaterSource, WaterSourceStatusEvent
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 1.0
+HEARTBEAT_SECONDS = 15
+QUEUE_SIZE = 100
+REPLAY_LIMIT = 500
+POLL_LIMIT = 1000
+LATE_COMMIT_SECONDS = 5
+RETRY_MILLISECONDS = 3000
+
+
+@dataclass(frozen=True)
+class Event:
+    kind: str  # 'source' or 'vendor'
+    id: int
+    at: datetime
+    data: dict
+
+    def encode(self, cursor):
+        return f"event: {self.kind}\nid: {cursor}\ndata: {json.dumps(self.data)}\n\n"
+
+
+@dataclass(frozen=True)
+class Cursor:
+    source: int = 0
+    vendor: int = 0
+
+    @classmethod
+    def parse(cls, value):
+        """The cursor in a Last-Event-ID, or None if it is not one."""
+        try:
+            source, vendor = (int(part) for part in value.split('-'))
+        except (AttributeError, ValueError):
+            return None
+        return cls(source, vendor) if source >= 0 and vendor >= 0 else None
+
+    def __str__(self):
+        return f"{self.source}-{self.vendor}"
+
+    def after(self, event):
+        if event.kind == 'source':
+            return Cursor(max(self.source, event.id), self.vendor)
+        return Cursor(self.source, max(self.vendor, event.id))
+
+
+def fetch_events(cursor, limit=POLL_LIMIT):
+    """
+    Up to ``limit`` events of each log after ``cursor``, oldest first, and
+    whether either log had more.
+    """
+    labels = dict(WaterSource.STATUS_CHOICES)
+    sources = list(
+        WaterSourceStatusEvent.objects.filter(pk__gt=cursor.source).order_by('pk')
+        .values_list('pk', 'at', 'source_id', 'status')[:limit]
+    )
+    vendors = list(
+        VendorStatusEvent.objects.filter(pk__gt=cursor.vendor).order_by('pk')
+        .values_list('pk', 'at', 'vendor_id', 'is_open')[:limit]
+    )
+    events = [
+        Event('source', pk, at, {
+            'id': source_id,
+            'status': labels.get(status, status),
+            'color': WaterSource.STATUS_COLORS.get(status, 'secondary'),
+        })
+        for pk, at, source_id, status in sources
+    ] + [
+        Event('vendor', pk, at, {'id': vendor_id, 'open': is_open})
+        for pk, at, vendor_id, is_open in vendors
+    ]
+    events.sort(key=lambda event: (event.at, event.kind, event.id))
+    return events, len(sources) == limit or len(vendors) == limit
+
+
+def latest_cursor(before=None):
+    """The cursor after the newest events (those older than ``before``, if given)."""
+    def last_id(log):
+        events = log.objects.all() if before is None else log.objects.filter(at__lt=before)
+        return events.order_by('-pk').values_list('pk', flat=True).first() or 0
+    return Cursor(last_id(WaterSourceStatusEvent), last_id(VendorStatusEvent))
+
+
+class Subscriber:
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+
+class LiveMapBroker:
+    """
+    Fans events from the status logs out to the subscribers of one process.
+    The polling task runs on the event loop of the first subscriber and stops
+    when the last one leaves.
+    """
+
+    def __init__(self, poll_seconds=POLL_SECONDS, queue_size=QUEUE_SIZE):
+        self.poll_seconds = poll_seconds
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._loop = None
+        self._task = None
+        self._wake = None
+        self._watermark = None
+        # (kind, id) of events read above the watermark, so re-reads are not re-sent.
+        self._recent = set()
+
+    def subscribe(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Subscribers of another (finished) loop went with it.
+            self._loop, self._subscribers, self._task = loop, set(), None
+            self._wake = asyncio.Event()
+        subscriber = Subscriber(self.queue_size)
+        self._subscribers.add(subscriber)
+        if self._task is None or self._task.done():
+            # Not the request's context: the task outlives the request.
+            self._task = loop.create_task(self._run(), context=contextvars.Context())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+        if not self._subscribers and self._wake is not None:
+            self._wake.set()
+
+    def notify(self):
+        """Polls now rather than at the next tick. Safe to call from any thread."""
+        loop, wake = self._loop, self._wake
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wake.set)
+
+    def publish(self, events):
+        for event in events:
+            for subscriber in list(self._subscribers):
+                try:
+                    subscriber.queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    subscriber.overflowed = True
+                    self._subscribers.discard(subscriber)
+
+    def poll(self):
+        """New events since the last poll (sync; runs in a thread)."""
+        settled = timezone.now() - timedelta(seconds=LATE_COMMIT_SECONDS)
+        if self._watermark is None:
+            self._watermark, self._recent = latest_cursor(before=settled), set()
+        events, _ = fetch_events(self._watermark)
+        new = [event for event in events if (event.kind, event.id) not in self._recent]
+        self._recent.update((event.kind, event.id) for event in new)
+
+        # Events older than LATE_COMMIT_SECONDS are taken as final: move the
+        # watermark over them, up to the first one that is not.
+        watermark = {'source': self._watermark.source, 'vendor': self._watermark.vendor}
+        blocked = set()
+        for event in sorted(events, key=lambda event: event.id):
+            if event.kind in blocked:
+                continue
+            if event.at < settled:
+                watermark[event.kind] = event.id
+            else:
+                blocked.add(event.kind)
+        self._watermark = Cursor(**watermark)
+        self._recent = {(kind, pk) for kind, pk in self._recent if pk > watermark[kind]}
+        return new
+
+    async def _run(self):
+        self._watermark = None
+        while self._subscribers:
+            self._wake.clear()
+            try:
+                self.publish(await sync_to_async(self.poll)())
+            except Exception:
+                logger.exception("Live map poll failed")
+                await sync_to_async(close_old_connections)()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def aclose(self):
+        """Stops the polling task (tests, shutdown)."""
+        self._subscribers.clear()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+broker = LiveMapBroker()
+
+
+async def stream(last_event_id=None, broker=broker):
+    """
+    The event stream for one client: a replay from ``last_event_id`` when
+    resuming, then live events, with a heartbeat comment when idle.
+    """
+    subscriber = broker.subscribe()
+    try:
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        cursor = Cursor.parse(last_event_id) if last_event_id else None
+        replayed = set()
+        if cursor is not None:
+            events, truncated = await sync_to_async(fetch_events)(cursor, REPLAY_LIMIT)
+            if truncated:
+                cursor = None
+            else:
+                replayed = {(event.kind, event.id) for event in events}
+                for event in events:
+                    cursor = cursor.after(event)
+                    yield event.encode(cursor)
+        if cursor is None:
+            cursor = await sync_to_async(latest_cursor)()
+            # 'reset' tells a resuming client it missed too much and should reload the map.
+            yield f"event: {'reset' if last_event_id else 'ready'}\nid: {cursor}\ndata: {{}}\n\n"
+
+        while not subscriber.overflowed:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if (event.kind, event.id) in replayed:
+                continue
+            cursor = cursor.after(event)
+            yield event.encode(cursor)
+    finally:
+        broker.unsubscribe(subscriber)
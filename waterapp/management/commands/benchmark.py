@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from waterapp.benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    help = "Runs a performance scenario against seeded data that is rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument(
+            '--sizes', default='1000,10000,50000',
+            help="Comma-separated data sizes to measure at (default: 1000,10000,50000)."
+        )
+        parser.add_argument('--repeat', type=int, default=5, help="Samples per measurement.")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        SCENARIOS[options['scenario']](self.stdout, sizes, options['repeat'])
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from waterapp.clicks import RAW_CLICK_RETENTION_DAYS, compact_click_logs
+
+
+class Command(BaseCommand):
+    help = "Prunes raw vendor click logs that are already counted in the daily rollup."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep-days', type=int, default=RAW_CLICK_RETENTION_DAYS,
+            help=f"Whole days of raw clicks to keep (default: {RAW_CLICK_RETENTION_DAYS})."
+        )
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help="Recompute the daily rollup for the kept days from the raw logs first."
+        )
+
+    def handle(self, *args, **options):
+        rebuilt, deleted = compact_click_logs(options['keep_days'], options['rebuild'])
+        if options['rebuild']:
+            self.stdout.write(f"Rebuilt {rebuilt} daily click buckets.")
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} raw click logs."))
@@ -0,0 +1,46 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from waterapp.imports import BATCH_SIZE, DEDUPE_METERS, ImportFileError, import_sources
+
+
+class Command(BaseCommand):
+    help = "Imports water sources from a CSV or XLSX survey file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="A .csv or .xlsx file with name, source_type, latitude, longitude columns.")
+        parser.add_argument('--user', help="Username recorded as the creator of new sources.")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            '--dedupe-meters', type=float, default=DEDUPE_METERS,
+            help=f"Rows this close to an existing source update it instead (default: {DEDUPE_METERS})."
+        )
+        parser.add_argument('--report', help="Write every rejected row and the reason to this CSV file.")
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"No user named '{options['user']}'.")
+
+        try:
+            with open(options['path'], 'rb') as file:
+                result = import_sources(
+                    file, options['path'], user, options['batch_size'], options['dedupe_meters']
+                )
+        except (OSError, ImportFileError) as e:
+            raise CommandError(str(e))
+
+        if options['report']:
+            with open(options['report'], 'w', newline='') as report:
+                result.write_report(report)
+        for number, problem in result.problems[:20]:
+            self.stdout.write(f"Row {number}: {problem}")
+        if len(result.problems) > 20:
+            self.stdout.write(f"... and {len(result.problems) - 20} more.")
+        self.stdout.write(self.style.SUCCESS(
+            f"{result.rows} rows in {result.seconds:.1f}s ({result.rows_per_second:.0f} rows/s): "
+            f"{result.created} created, {result.updated} updated, {len(result.problems)} rejected."
+        ))
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from waterapp.payment_callbacks import BATCH_SIZE, process_callbacks, sweep_pending_payments
+
+
+class Command(BaseCommand):
+    help = "Applies received M-Pesa callbacks to their payments, then queries payments whose callback is overdue."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Callbacks applied per query.")
+        parser.add_argument('--no-sweep', action='store_true', help="Skip the STK query for overdue payments.")
+        parser.add_argument(
+            '--loop', action='store_true',
+            help="Keep running, polling for new callbacks every --interval seconds."
+        )
+        parser.add_argument('--interval', type=float, default=2.0)
+        parser.add_argument(
+            '--sweep-interval', type=float, default=60.0, help="Seconds between sweeps when looping."
+        )
+
+    def handle(self, *args, **options):
+        next_sweep = 0.0
+        while True:
+            counts = process_callbacks(options['batch_size'])
+            if any(counts.values()) or not options['loop']:
+                self.stdout.write(self.style.SUCCESS(
+                    f"Applied {counts['applied']} callbacks ({counts['duplicate']} duplicate, "
+                    f"{counts['orphan']} orphaned, {counts['invalid']} invalid, {counts['waiting']} waiting)."
+                ))
+            if not options['no_sweep'] and time.monotonic() >= next_sweep:
+                swept = sweep_pending_payments()
+                next_sweep = time.monotonic() + options['sweep_interval']
+                if any(swept.values()) or not options['loop']:
+                    self.stdout.write(self.style.SUCCESS(
+                        f"Swept overdue payments: {swept['settled']} settled, {swept['expired']} expired, "
+                        f"{swept['pending']} still pending."
+                    ))
+            if not options['loop']:
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from waterapp.map_data import TOMBSTONE_RETENTION, prune_tombstones
+
+
+class Command(BaseCommand):
+    help = "Deletes map tombstones older than the delta-sync retention window."
+
+    def handle(self, *args, **options):
+        deleted = prune_tombstones()
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted} tombstones older than {TOMBSTONE_RETENTION.days} days."
+        ))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from waterapp.map_data import rebuild_clusters
+
+
+class Command(BaseCommand):
+    help = "Recomputes the pre-aggregated map clusters from the water sources table."
+
+    def handle(self, *args, **options):
+        cells = rebuild_clusters()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {cells} map cluster cells."))
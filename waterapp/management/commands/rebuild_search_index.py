@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from waterapp.search import INDEXED_FIELDS, rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the trigram search index for water sources and vendors."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=sorted(INDEXED_FIELDS), help="Only rebuild one kind of object.")
+
+    def handle(self, *args, **options):
+        indexed = rebuild_index([options['kind']] if options['kind'] else None)
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} objects."))
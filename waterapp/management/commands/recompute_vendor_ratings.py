@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from waterapp.ratings import recompute_ratings
+
+
+class Command(BaseCommand):
+    help = "Recomputes every vendor's denormalized review count and rating sum."
+
+    def handle(self, *args, **options):
+        updated = recompute_ratings()
+        self.stdout.write(self.style.SUCCESS(f"Recomputed ratings for {updated} vendors."))
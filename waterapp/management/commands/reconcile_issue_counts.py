@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from waterapp.caching import refresh_versions
+from waterapp.issue_counts import reconcile
+
+
+class Command(BaseCommand):
+    help = "Recounts every water source's open issues and fixes counters that have drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help="Only report drifted sources; change nothing.")
+
+    def handle(self, *args, **options):
+        drifted = reconcile(fix=not options['check'])
+        if options['check']:
+            ids = ', '.join(str(pk) for pk in drifted[:20]) + (' ...' if len(drifted) > 20 else '')
+            message = f"{len(drifted)} sources have drifted counters" + (f": {ids}" if drifted else ".")
+            self.stdout.write(self.style.WARNING(message) if drifted else self.style.SUCCESS(message))
+            return
+        if drifted:
+            refresh_versions('sources', 'map', 'dashboard')
+        self.stdout.write(self.style.SUCCESS(f"Fixed open issue counters on {len(drifted)} sources."))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from waterapp.analytics import refresh_analytics
+
+
+class Command(BaseCommand):
+    help = "Materializes the per-source and per-type daily analytics rollups (run nightly or more often)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', help="First day (YYYY-MM-DD) to re-roll; default resumes from the last run."
+        )
+        parser.add_argument('--until', help="Last day (YYYY-MM-DD) to roll up; default today.")
+
+    def handle(self, *args, **options):
+        days = {}
+        for key in ('since', 'until'):
+            if options[key]:
+                try:
+                    days[key] = parse_date(options[key])
+                except ValueError:
+                    days[key] = None
+                if days[key] is None:
+                    raise CommandError(f"--{key} must be a date in YYYY-MM-DD format.")
+        rolled = refresh_analytics(**days)
+        if rolled is None:
+            self.stdout.write("No issue or repair history to roll up yet.")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Rolled up analytics for {rolled[0]} to {rolled[1]}."))
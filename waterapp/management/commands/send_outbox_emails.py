@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from waterapp.outbox import process_outbox
+
+
+class Command(BaseCommand):
+    help = "Delivers queued notification emails from the outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help="Emails sent per SMTP connection.")
+        parser.add_argument('--workers', type=int, default=4, help="Batches sent in parallel.")
+        parser.add_argument(
+            '--loop', action='store_true',
+            help="Keep running, polling for new emails every --interval seconds."
+        )
+        parser.add_argument('--interval', type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        while True:
+            counts = process_outbox(options['batch_size'], options['workers'])
+            if any(counts.values()) or not options['loop']:
+                self.stdout.write(self.style.SUCCESS(
+                    f"Sent {counts['sent']} emails ({counts['retry']} to retry, {counts['failed']} failed)."
+                ))
+            if not options['loop']:
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,443 @@
+"""
+Builds the JSON payload behind the Leaflet map (``/api/map-data/``).
+"""
+import gzip
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from . import geo
+from .caching import aget_version, bump_version, get_version
+from .models import MapCluster, MapTombstone, WaterSource, WaterVendor
+
+MAX_RADIUS_KM = 500
+
+# Zoom levels at which the map receives clusters instead of single sources.
+# A cluster cell is roughly a quarter of a 256px map tile wide. The map page
+# opens at zoom 13, past the last clustered level, so it starts on sources.
+CLUSTER_MIN_ZOOM = 3
+CLUSTER_MAX_ZOOM = 12
+CLUSTER_LEVEL_OFFSET = 2
+CLUSTER_LEVELS = range(CLUSTER_MIN_ZOOM + CLUSTER_LEVEL_OFFSET, CLUSTER_MAX_ZOOM + CLUSTER_LEVEL_OFFSET + 1)
+
+# Cells per query when fetching the sources of single-source cells.
+SINGLE_CELLS_PER_QUERY = 200
+
+# Pre-serialized payloads are cached per data version; a version bump makes
+# old entries unreachable, the timeout only bounds how long they linger.
+PAYLOAD_CACHE_TIMEOUT = 60 * 60
+
+# Delta sync: changes are re-sent for a short overlap before the cursor so a
+# row saved just before a sync but committed just after is never missed.
+# Cursors older than the tombstone retention get a full reload instead.
+SYNC_OVERLAP = timedelta(seconds=5)
+TOMBSTONE_RETENTION = timedelta(days=30)
+
+CLUSTER_STATUS_FIELDS = {
+    'O': 'operational',
+    'M': 'maintenance',
+    'B': 'broken',
+    'C': 'contaminated',
+}
+
+
+class MapQueryError(ValueError):
+    """Raised when the map-data query string cannot be understood."""
+
+
+def parse_viewport(params):
+    """
+    Reads an optional viewport from the query string.
+
+    Supports ``?bbox=west,south,east,north`` (Leaflet's ``toBBoxString()``) and
+    ``?lat=&lon=&radius=`` (radius in km). Returns None when neither is given,
+    otherwise a dict with a ``bbox`` tuple (south, west, north, east) and, for
+    radius queries, the ``center`` and ``radius``.
+    """
+    if params.get('bbox'):
+        try:
+            west, south, east, north = [float(part) for part in params['bbox'].split(',')]
+        except ValueError:
+            raise MapQueryError("bbox must be 'west,south,east,north'.")
+        if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+            raise MapQueryError("bbox is outside the valid coordinate range.")
+        return {'bbox': (south, west, north, east)}
+
+    if params.get('lat') or params.get('lon') or params.get('radius'):
+        try:
+            lat = float(params['lat'])
+            lon = float(params['lon'])
+            radius = float(params.get('radius', 5))
+        except (KeyError, ValueError):
+            raise MapQueryError("lat, lon and radius must be numbers.")
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180) or not 0 < radius <= MAX_RADIUS_KM:
+            raise MapQueryError(f"lat/lon must be valid and radius between 0 and {MAX_RADIUS_KM} km.")
+        return {
+            'bbox': geo.bbox_around(lat, lon, radius),
+            'center': (lat, lon),
+            'radius': radius,
+        }
+
+    return None
+
+
+def parse_zoom(params):
+    """Reads the optional ``?zoom=`` Leaflet zoom level."""
+    if not params.get('zoom'):
+        return None
+    try:
+        zoom = int(params['zoom'])
+    except ValueError:
+        raise MapQueryError("zoom must be an integer.")
+    if not 0 <= zoom <= 22:
+        raise MapQueryError("zoom must be between 0 and 22.")
+    return zoom
+
+
+def within_bbox(queryset, south, west, north, east):
+    """
+    Restricts a queryset of a model with ``geokey``/``latitude``/``longitude``
+    to a bounding box. The geokey ranges let the database use its index; the
+    coordinate filter trims the cells' overhang.
+    """
+    cells = Q()
+    for low, high in geo.cover_bbox(south, west, north, east):
+        cells |= Q(geokey__gte=low, geokey__lt=high)
+
+    if west <= east:
+        longitude = Q(longitude__gte=west, longitude__lte=east)
+    else:
+        longitude = Q(longitude__gte=west) | Q(longitude__lte=east)
+
+    return queryset.filter(cells, longitude, latitude__gte=south, latitude__lte=north)
+
+
+def _in_radius(point, viewport):
+    if 'center' not in viewport:
+        return True
+    lat, lon = viewport['center']
+    return geo.haversine_km(lat, lon, point['lat'], point['lon']) <= viewport['radius']
+
+
+def serialize_sources(sources):
+    status_labels = dict(WaterSource.STATUS_CHOICES)
+    points = []
+    rows = sources.values_list('pk', 'name', 'latitude', 'longitude', 'status', 'open_issue_count', 'max_open_priority')
+    for pk, name, lat, lon, status, open_issues, priority in rows:
+        points.append({
+            'type': 'source',
+            'id': pk,
+            'name': name,
+            'lat': float(lat),
+            'lon': float(lon),
+            'status': status_labels.get(status, status),
+            'color': WaterSource.STATUS_COLORS.get(status, 'secondary'),
+            'open_issues': open_issues,
+            'priority': priority,
+        })
+    return points
+
+
+def serialize_vendors(vendors):
+    points = []
+    for v in vendors.only('pk', 'business_name', 'latitude', 'longitude', 'price_per_20l', 'phone_number'):
+        points.append({
+            'type': 'vendor',
+            'id': v.pk,
+            'name': v.business_name,
+            'lat': float(v.latitude),
+            'lon': float(v.longitude),
+            'status': f"Selling @ KES {v.price_per_20l}/20L",
+            'phone': v.whatsapp_number,
+            'color': 'info'
+        })
+    return points
+
+
+def visible_vendors():
+    return WaterVendor.objects.filter(
+        is_open=True,
+        is_verified=True
+    ).exclude(latitude__isnull=True).exclude(longitude__isnull=True)
+
+
+def source_points(viewport=None):
+    sources = WaterSource.objects.all()
+    if viewport:
+        sources = within_bbox(sources, *viewport['bbox'])
+    return serialize_sources(sources)
+
+
+def vendor_points(viewport=None):
+    vendors = visible_vendors()
+    if viewport:
+        vendors = within_bbox(vendors, *viewport['bbox'])
+    return serialize_vendors(vendors)
+
+
+def encode_cursor(moment):
+    return str(int(moment.timestamp() * 1_000_000))
+
+
+def decode_cursor(cursor):
+    try:
+        return datetime.fromtimestamp(int(cursor) / 1_000_000, tz=dt_timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise MapQueryError("since must be a cursor returned by a previous sync.")
+
+
+def changes_since(cursor=None):
+    """
+    Everything an offline map copy needs to catch up since ``cursor``.
+
+    Returns ``upserted`` points (sources changed since then and vendors that
+    changed while on the map), ``removed`` points (from the tombstone log),
+    and the ``cursor`` for the next call. Without a cursor, or with one older
+    than the tombstone retention, ``full`` is set and every point is sent.
+    """
+    now = timezone.now()
+    since = decode_cursor(cursor) if cursor else None
+    full = since is None or since < now - TOMBSTONE_RETENTION
+
+    sources = WaterSource.objects.all()
+    vendors = visible_vendors()
+    removed = []
+    if not full:
+        since = since - SYNC_OVERLAP
+        sources = sources.filter(last_updated__gte=since)
+        vendors = vendors.filter(last_updated__gte=since)
+        tombstones = MapTombstone.objects.filter(removed_at__gte=since).values_list('kind', 'object_id')
+        removed = [{'type': kind, 'id': object_id} for kind, object_id in tombstones.distinct()]
+
+    upserted = serialize_sources(sources) + serialize_vendors(vendors)
+    # A vendor can close and reopen within one window; its current state wins.
+    present = {(p['type'], p['id']) for p in upserted}
+    removed = [r for r in removed if (r['type'], r['id']) not in present]
+
+    return {
+        'cursor': encode_cursor(now),
+        'full': full,
+        'upserted': upserted,
+        'removed': removed,
+    }
+
+
+def record_removal(kind, object_id):
+    MapTombstone.objects.create(kind=kind, object_id=object_id)
+
+
+def prune_tombstones():
+    """Deletes tombstones no client can still need; returns how many."""
+    deleted, _ = MapTombstone.objects.filter(removed_at__lt=timezone.now() - TOMBSTONE_RETENTION).delete()
+    return deleted
+
+
+def cluster_level(zoom):
+    zoom = max(zoom, CLUSTER_MIN_ZOOM)
+    return zoom + CLUSTER_LEVEL_OFFSET
+
+
+def source_clusters(zoom, viewport=None):
+    level = cluster_level(zoom)
+    clusters = MapCluster.objects.filter(level=level, count__gt=0)
+    if viewport:
+        shift = 2 * (geo.GEOKEY_BITS - level)
+        cells = Q()
+        for low, high in geo.cover_bbox(*viewport['bbox']):
+            cells |= Q(cell__gte=low >> shift, cell__lte=(high - 1) >> shift)
+        clusters = clusters.filter(cells)
+
+    status_labels = dict(WaterSource.STATUS_CHOICES)
+    points, single_cells = [], []
+    for cluster in clusters:
+        if cluster.count == 1:
+            single_cells.append(cluster.cell)
+            continue
+        points.append({
+            'type': 'cluster',
+            'id': f"{cluster.level}:{cluster.cell}",
+            'lat': cluster.lat_sum / cluster.count,
+            'lon': cluster.lon_sum / cluster.count,
+            'count': cluster.count,
+            'statuses': {
+                status_labels[code]: getattr(cluster, field)
+                for code, field in CLUSTER_STATUS_FIELDS.items()
+                if getattr(cluster, field)
+            },
+        })
+    return points + single_cell_sources(level, single_cells)
+
+
+def single_cell_sources(level, cells):
+    """
+    The sources of cells holding just one, as ordinary source points: a
+    cluster of one would hide its status and popup for nothing.
+    """
+    points = []
+    for start in range(0, len(cells), SINGLE_CELLS_PER_QUERY):
+        ranges = Q()
+        for cell in cells[start:start + SINGLE_CELLS_PER_QUERY]:
+            low, high = geo.cell_range(cell, level)
+            ranges |= Q(geokey__gte=low, geokey__lt=high)
+        points += serialize_sources(WaterSource.objects.filter(ranges))
+    return points
+
+
+def build_map_payload(viewport=None, zoom=None):
+    """
+    Returns the list of sources and open, verified vendors for the map.
+
+    Up to CLUSTER_MAX_ZOOM, sources are replaced by the pre-aggregated grid
+    cells of MapCluster (except in cells holding a single source); vendors
+    are always returned individually.
+    """
+    if zoom is not None and zoom <= CLUSTER_MAX_ZOOM:
+        points = source_clusters(zoom, viewport) + vendor_points(viewport)
+    else:
+        points = source_points(viewport) + vendor_points(viewport)
+    if viewport:
+        points = [p for p in points if p['type'] == 'cluster' or _in_radius(p, viewport)]
+    return points
+
+
+def _query_digest(viewport, zoom):
+    return hashlib.sha1(repr((viewport, zoom)).encode()).hexdigest()[:16]
+
+
+def map_payload_etag(viewport=None, zoom=None):
+    """
+    The entity tag for a map query: the current ``'map'`` data version (bumped
+    by the WaterSource/WaterVendor signals on every change) plus a digest of
+    the query. Cheap enough to check before any payload is loaded.
+    """
+    return f"{get_version('map')}-{_query_digest(viewport, zoom)}"
+
+
+async def amap_payload_etag(viewport=None, zoom=None):
+    return f"{await aget_version('map')}-{_query_digest(viewport, zoom)}"
+
+
+def _payload_key(etag, compressed):
+    return f"map-data:{etag}:{'gzip' if compressed else 'json'}"
+
+
+def _build_payload(etag, viewport, zoom, compressed):
+    body = json.dumps(build_map_payload(viewport, zoom), cls=DjangoJSONEncoder).encode()
+    gzipped = gzip.compress(body, compresslevel=6)
+    cache.set_many({
+        _payload_key(etag, False): body,
+        _payload_key(etag, True): gzipped,
+    }, PAYLOAD_CACHE_TIMEOUT)
+    return gzipped if compressed else body
+
+
+def cached_map_payload(etag, viewport=None, zoom=None, compressed=False):
+    """
+    Returns the serialized JSON for a map query, or its gzip copy when
+    ``compressed`` is set.
+
+    Both encodings are built together and cached under the ETag, each in its
+    own entry so a request only ever loads the one it will send.
+    """
+    cached = cache.get(_payload_key(etag, compressed))
+    if cached is not None:
+        return cached
+    return _build_payload(etag, viewport, zoom, compressed)
+
+
+async def acached_map_payload(etag, viewport=None, zoom=None, compressed=False):
+    """
+    ``cached_map_payload`` for async views. Only a miss (once per data
+    version and query) leaves the event loop, to build the payload in a
+    worker thread.
+    """
+    cached = await cache.aget(_payload_key(etag, compressed))
+    if cached is not None:
+        return cached
+    return await sync_to_async(_build_payload)(etag, viewport, zoom, compressed)
+
+
+def _cluster_cells(values):
+    geokey = geo.encode(values['latitude'], values['longitude'])
+    return [(level, geo.cell_of(geokey, level)) for level in CLUSTER_LEVELS]
+
+
+def _adjust_clusters(values, sign):
+    lat = float(values['latitude'])
+    lon = float(values['longitude'])
+    status_field = CLUSTER_STATUS_FIELDS[values['status']]
+
+    for level, cell in _cluster_cells(values):
+        changes = {
+            'count': F('count') + sign,
+            'lat_sum': F('lat_sum') + sign * lat,
+            'lon_sum': F('lon_sum') + sign * lon,
+            status_field: F(status_field) + sign,
+        }
+        if MapCluster.objects.filter(level=level, cell=cell).update(**changes) or sign < 0:
+            continue
+        try:
+            with transaction.atomic():
+                MapCluster.objects.create(
+                    level=level, cell=cell, count=1, lat_sum=lat, lon_sum=lon, **{status_field: 1}
+                )
+        except IntegrityError:
+            # Created concurrently by another save; add to it instead.
+            MapCluster.objects.filter(level=level, cell=cell).update(**changes)
+
+
+def update_clusters(previous, current):
+    """
+    Moves one source's contribution between grid cells. Either side may be
+    None (source created or deleted). Only the cells involved are touched.
+    """
+    if previous == current:
+        return
+    with transaction.atomic():
+        if previous:
+            _adjust_clusters(previous, -1)
+        if current:
+            _adjust_clusters(current, +1)
+
+
+def aggregate_clusters(rows):
+    """
+    Folds (latitude, longitude, status) rows into MapCluster field dicts for
+    every cluster level. Used by rebuilds and data migrations.
+    """
+    cells = {}
+    for lat, lon, status in rows:
+        values = {'latitude': lat, 'longitude': lon, 'status': status}
+        status_field = CLUSTER_STATUS_FIELDS[status]
+        for level, cell in _cluster_cells(values):
+            cluster = cells.get((level, cell))
+            if cluster is None:
+                cluster = cells[(level, cell)] = {
+                    'level': level, 'cell': cell, 'count': 0, 'lat_sum': 0.0, 'lon_sum': 0.0,
+                    **{field: 0 for field in CLUSTER_STATUS_FIELDS.values()},
+                }
+            cluster['count'] += 1
+            cluster['lat_sum'] += float(lat)
+            cluster['lon_sum'] += float(lon)
+            cluster[status_field] += 1
+    return cells.values()
+
+
+def rebuild_clusters():
+    """
+    Recomputes the whole MapCluster table from WaterSource and retires the
+    cached map payloads built from the old one.
+    """
+    rows = WaterSource.objects.values_list('latitude', 'longitude', 'status').iterator(chunk_size=2000)
+    clusters = [MapCluster(**fields) for fields in aggregate_clusters(rows)]
+    with transaction.atomic():
+        MapCluster.objects.all().delete()
+        MapCluster.objects.bulk_create(clusters, batch_size=1000)
+        bump_version('map')
+    return len(clusters)
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.8 on 2026-10-17 03:59
+
+from django.db import migrations, models
+
+from waterapp import geo
+
+
+def backfill_geokeys(apps, schema_editor):
+    for model_name in ('WaterSource', 'WaterVendor'):
+        model = apps.get_model('waterapp', model_name)
+        rows = list(model.objects.only('pk', 'latitude', 'longitude'))
+        for row in rows:
+            row.geokey = geo.encode(row.latitude, row.longitude)
+        model.objects.bulk_update(rows, ['geokey'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0012_issuereport_vendor_alter_issuereport_water_source'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watersource',
+            name='geokey',
+            field=models.BigIntegerField(blank=True, db_index=True, editable=False, help_text='Integer geohash of the coordinates, kept in sync on save', null=True),
+        ),
+        migrations.AddField(
+            model_name='watervendor',
+            name='geokey',
+            field=models.BigIntegerField(blank=True, db_index=True, editable=False, help_text='Integer geohash of the coordinates, kept in sync on save', null=True),
+        ),
+        migrations.RunPython(backfill_geokeys, migrations.RunPython.noop),
+    ]
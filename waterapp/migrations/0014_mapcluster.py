@@ -0,0 +1,43 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:01
+
+from django.db import migrations, models
+
+from waterapp.map_data import aggregate_clusters
+
+
+def build_clusters(apps, schema_editor):
+    WaterSource = apps.get_model('waterapp', 'WaterSource')
+    MapCluster = apps.get_model('waterapp', 'MapCluster')
+    rows = WaterSource.objects.values_list('latitude', 'longitude', 'status')
+    MapCluster.objects.bulk_create(
+        [MapCluster(**fields) for fields in aggregate_clusters(rows)], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0013_geokey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapCluster',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveSmallIntegerField()),
+                ('cell', models.BigIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('lat_sum', models.FloatField(default=0)),
+                ('lon_sum', models.FloatField(default=0)),
+                ('operational', models.IntegerField(default=0)),
+                ('maintenance', models.IntegerField(default=0)),
+                ('broken', models.IntegerField(default=0)),
+                ('contaminated', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('level', 'cell')},
+            },
+        ),
+        migrations.RunPython(build_clusters, migrations.RunPython.noop),
+    ]
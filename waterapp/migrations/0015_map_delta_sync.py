@@ -0,0 +1,35 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0014_mapcluster'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('source', 'Water Source'), ('vendor', 'Water Vendor')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('removed_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'ordering': ['removed_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='watervendor',
+            name='last_updated',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='watersource',
+            name='last_updated',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+def backfill_daily_stats(apps, schema_editor):
+    VendorClickLog = apps.get_model('waterapp', 'VendorClickLog')
+    VendorDailyStats = apps.get_model('waterapp', 'VendorDailyStats')
+    rows = (
+        VendorClickLog.objects.annotate(date=TruncDate('timestamp'))
+        .values('vendor_id', 'date')
+        .annotate(clicks=Count('pk'))
+        .order_by()
+    )
+    VendorDailyStats.objects.bulk_create(
+        [VendorDailyStats(vendor_id=r['vendor_id'], date=r['date'], clicks=r['clicks']) for r in rows],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0015_map_delta_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VendorDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('clicks', models.PositiveIntegerField(default=0)),
+                ('vendor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='waterapp.watervendor')),
+            ],
+            options={
+                'verbose_name_plural': 'Vendor daily stats',
+                'ordering': ['date'],
+                'unique_together': {('vendor', 'date')},
+            },
+        ),
+        migrations.RunPython(backfill_daily_stats, migrations.RunPython.noop),
+    ]
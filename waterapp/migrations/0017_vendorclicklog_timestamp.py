@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:11
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0016_vendordailystats'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vendorclicklog',
+            name='timestamp',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+    ]
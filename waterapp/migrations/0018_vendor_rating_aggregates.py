@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:13
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_ratings(apps, schema_editor):
+    WaterVendor = apps.get_model('waterapp', 'WaterVendor')
+    VendorReview = apps.get_model('waterapp', 'VendorReview')
+    reviews = VendorReview.objects.filter(vendor=OuterRef('pk')).order_by().values('vendor')
+    WaterVendor.objects.update(
+        rating_count=Coalesce(Subquery(reviews.annotate(n=Count('pk')).values('n')), 0),
+        rating_sum=Coalesce(Subquery(reviews.annotate(total=Sum('rating')).values('total')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0017_vendorclicklog_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watervendor',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of reviews, kept in sync by signals'),
+        ),
+        migrations.AddField(
+            model_name='watervendor',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Sum of review ratings, kept in sync by signals'),
+        ),
+        migrations.RunPython(backfill_ratings, migrations.RunPython.noop),
+    ]
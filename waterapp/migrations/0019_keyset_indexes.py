@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:15
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0018_vendor_rating_aggregates'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='issuereport',
+            index=models.Index(fields=['reporter', '-reported_at', '-id'], name='issue_reporter_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vendorreview',
+            index=models.Index(fields=['vendor', '-created_at', '-id'], name='review_vendor_keyset_idx'),
+        ),
+    ]
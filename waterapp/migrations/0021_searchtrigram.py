@@ -0,0 +1,45 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:26
+
+from django.db import migrations, models
+
+from waterapp.search import INDEXED_FIELDS, document_trigrams
+
+
+def build_index(apps, schema_editor):
+    SearchTrigram = apps.get_model('waterapp', 'SearchTrigram')
+    for kind, (model, fields) in INDEXED_FIELDS.items():
+        Model = apps.get_model('waterapp', model.__name__)
+        names = [name for name, _ in fields]
+        SearchTrigram.objects.bulk_create(
+            [
+                SearchTrigram(kind=kind, object_id=values['pk'], trigram=gram, weight=weight)
+                for values in Model.objects.values('pk', *names)
+                for gram, weight in document_trigrams(kind, values).items()
+            ],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0020_outboundemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('source', 'Water Source'), ('vendor', 'Water Vendor')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('trigram', models.CharField(max_length=3)),
+                ('weight', models.PositiveSmallIntegerField(default=1)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'trigram'], name='search_trigram_idx')],
+                'unique_together': {('kind', 'object_id', 'trigram')},
+            },
+        ),
+        migrations.RunPython(build_index, migrations.RunPython.noop),
+    ]
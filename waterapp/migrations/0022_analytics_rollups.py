@@ -0,0 +1,76 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:50
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0021_searchtrigram'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('rolled_through', models.DateField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='issuereport',
+            name='resolved_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='issuereport',
+            name='reported_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='SourceTypeDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_type', models.CharField(choices=[('BH', 'Borehole'), ('WL', 'Well'), ('TP', 'Tap'), ('RI', 'River Intake'), ('PP', 'Public Pump')], max_length=2)),
+                ('day', models.DateField()),
+                ('sources', models.PositiveIntegerField(default=0, help_text='Sources with any activity that day')),
+                ('downtime_hours', models.FloatField(default=0)),
+                ('issues_opened', models.PositiveIntegerField(default=0)),
+                ('issues_resolved', models.PositiveIntegerField(default=0)),
+                ('resolution_hours', models.FloatField(default=0)),
+                ('repairs', models.PositiveIntegerField(default=0)),
+                ('repair_cost', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+            ],
+            options={
+                'verbose_name_plural': 'Source type daily stats',
+                'ordering': ['day'],
+                'indexes': [models.Index(fields=['day'], name='type_stats_day_idx')],
+                'unique_together': {('source_type', 'day')},
+            },
+        ),
+        migrations.CreateModel(
+            name='SourceDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_type', models.CharField(choices=[('BH', 'Borehole'), ('WL', 'Well'), ('TP', 'Tap'), ('RI', 'River Intake'), ('PP', 'Public Pump')], max_length=2)),
+                ('day', models.DateField()),
+                ('downtime_hours', models.FloatField(default=0)),
+                ('issues_opened', models.PositiveIntegerField(default=0)),
+                ('issues_resolved', models.PositiveIntegerField(default=0)),
+                ('resolution_hours', models.FloatField(default=0)),
+                ('repairs', models.PositiveIntegerField(default=0)),
+                ('repair_cost', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='waterapp.watersource')),
+            ],
+            options={
+                'verbose_name_plural': 'Source daily stats',
+                'ordering': ['day'],
+                'indexes': [models.Index(fields=['day'], name='source_stats_day_idx')],
+                'unique_together': {('source', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:56
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def record_current_status(apps, schema_editor):
+    # Earlier transitions were never recorded; each source's history starts
+    # with its status as of this migration.
+    WaterSource = apps.get_model('waterapp', 'WaterSource')
+    WaterSourceStatusEvent = apps.get_model('waterapp', 'WaterSourceStatusEvent')
+    now = timezone.now()
+    WaterSourceStatusEvent.objects.bulk_create(
+        (
+            WaterSourceStatusEvent(source_id=pk, status=status, at=now)
+            for pk, status in WaterSource.objects.values_list('pk', 'status').iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0022_analytics_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaterSourceStatusEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('previous_status', models.CharField(blank=True, choices=[('O', 'Operational'), ('M', 'Maintenance'), ('B', 'Broken/Non-Operational'), ('C', 'Contaminated')], max_length=2)),
+                ('status', models.CharField(choices=[('O', 'Operational'), ('M', 'Maintenance'), ('B', 'Broken/Non-Operational'), ('C', 'Contaminated')], max_length=2)),
+                ('at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_events', to='waterapp.watersource')),
+            ],
+            options={
+                'ordering': ['at', 'id'],
+                'indexes': [models.Index(fields=['source', 'at'], name='status_event_source_at_idx'), models.Index(fields=['at'], name='status_event_at_idx')],
+            },
+        ),
+        migrations.RunPython(record_current_status, migrations.RunPython.noop),
+    ]
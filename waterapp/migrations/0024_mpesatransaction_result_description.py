@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-17 05:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0023_watersourcestatusevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='result_description',
+            field=models.CharField(blank=True, help_text='Latest message from M-Pesa', max_length=255),
+        ),
+    ]
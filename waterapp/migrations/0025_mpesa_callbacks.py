@@ -0,0 +1,44 @@
+# Generated by Django 5.2.8 on 2026-10-17 05:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0024_mpesatransaction_result_description'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MpesaCallback',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('outcome', models.CharField(blank=True, choices=[('applied', 'Applied'), ('duplicate', 'Duplicate'), ('orphan', 'No matching payment'), ('invalid', 'Invalid payload')], max_length=10)),
+            ],
+            options={
+                'ordering': ['-received_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='receipt_number',
+            field=models.CharField(blank=True, help_text='M-Pesa receipt of a completed payment', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='transaction_code',
+            field=models.CharField(blank=True, max_length=40, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['status', 'created_at'], name='mpesa_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesacallback',
+            index=models.Index(fields=['processed_at', 'id'], name='mpesa_callback_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.8 on 2026-10-17 05:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+from waterapp.phones import to_e164
+
+
+def normalize_and_link(apps, schema_editor):
+    # Numbers were stored as typed (or as 2547...); rewrite them in E.164 and
+    # link each payment to the account whose username is that number, which
+    # is how transaction history used to find them.
+    MpesaTransaction = apps.get_model('waterapp', 'MpesaTransaction')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    users = {}
+    for pk, username in User.objects.values_list('pk', 'username').iterator():
+        phone = to_e164(username)
+        if phone:
+            users.setdefault(phone, pk)
+
+    batch = []
+    for payment in MpesaTransaction.objects.only('pk', 'phone_number').iterator(chunk_size=2000):
+        phone = to_e164(payment.phone_number) or payment.phone_number
+        payment.phone_number, payment.user_id = phone, users.get(phone)
+        batch.append(payment)
+        if len(batch) == 2000:
+            MpesaTransaction.objects.bulk_update(batch, ['phone_number', 'user'])
+            batch = []
+    MpesaTransaction.objects.bulk_update(batch, ['phone_number', 'user'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0025_mpesa_callbacks'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='user',
+            field=models.ForeignKey(blank=True, help_text='Account that made the payment, if known', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='mpesa_transactions', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='phone_number',
+            field=models.CharField(help_text='E.164, e.g. +254712345678', max_length=16),
+        ),
+        migrations.RunPython(normalize_and_link, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['phone_number', 'created_at'], name='mpesa_phone_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['user', 'created_at'], name='mpesa_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.8 on 2026-10-17 05:17
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_open_issue_counts(apps, schema_editor):
+    WaterSource = apps.get_model('waterapp', 'WaterSource')
+    IssueReport = apps.get_model('waterapp', 'IssueReport')
+    issues = IssueReport.objects.filter(water_source=OuterRef('pk'), is_resolved=False).order_by().values('water_source')
+    WaterSource.objects.update(
+        open_issue_count=Coalesce(Subquery(issues.annotate(n=Count('pk')).values('n')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0026_mpesa_transaction_phone_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watersource',
+            name='open_issue_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Unresolved issues, kept in sync by signals'),
+        ),
+        migrations.RunPython(backfill_open_issue_counts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='watersource',
+            index=models.Index(fields=['name', 'id'], name='source_name_keyset_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.8 on 2026-10-17 05:24
+
+from django.db import migrations, models
+from django.db.models import Case, Count, IntegerField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import GreaterThan
+
+
+def backfill_priority_counters(apps, schema_editor):
+    WaterSource = apps.get_model('waterapp', 'WaterSource')
+    IssueReport = apps.get_model('waterapp', 'IssueReport')
+    issues = IssueReport.objects.filter(water_source=OuterRef('pk'), is_resolved=False).order_by().values('water_source')
+
+    def count(priority):
+        return Coalesce(Subquery(issues.filter(priority_level=priority).annotate(n=Count('pk')).values('n')), 0)
+
+    WaterSource.objects.update(
+        open_low_count=count(1),
+        open_medium_count=count(2),
+        open_high_count=count(3),
+        max_open_priority=Case(
+            *[When(GreaterThan(count(priority), 0), then=Value(priority)) for priority in (3, 2, 1)],
+            default=Value(0), output_field=IntegerField(),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0027_source_open_issue_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watersource',
+            name='max_open_priority',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0, editable=False, help_text='Highest priority among unresolved issues, 0 if none'),
+        ),
+        migrations.AddField(
+            model_name='watersource',
+            name='open_high_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='watersource',
+            name='open_low_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='watersource',
+            name='open_medium_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_priority_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-17 05:56
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0028_source_priority_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VendorStatusEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_open', models.BooleanField()),
+                ('at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('vendor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_events', to='waterapp.watervendor')),
+            ],
+            options={
+                'ordering': ['at', 'id'],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations
+
+from waterapp.map_data import CLUSTER_LEVELS
+
+
+def drop_unused_levels(apps, schema_editor):
+    MapCluster = apps.get_model('waterapp', 'MapCluster')
+    MapCluster.objects.exclude(level__in=list(CLUSTER_LEVELS)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0029_vendor_status_event'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_unused_levels, migrations.RunPython.noop),
+    ]
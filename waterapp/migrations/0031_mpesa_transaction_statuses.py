@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-17 06:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('waterapp', '0030_drop_unused_cluster_levels'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='status',
+            field=models.CharField(choices=[('Queued', 'Queued'), ('Pending (STK Sent)', 'Pending (STK Sent)'), ('Pending', 'Pending'), ('Completed', 'Completed'), ('Cancelled', 'Cancelled'), ('Failed', 'Failed')], default='Pending', max_length=20),
+        ),
+    ]
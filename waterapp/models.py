@@ -1,12 +1,59 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.core.validators import MinValueValidator
 from decimal import Decimal
+from . import geo
+from .phones import to_e164
 
-class WaterSource(models.Model):
+
+def _with_geokey(update_fields):
+    """Makes sure a partial save that moves a point also rewrites its geokey."""
+    if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+        return set(update_fields) | {'geokey'}
+    return update_fields
+
+
+class TrackedFieldsMixin:
+    """
+    Remembers the values of TRACKED_FIELDS as they were loaded from the
+    database, so signal handlers can diff a save against them without an
+    extra SELECT. During post_save the previous values are available as
+    ``instance.previous_values`` (None for newly created rows).
+    """
+    TRACKED_FIELDS = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_loaded_values()
+        return instance
+
+    def _remember_loaded_values(self):
+        if self.get_deferred_fields() & set(self.TRACKED_FIELDS):
+            self._loaded_values = None
+        else:
+            self._loaded_values = {name: getattr(self, name) for name in self.TRACKED_FIELDS}
+
+    def _values_before_save(self):
+        if self._state.adding:
+            return None
+        values = getattr(self, '_loaded_values', None)
+        if values is None:
+            # Built by hand or loaded with deferred fields: fall back to a lookup.
+            values = type(self)._base_manager.filter(pk=self.pk).values(*self.TRACKED_FIELDS).first()
+        return values
+
+    def save(self, *args, **kwargs):
+        self.previous_values = self._values_before_save()
+        super().save(*args, **kwargs)
+        self._remember_loaded_values()
+
+class WaterSource(TrackedFieldsMixin, models.Model):
     """Represents a physical water source."""
 
+    TRACKED_FIELDS = ('latitude', 'longitude', 'status')
+
     SOURCE_TYPES = [
         ('BH', 'Borehole'),
         ('WL', 'Well'),
@@ -22,11 +69,19 @@ class WaterSource(models.Model):
         ('C', 'Contaminated'),  
     ]
 
+    STATUS_COLORS = {
+        'O': 'success',
+        'M': 'warning',
+        'C': 'danger',
+        'B': 'brown-custom',
+    }
+
     name = models.CharField(max_length=100, help_text="E.g., Nairobi Zone A")
     source_type = models.CharField(max_length=2, choices=SOURCE_TYPES)
     
     latitude = models.DecimalField(max_digits=9, decimal_places=6, help_text="Latitude coordinate")
     longitude = models.DecimalField(max_digits=9, decimal_places=6, help_text="Longitude coordinate")
+    geokey = models.BigIntegerField(null=True, blank=True, editable=False, db_index=True, help_text="Integer geohash of the coordinates, kept in sync on save")
     
     status = models.CharField(max_length=2, choices=STATUS_CHOICES, default='O')
     is_verified = models.BooleanField(default=False, help_text="Has this source been verified for water quality?")
@@ -35,48 +90,118 @@ class WaterSource(models.Model):
 
     installation_date = models.DateField(default=timezone.now)
     description = models.TextField(blank=True)
-    last_updated = models.DateTimeField(auto_now=True)
+    last_updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    # Unresolved issues, in total and per priority, kept in sync by signals.
+    open_issue_count = models.PositiveIntegerField(default=0, editable=False, help_text="Unresolved issues, kept in sync by signals")
+    open_low_count = models.PositiveIntegerField(default=0, editable=False)
+    open_medium_count = models.PositiveIntegerField(default=0, editable=False)
+    open_high_count = models.PositiveIntegerField(default=0, editable=False)
+    max_open_priority = models.PositiveSmallIntegerField(
+        default=0, editable=False, db_index=True, help_text="Highest priority among unresolved issues, 0 if none"
+    )
+
+    # Maintained with F() updates; a full save must not write back a stale copy.
+    COUNTER_FIELDS = ('open_issue_count', 'open_low_count', 'open_medium_count', 'open_high_count', 'max_open_priority')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['name', 'id'], name='source_name_keyset_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.geokey = geo.encode(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None and not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        kwargs['update_fields'] = _with_geokey(update_fields)
+        super().save(*args, **kwargs)
+
     @property
     def status_color(self):
         """Helper to return the CSS color class based on status."""
-        if self.status == 'O':
-            return 'success'
-        elif self.status == 'M':
-            return 'warning' 
-        elif self.status == 'C':
-            return 'danger'    
-        elif self.status == 'B':
-            return 'brown-custom' 
-        return 'secondary'
-
-class IssueReport(models.Model):
+        return self.STATUS_COLORS.get(self.status, 'secondary')
+
+    @property
+    def max_open_priority_label(self):
+        return dict(IssueReport.PRIORITY_CHOICES).get(self.max_open_priority, '')
+
+class WaterSourceStatusEvent(models.Model):
+    """
+    Append-only log of WaterSource status changes, one row per transition
+    (and one for the initial status of a new source), written by the
+    post_save signal from the TrackedFieldsMixin snapshot.
+    """
+    source = models.ForeignKey(WaterSource, on_delete=models.CASCADE, related_name='status_events')
+    # Blank for the event recording a new source's initial status.
+    previous_status = models.CharField(max_length=2, choices=WaterSource.STATUS_CHOICES, blank=True)
+    status = models.CharField(max_length=2, choices=WaterSource.STATUS_CHOICES)
+    at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['at', 'id']
+        indexes = [
+            models.Index(fields=['source', 'at'], name='status_event_source_at_idx'),
+            models.Index(fields=['at'], name='status_event_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.source.name}: {self.previous_status or '-'} -> {self.status} at {self.at}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Status events are append-only.")
+        super().save(*args, **kwargs)
+
+class IssueReport(TrackedFieldsMixin, models.Model):
     """Report submitted about a water source OR a vendor's equipment."""
+
+    TRACKED_FIELDS = ('water_source_id', 'is_resolved', 'priority_level')
+    PRIORITY_CHOICES = [(1, 'Low'), (2, 'Medium'), (3, 'High')]
     water_source = models.ForeignKey(WaterSource, on_delete=models.CASCADE, related_name='issues', null=True, blank=True)
     
     vendor = models.ForeignKey('WaterVendor', on_delete=models.CASCADE, related_name='issues', null=True, blank=True)
     
     reporter = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     description = models.TextField()
-    reported_at = models.DateTimeField(auto_now_add=True)
+    reported_at = models.DateTimeField(auto_now_add=True, db_index=True)
     is_resolved = models.BooleanField(default=False)
+    resolved_at = models.DateTimeField(null=True, blank=True, db_index=True, editable=False)
     
     priority_level = models.IntegerField(
         default=1, 
-        choices=[(1, 'Low'), (2, 'Medium'), (3, 'High')],
+        choices=PRIORITY_CHOICES,
         validators=[MinValueValidator(1)]
     )
 
     class Meta:
         ordering = ['-reported_at']
+        indexes = [
+            models.Index(fields=['reporter', '-reported_at', '-id'], name='issue_reporter_keyset_idx'),
+        ]
 
     def __str__(self):
         target = self.water_source.name if self.water_source else self.vendor.business_name
         return f"Issue at {target} - Resolved: {self.is_resolved}"
 
+    def save(self, *args, **kwargs):
+        if not self.is_resolved:
+            self.resolved_at = None
+        elif self.resolved_at is None:
+            self.resolved_at = timezone.now()
+        if kwargs.get('update_fields') is not None and 'is_resolved' in kwargs['update_fields']:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'resolved_at'}
+        # The post_save signal moves the source's open-issue counters; keep
+        # them in the same transaction as the row.
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
 class RepairLog(models.Model):
     """Log of maintenance/repair work done on a water source."""
     water_source = models.ForeignKey(WaterSource, on_delete=models.CASCADE, related_name='repairs')
@@ -98,11 +223,13 @@ class RepairLog(models.Model):
     def __str__(self):
         return f"Repair on {self.water_source.name} on {self.repair_date}"
 
-class WaterVendor(models.Model):
+class WaterVendor(TrackedFieldsMixin, models.Model):
     """
     Represents a commercial water seller (Shop, Truck, or Individual).
     Linked to a User account so they can manage their own orders.
     """
+
+    TRACKED_FIELDS = ('latitude', 'longitude', 'is_open', 'is_verified')
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='vendor_profile')
     business_name = models.CharField(max_length=100)
     phone_number = models.CharField(max_length=15, help_text="Contact number for orders")
@@ -110,6 +237,7 @@ class WaterVendor(models.Model):
     location_name = models.CharField(max_length=100, help_text="e.g., 'Kasarani, Near Naivas'")
     latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
     longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    geokey = models.BigIntegerField(null=True, blank=True, editable=False, db_index=True, help_text="Integer geohash of the coordinates, kept in sync on save")
     
     image = models.ImageField(upload_to='vendor_images/', blank=True, null=True)
     is_open = models.BooleanField(default=True, help_text="Toggle this to show/hide on the map")
@@ -130,19 +258,58 @@ class WaterVendor(models.Model):
         validators=[MinValueValidator(Decimal('0.00'))],
         help_text="Fixed delivery fee (0 for free delivery)"
     )
+    last_updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    rating_count = models.PositiveIntegerField(default=0, editable=False, help_text="Number of reviews, kept in sync by signals")
+    rating_sum = models.PositiveIntegerField(default=0, editable=False, help_text="Sum of review ratings, kept in sync by signals")
 
     def __str__(self):
         status = "Open" if self.is_open else "Closed"
         return f"{self.business_name} ({status})"
 
+    def save(self, *args, **kwargs):
+        self.geokey = geo.encode(self.latitude, self.longitude)
+        kwargs['update_fields'] = _with_geokey(kwargs.get('update_fields'))
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def shows_on_map(values):
+        """Whether a vendor with these TRACKED_FIELDS values appears on the map."""
+        return bool(
+            values['is_open'] and values['is_verified']
+            and values['latitude'] is not None and values['longitude'] is not None
+        )
+
+    @property
+    def average_rating(self):
+        if not self.rating_count:
+            return 0
+        return round(self.rating_sum / self.rating_count, 1)
+
     @property
     def whatsapp_number(self):
-        number = str(self.phone_number).strip().replace('+', '').replace(' ', '').replace('-', '')
-        
-        if number.startswith('0'):
-            return '254' + number[1:]
-        
-        return number
+        """The number as wa.me links take it: E.164 without the '+'."""
+        return to_e164(self.phone_number).removeprefix('+') or str(self.phone_number).strip()
+
+class VendorStatusEvent(models.Model):
+    """
+    Append-only log of vendors opening and closing, one row per ``is_open``
+    toggle, written by the post_save signal. Read by the live map stream.
+    """
+    vendor = models.ForeignKey(WaterVendor, on_delete=models.CASCADE, related_name='status_events')
+    is_open = models.BooleanField()
+    at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ['at', 'id']
+
+    def __str__(self):
+        return f"{self.vendor.business_name}: {'open' if self.is_open else 'closed'} at {self.at}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Status events are append-only.")
+        super().save(*args, **kwargs)
 
 class WaterOrder(models.Model):
     """
@@ -184,13 +351,99 @@ class WaterOrder(models.Model):
 class VendorClickLog(models.Model):
     """Tracks every time a user clicks 'Order Now' on a vendor."""
     vendor = models.ForeignKey(WaterVendor, on_delete=models.CASCADE, related_name='click_logs')
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: buffered clicks are written later with their own time.
+    timestamp = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
 
     def __str__(self):
         return f"Click for {self.vendor.business_name} at {self.timestamp}"
+
+
+class VendorDailyStats(models.Model):
+    """
+    Daily rollup of 'Order Now' clicks per vendor, incremented as clicks
+    arrive so charts never have to count raw VendorClickLog rows.
+    """
+    vendor = models.ForeignKey(WaterVendor, on_delete=models.CASCADE, related_name='daily_stats')
+    date = models.DateField()
+    clicks = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('vendor', 'date')
+        ordering = ['date']
+        verbose_name_plural = "Vendor daily stats"
+
+    def __str__(self):
+        return f"{self.vendor.business_name} on {self.date}: {self.clicks} clicks"
     
-class VendorReview(models.Model):
+class SourceDailyStats(models.Model):
+    """
+    Daily facts for one water source, materialized by
+    ``waterapp.analytics.refresh_analytics`` so reports never scan the issue
+    and repair history. ``source_type`` is copied from the source when the
+    day is rolled up.
+    """
+    source = models.ForeignKey(WaterSource, on_delete=models.CASCADE, related_name='daily_stats')
+    source_type = models.CharField(max_length=2, choices=WaterSource.SOURCE_TYPES)
+    day = models.DateField()
+    downtime_hours = models.FloatField(default=0)
+    issues_opened = models.PositiveIntegerField(default=0)
+    issues_resolved = models.PositiveIntegerField(default=0)
+    # Report-to-resolution hours summed over the issues resolved that day.
+    resolution_hours = models.FloatField(default=0)
+    repairs = models.PositiveIntegerField(default=0)
+    repair_cost = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        unique_together = ('source', 'day')
+        ordering = ['day']
+        indexes = [
+            models.Index(fields=['day'], name='source_stats_day_idx'),
+        ]
+        verbose_name_plural = "Source daily stats"
+
+    def __str__(self):
+        return f"{self.source.name} on {self.day}"
+
+
+class SourceTypeDailyStats(models.Model):
+    """SourceDailyStats summed per source type, for network-wide charts."""
+    source_type = models.CharField(max_length=2, choices=WaterSource.SOURCE_TYPES)
+    day = models.DateField()
+    sources = models.PositiveIntegerField(default=0, help_text="Sources with any activity that day")
+    downtime_hours = models.FloatField(default=0)
+    issues_opened = models.PositiveIntegerField(default=0)
+    issues_resolved = models.PositiveIntegerField(default=0)
+    resolution_hours = models.FloatField(default=0)
+    repairs = models.PositiveIntegerField(default=0)
+    repair_cost = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        unique_together = ('source_type', 'day')
+        ordering = ['day']
+        indexes = [
+            models.Index(fields=['day'], name='type_stats_day_idx'),
+        ]
+        verbose_name_plural = "Source type daily stats"
+
+    def __str__(self):
+        return f"{self.get_source_type_display()} on {self.day}"
+
+
+class RollupWatermark(models.Model):
+    """The last day a rollup job has materialized, so it can resume from there."""
+    name = models.CharField(max_length=50, unique=True)
+    rolled_through = models.DateField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} through {self.rolled_through}"
+
+
+class VendorReview(TrackedFieldsMixin, models.Model):
     """Allows residents to rate and review vendors."""
+
+    TRACKED_FIELDS = ('vendor_id', 'rating')
+
     vendor = models.ForeignKey(WaterVendor, on_delete=models.CASCADE, related_name='reviews')
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     rating = models.IntegerField(choices=[(i, i) for i in range(1, 6)])
@@ -199,17 +452,191 @@ class VendorReview(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['vendor', '-created_at', '-id'], name='review_vendor_keyset_idx'),
+        ]
 
     def __str__(self):
         return f"{self.rating} Stars for {self.vendor.business_name} by {self.author.username}"
     
 class MpesaTransaction(models.Model):
-    transaction_code = models.CharField(max_length=20, unique=True, null=True, blank=True)
-    phone_number = models.CharField(max_length=15)
+    QUEUED = 'Queued'
+    SENT = 'Pending (STK Sent)'
+    # Payments from before pushes were queued.
+    PENDING = 'Pending'
+    COMPLETED = 'Completed'
+    CANCELLED = 'Cancelled'
+    FAILED = 'Failed'
+    STATUSES = [
+        (QUEUED, 'Queued'),
+        (SENT, 'Pending (STK Sent)'),
+        (PENDING, 'Pending'),
+        (COMPLETED, 'Completed'),
+        (CANCELLED, 'Cancelled'),
+        (FAILED, 'Failed'),
+    ]
+
+    transaction_code = models.CharField(max_length=40, unique=True, null=True, blank=True)
+    phone_number = models.CharField(max_length=16, help_text="E.164, e.g. +254712345678")
+    user = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, related_name='mpesa_transactions',
+        help_text="Account that made the payment, if known"
+    )
     amount = models.DecimalField(max_digits=10, decimal_places=2)
-    status = models.CharField(max_length=20, default="Pending")
+    status = models.CharField(max_length=20, choices=STATUSES, default=PENDING)
+    result_description = models.CharField(max_length=255, blank=True, help_text="Latest message from M-Pesa")
+    receipt_number = models.CharField(max_length=20, blank=True, help_text="M-Pesa receipt of a completed payment")
     vendor = models.ForeignKey(WaterVendor, on_delete=models.SET_NULL, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # The sweeper's lookup of payments still waiting for a result.
+            models.Index(fields=['status', 'created_at'], name='mpesa_status_created_idx'),
+            # Linking an account's earlier payments by phone.
+            models.Index(fields=['phone_number', 'created_at'], name='mpesa_phone_created_idx'),
+            # Transaction history, newest first.
+            models.Index(fields=['user', 'created_at'], name='mpesa_user_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.phone_number} - {self.amount} ({self.status})"
+
+
+class MpesaCallback(models.Model):
+    """
+    An STK push result posted by Safaricom, stored as received so the
+    callback view can acknowledge at once. ``process_mpesa_callbacks``
+    applies it to the matching MpesaTransaction.
+    """
+    APPLIED = 'applied'
+    DUPLICATE = 'duplicate'
+    ORPHAN = 'orphan'
+    INVALID = 'invalid'
+    OUTCOMES = [
+        (APPLIED, 'Applied'),
+        (DUPLICATE, 'Duplicate'),
+        (ORPHAN, 'No matching payment'),
+        (INVALID, 'Invalid payload'),
+    ]
+
+    body = models.TextField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    outcome = models.CharField(max_length=10, choices=OUTCOMES, blank=True)
+
+    class Meta:
+        ordering = ['-received_at']
+        indexes = [
+            models.Index(fields=['processed_at', 'id'], name='mpesa_callback_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"Callback #{self.pk} received {self.received_at}"
+
+
+class MapCluster(models.Model):
+    """
+    One cell of the pre-aggregated map grid: how many water sources fall in
+    it, their coordinate sums (for the centroid) and a status breakdown.
+    Maintained incrementally by the WaterSource signals.
+    """
+    level = models.PositiveSmallIntegerField()
+    cell = models.BigIntegerField()
+    count = models.IntegerField(default=0)
+    lat_sum = models.FloatField(default=0)
+    lon_sum = models.FloatField(default=0)
+
+    operational = models.IntegerField(default=0)
+    maintenance = models.IntegerField(default=0)
+    broken = models.IntegerField(default=0)
+    contaminated = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('level', 'cell')
+
+    def __str__(self):
+        return f"Cluster {self.level}:{self.cell} ({self.count} sources)"
+
+
+class MapTombstone(models.Model):
+    """
+    Records a point leaving the map (a deleted source, or a vendor that was
+    deleted, closed or unverified) so delta-sync clients can drop it.
+    """
+    KINDS = [
+        ('source', 'Water Source'),
+        ('vendor', 'Water Vendor'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KINDS)
+    object_id = models.BigIntegerField()
+    removed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['removed_at']
+
+    def __str__(self):
+        return f"{self.get_kind_display()} #{self.object_id} removed at {self.removed_at}"
+
+class OutboundEmail(models.Model):
+    """
+    One queued email to one recipient. Views only insert rows; the
+    ``send_outbox_emails`` worker delivers them, retrying with backoff.
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # When a pending email is next due; pushed forward while a worker holds
+    # it and after each failed attempt.
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {self.recipient} ({self.get_status_display()})"
+
+
+class SearchTrigram(models.Model):
+    """
+    Inverted trigram index for source and vendor search: one row per
+    distinct trigram of an object's searchable text, weighted by the field
+    it came from. Maintained by waterapp.search on save and delete.
+    """
+    KINDS = [
+        ('source', 'Water Source'),
+        ('vendor', 'Water Vendor'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KINDS)
+    object_id = models.BigIntegerField()
+    trigram = models.CharField(max_length=3)
+    weight = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        unique_together = ('kind', 'object_id', 'trigram')
+        indexes = [
+            models.Index(fields=['kind', 'trigram'], name='search_trigram_idx'),
+        ]
+
     def __str__(self):
-        return f"{self.phone_number} - {self.amount} ({self.status})"
\ No newline at end of file
+        return f"{self.kind} #{self.object_id}: '{self.trigram}'"
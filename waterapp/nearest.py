@@ -0,0 +1,132 @@
+"""
+"Where is the closest working water right now?"
+
+Candidates are read through the geokey index (``within_bbox``) from a box
+around the user that doubles in size until the circle inside it holds k
+results, so only nearby rows are fetched however large the tables grow.
+Distances (and vendor costs) for the candidate set are computed in one
+NumPy pass.
+"""
+from decimal import Decimal
+
+import numpy as np
+
+from . import geo
+from .map_data import MAX_RADIUS_KM, MapQueryError, visible_vendors, within_bbox
+from .models import WaterSource
+
+DEFAULT_K = 5
+MAX_K = 50
+START_RADIUS_KM = 2.0
+# Vendors ranked by cost are compared within this distance by default.
+COST_RADIUS_KM = 10.0
+
+SOURCE_FIELDS = ('pk', 'name', 'source_type', 'status')
+VENDOR_FIELDS = ('pk', 'business_name', 'price_per_20l', 'delivery_fee')
+
+
+def parse_nearest_query(params):
+    """Validates ``lat``, ``lon``, ``k``, ``kind``, ``sort``, ``qty`` and ``radius``."""
+    try:
+        lat = float(params['lat'])
+        lon = float(params['lon'])
+        k = int(params.get('k', DEFAULT_K))
+        qty = int(params.get('qty', 1))
+        radius = float(params.get('radius', COST_RADIUS_KM))
+    except (KeyError, ValueError):
+        raise MapQueryError("lat and lon are required; k, qty and radius must be numbers.")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise MapQueryError("lat/lon are outside the valid coordinate range.")
+    if not 1 <= k <= MAX_K or qty < 1 or not 0 < radius <= MAX_RADIUS_KM:
+        raise MapQueryError(f"k must be 1-{MAX_K}, qty at least 1 and radius up to {MAX_RADIUS_KM} km.")
+
+    kind = params.get('kind', 'all')
+    sort = params.get('sort', 'distance')
+    if kind not in ('all', 'source', 'vendor') or sort not in ('distance', 'cost'):
+        raise MapQueryError("kind must be source, vendor or all; sort must be distance or cost.")
+    return {'lat': lat, 'lon': lon, 'k': k, 'kind': kind, 'sort': sort, 'qty': qty, 'radius': radius}
+
+
+def _candidates(queryset, lat, lon, radius, fields):
+    """Rows (lat, lon, *fields) in the box around the circle, and their distances."""
+    rows = list(
+        within_bbox(queryset, *geo.bbox_around(lat, lon, radius))
+        .values_list('latitude', 'longitude', *fields)
+    )
+    if not rows:
+        return rows, np.empty(0)
+    coordinates = np.array([row[:2] for row in rows], dtype=float)
+    return rows, geo.haversine_km_many(lat, lon, coordinates[:, 0], coordinates[:, 1])
+
+
+def k_nearest(queryset, lat, lon, k, fields, max_radius=MAX_RADIUS_KM):
+    """
+    The ``k`` rows of ``queryset`` closest to (lat, lon) within
+    ``max_radius`` km, as (row, distance_km) pairs, nearest first.
+    """
+    radius = START_RADIUS_KM
+    while True:
+        rows, distances = _candidates(queryset, lat, lon, radius, fields)
+        # Only points inside the circle are certain to beat everything not
+        # yet fetched; the box corners may not.
+        inside = np.flatnonzero(distances <= radius)
+        if len(inside) >= k or radius >= max_radius:
+            nearest = inside[np.argsort(distances[inside], kind='stable')][:k]
+            return [(rows[i], float(distances[i])) for i in nearest]
+        radius = min(radius * 2, max_radius)
+
+
+def cheapest_vendors(lat, lon, k, qty, radius):
+    """
+    Open, verified vendors within ``radius`` km, cheapest total for ``qty``
+    jerrycans (price * qty + delivery fee) first, then nearest.
+    """
+    rows, distances = _candidates(visible_vendors(), lat, lon, radius, VENDOR_FIELDS)
+    inside = np.flatnonzero(distances <= radius)
+    if not len(inside):
+        return []
+    costs = np.array([float(rows[i][4]) * qty + float(rows[i][5]) for i in inside])
+    order = inside[np.lexsort((distances[inside], costs))][:k]
+    return [(rows[i], float(distances[i])) for i in order]
+
+
+def _source(row, distance):
+    lat, lon, pk, name, source_type, status = row
+    return {
+        'id': pk,
+        'name': name,
+        'type': dict(WaterSource.SOURCE_TYPES).get(source_type, source_type),
+        'status': dict(WaterSource.STATUS_CHOICES).get(status, status),
+        'lat': float(lat),
+        'lon': float(lon),
+        'distance_km': round(distance, 3),
+    }
+
+
+def _vendor(row, distance, qty):
+    lat, lon, pk, name, price, fee = row
+    return {
+        'id': pk,
+        'name': name,
+        'lat': float(lat),
+        'lon': float(lon),
+        'price_per_20l': float(price),
+        'delivery_fee': float(fee),
+        'total_cost': float(Decimal(price) * qty + Decimal(fee)),
+        'distance_km': round(distance, 3),
+    }
+
+
+def nearest_water(lat, lon, k=DEFAULT_K, kind='all', sort='distance', qty=1, radius=COST_RADIUS_KM):
+    """The JSON payload of the nearest-water API."""
+    payload = {}
+    if kind in ('all', 'source'):
+        operational = WaterSource.objects.filter(status='O')
+        payload['sources'] = [_source(*hit) for hit in k_nearest(operational, lat, lon, k, SOURCE_FIELDS)]
+    if kind in ('all', 'vendor'):
+        if sort == 'cost':
+            hits = cheapest_vendors(lat, lon, k, qty, radius)
+        else:
+            hits = k_nearest(visible_vendors(), lat, lon, k, VENDOR_FIELDS)
+        payload['vendors'] = [_vendor(row, distance, qty) for row, distance in hits]
+    return payload
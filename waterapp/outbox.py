@@ -0,0 +1,154 @@
+"""
+Email outbox.
+
+Views call ``queue_email``, which only inserts OutboundEmail rows (in the
+same transaction as the report that triggered them), so request latency
+never includes SMTP. The ``send_outbox_emails`` worker claims due rows in
+batches and sends each batch over a single SMTP connection from a small
+thread pool. Failed rows are retried with exponential backoff and marked
+failed after ``MAX_ATTEMPTS``.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection as db_connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 6 * 3600
+# How long a claimed batch is hidden from other workers; a worker that dies
+# mid-batch leaves its rows to be picked up again after this.
+CLAIM_LEASE_SECONDS = 300
+
+
+def queue_email(subject, body, recipients, html_body=''):
+    """Queues one email per recipient; returns the created rows."""
+    return OutboundEmail.objects.bulk_create([
+        OutboundEmail(recipient=recipient, subject=subject[:255], body=body, html_body=html_body or '')
+        for recipient in dict.fromkeys(recipients) if recipient
+    ])
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS))
+
+
+def claim_batch(limit):
+    """
+    Claims up to ``limit`` due emails by pushing their ``next_attempt_at``
+    past the lease. Rows locked by another worker are skipped where the
+    database supports it.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        due = (
+            OutboundEmail.objects.select_for_update(skip_locked=db_connection.features.has_select_for_update_skip_locked)
+            .filter(status=OutboundEmail.PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'pk')[:limit]
+        )
+        ids = list(due.values_list('pk', flat=True))
+        if not ids:
+            return []
+        # The status/due filter is repeated so a row another worker claimed
+        # meanwhile (without row locks, e.g. on SQLite) is not taken twice.
+        lease = now + timedelta(seconds=CLAIM_LEASE_SECONDS)
+        OutboundEmail.objects.filter(pk__in=ids, status=OutboundEmail.PENDING, next_attempt_at__lte=now).update(
+            next_attempt_at=lease
+        )
+        return list(OutboundEmail.objects.filter(pk__in=ids, next_attempt_at=lease).order_by('pk'))
+
+
+def _message(email, connection):
+    message = EmailMultiAlternatives(
+        email.subject, email.body, settings.DEFAULT_FROM_EMAIL, [email.recipient], connection=connection
+    )
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def _record_failure(email, error):
+    attempts = email.attempts + 1
+    if attempts >= MAX_ATTEMPTS:
+        changes = {'status': OutboundEmail.FAILED}
+        logger.error("Giving up on email %s to %s: %s", email.pk, email.recipient, error)
+    else:
+        changes = {'next_attempt_at': timezone.now() + retry_delay(attempts)}
+    OutboundEmail.objects.filter(pk=email.pk).update(attempts=attempts, last_error=str(error)[:1000], **changes)
+    return changes.get('status', 'retry')
+
+
+def deliver(batch):
+    """
+    Sends a claimed batch over one connection and records each outcome.
+    Returns a dict of counts: sent, retry, failed.
+    """
+    counts = {'sent': 0, 'retry': 0, 'failed': 0}
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception as e:
+        for email in batch:
+            counts[_record_failure(email, e)] += 1
+        return counts
+
+    sent = []
+    try:
+        for email in batch:
+            try:
+                _message(email, connection).send()
+            except Exception as e:
+                counts[_record_failure(email, e)] += 1
+            else:
+                sent.append(email.pk)
+    finally:
+        connection.close()
+
+    OutboundEmail.objects.filter(pk__in=sent).update(
+        status=OutboundEmail.SENT, sent_at=timezone.now(), attempts=F('attempts') + 1, last_error=''
+    )
+    counts['sent'] = len(sent)
+    return counts
+
+
+def _deliver_in_thread(batch):
+    try:
+        return deliver(batch)
+    finally:
+        db_connection.close()
+
+
+def process_outbox(batch_size=50, workers=4):
+    """
+    Delivers everything currently due: claims up to ``workers`` batches at a
+    time and sends them in parallel, until no due rows remain. With one
+    worker, batches are sent on the calling thread. Returns summed counts.
+    """
+    totals = {'sent': 0, 'retry': 0, 'failed': 0}
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbox') if workers > 1 else None
+    try:
+        while True:
+            batches = []
+            for _ in range(workers):
+                batch = claim_batch(batch_size)
+                if not batch:
+                    break
+                batches.append(batch)
+            if not batches:
+                return totals
+            results = executor.map(_deliver_in_thread, batches) if executor else map(deliver, batches)
+            for counts in results:
+                for key, value in counts.items():
+                    totals[key] += value
+    finally:
+        if executor:
+            executor.shutdown()
@@ -0,0 +1,94 @@
+"""
+Cached fragments and anonymous pages.
+
+Rendered HTML is cached under the version tokens (see ``caching``) of the
+namespaces it was built from: the source list under ``'sources'``, the
+vendor directory under ``'vendors'``, the home page under both plus
+``'dashboard'``. A WaterSource save therefore retires the source list and
+home page but leaves the vendor pages cached, and vice versa.
+
+``cache_anonymous_page`` serves whole pages to anonymous visitors. Anyone
+with a session (a signed-in user, or someone with a flash message waiting)
+gets a freshly rendered page, as does any response that set a cookie, so a
+cached page never carries one visitor's state to another. Every response
+varies on Cookie so shared caches downstream keep the two apart too.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from .caching import get_versions
+
+PAGE_CACHE_TIMEOUT = 3600
+MESSAGES_COOKIE = 'messages'
+
+
+def _digest(value):
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+def fragment_key(name, namespaces, *parts):
+    versions = ':'.join(get_versions(*namespaces)) if namespaces else ''
+    return f"fragment:{name}:{versions}:{_digest(':'.join(map(str, parts)))}"
+
+
+def cached_fragment(name, namespaces, render, *parts, timeout=PAGE_CACHE_TIMEOUT):
+    """
+    ``render()``, cached until ``timeout`` or until any of ``namespaces`` is
+    bumped. ``parts`` tell apart variants of the same fragment (a cursor, a
+    page type).
+    """
+    key = fragment_key(name, namespaces, *parts)
+    value = cache.get(key)
+    if value is None:
+        value = render()
+        cache.set(key, value, timeout)
+    return value
+
+
+def is_cacheable_request(request):
+    """Anonymous GET/HEAD without a session or pending messages."""
+    return (
+        request.method in ('GET', 'HEAD')
+        and settings.SESSION_COOKIE_NAME not in request.COOKIES
+        and MESSAGES_COOKIE not in request.COOKIES
+        and not request.user.is_authenticated
+    )
+
+
+def cache_anonymous_page(*namespaces, timeout=PAGE_CACHE_TIMEOUT):
+    """
+    Caches a view's successful responses for anonymous visitors, keyed by
+    the full path (query string included) and the namespace versions.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if not is_cacheable_request(request):
+                response = view(request, *args, **kwargs)
+                patch_vary_headers(response, ('Cookie',))
+                return response
+            key = fragment_key(f'page:{view.__name__}', namespaces, request.get_full_path())
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+                response['X-Page-Cache'] = 'hit'
+            else:
+                response = view(request, *args, **kwargs)
+                if (
+                    response.status_code == 200
+                    and not response.streaming
+                    and not response.cookies
+                    and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE')
+                ):
+                    cache.set(key, (response.content, response['Content-Type']), timeout)
+                response['X-Page-Cache'] = 'miss'
+            patch_vary_headers(response, ('Cookie',))
+            return response
+        return wrapped
+    return decorator
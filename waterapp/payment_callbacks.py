@@ -0,0 +1,198 @@
+"""
+Reconciling M-Pesa payments with their results.
+
+Safaricom posts each STK push result to ``/api/mpesa/callback/``. The view
+only stores the body as an MpesaCallback row and acknowledges, so a burst
+of callbacks costs one INSERT each. ``process_callbacks`` then applies
+them in batches: one query fetches the payments for a whole batch by
+CheckoutRequestID (``transaction_code``), one ``bulk_update`` writes their
+results and one UPDATE marks the callbacks processed. A batch stays locked
+(``skip_locked``) until then, so concurrent runs take different batches.
+
+Applying a result is idempotent: only payments still waiting for a result
+are changed, so a callback delivered twice (or after the sweeper settled
+the payment) is recorded as a duplicate. A callback can overtake the push
+worker writing its CheckoutRequestID; it is retried on later runs and only
+given up as an orphan after ORPHAN_RETRY_SECONDS.
+
+``sweep_pending_payments`` covers callbacks that never arrive: it asks
+Daraja's STK query endpoint for the result of payments pending longer
+than SWEEP_AFTER_SECONDS and fails pushes that were never sent.
+"""
+import json
+import logging
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import MpesaCallback, MpesaTransaction
+from .payments import (
+    RESULT_STATUSES, STATUS_FAILED, STATUS_QUEUED, STATUS_SENT, get_gateway,
+)
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+MAX_CALLBACK_BYTES = 64 * 1024
+ORPHAN_RETRY_SECONDS = 300
+# Pending payments are queried once a callback is this late.
+SWEEP_AFTER_SECONDS = 120
+SWEEP_LIMIT = 200
+# A payment still queued this long never reached Daraja.
+QUEUED_TIMEOUT_SECONDS = 600
+# Daraja stops answering queries for old pushes; give up on them.
+PENDING_TIMEOUT_SECONDS = 24 * 3600
+
+WAITING_STATUSES = (STATUS_QUEUED, STATUS_SENT)
+
+
+def result_status(result_code):
+    return RESULT_STATUSES.get(result_code, STATUS_FAILED)
+
+
+def parse_callback(body):
+    """
+    (CheckoutRequestID, ResultCode, ResultDesc, receipt number) from a
+    callback body; raises ValueError if it is not an STK callback.
+    """
+    try:
+        callback = json.loads(body)['Body']['stkCallback']
+        checkout_request_id = str(callback['CheckoutRequestID'])
+        result_code = int(callback['ResultCode'])
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError(f"Not an STK callback: {e!r}")
+    items = (callback.get('CallbackMetadata') or {}).get('Item') or []
+    metadata = {item.get('Name'): item.get('Value') for item in items if isinstance(item, dict)}
+    receipt = str(metadata.get('MpesaReceiptNumber') or '')
+    return checkout_request_id, result_code, str(callback.get('ResultDesc', '')), receipt
+
+
+def _apply_batch(callbacks, now):
+    """Applies one batch; returns {callback_id: outcome} for those settled."""
+    outcomes, parsed = {}, {}
+    for callback in callbacks:
+        try:
+            parsed[callback.pk] = parse_callback(callback.body)
+        except ValueError as e:
+            logger.warning("Ignoring M-Pesa callback %s: %s", callback.pk, e)
+            outcomes[callback.pk] = MpesaCallback.INVALID
+
+    codes = {result[0] for result in parsed.values()}
+    payments = MpesaTransaction.objects.in_bulk(codes, field_name='transaction_code')
+    changed = []
+    orphan_before = now - timedelta(seconds=ORPHAN_RETRY_SECONDS)
+    for callback in callbacks:
+        if callback.pk not in parsed:
+            continue
+        code, result_code, description, receipt = parsed[callback.pk]
+        payment = payments.get(code)
+        if payment is None:
+            if callback.received_at < orphan_before:
+                outcomes[callback.pk] = MpesaCallback.ORPHAN
+            continue
+        if payment.status not in WAITING_STATUSES:
+            outcomes[callback.pk] = MpesaCallback.DUPLICATE
+            continue
+        payment.status = result_status(result_code)
+        payment.result_description = description[:255]
+        payment.receipt_number = receipt[:20]
+        changed.append(payment)
+        outcomes[callback.pk] = MpesaCallback.APPLIED
+
+    with transaction.atomic():
+        if changed:
+            # Re-checked under the write so the sweeper settling one of these
+            # meanwhile is not overwritten.
+            still_waiting = set(
+                MpesaTransaction.objects.select_for_update()
+                .filter(pk__in=[payment.pk for payment in changed], status__in=WAITING_STATUSES)
+                .values_list('pk', flat=True)
+            )
+            MpesaTransaction.objects.bulk_update(
+                [payment for payment in changed if payment.pk in still_waiting],
+                ['status', 'result_description', 'receipt_number'],
+                batch_size=BATCH_SIZE,
+            )
+            for callback_id, (code, *_) in parsed.items():
+                payment = payments.get(code)
+                if outcomes.get(callback_id) == MpesaCallback.APPLIED and payment.pk not in still_waiting:
+                    outcomes[callback_id] = MpesaCallback.DUPLICATE
+        by_outcome = {}
+        for callback_id, outcome in outcomes.items():
+            by_outcome.setdefault(outcome, []).append(callback_id)
+        for outcome, ids in by_outcome.items():
+            MpesaCallback.objects.filter(pk__in=ids, processed_at__isnull=True).update(
+                processed_at=now, outcome=outcome
+            )
+    return outcomes
+
+
+def process_callbacks(batch_size=BATCH_SIZE):
+    """
+    Applies every unprocessed callback, oldest first, in batches of
+    ``batch_size``. Returns a count per outcome, plus 'waiting' for
+    callbacks left for a later run.
+    """
+    counts = dict.fromkeys([outcome for outcome, _ in MpesaCallback.OUTCOMES] + ['waiting'], 0)
+    last_id = 0
+    while True:
+        now = timezone.now()
+        # The batch stays locked until its outcomes are written, so a
+        # concurrent run skips these rows rather than applying them again.
+        with transaction.atomic():
+            pending = (
+                MpesaCallback.objects.select_for_update(skip_locked=connection.features.has_select_for_update_skip_locked)
+                .filter(processed_at__isnull=True, pk__gt=last_id)
+                .order_by('pk')[:batch_size]
+            )
+            callbacks = list(pending)
+            if not callbacks:
+                return counts
+            outcomes = _apply_batch(callbacks, now)
+        last_id = callbacks[-1].pk
+        for outcome in outcomes.values():
+            counts[outcome] += 1
+        counts['waiting'] += len(callbacks) - len(outcomes)
+        if len(callbacks) < batch_size:
+            return counts
+
+
+def _settle(payment_id, status, description, receipt=''):
+    return MpesaTransaction.objects.filter(pk=payment_id, status__in=WAITING_STATUSES).update(
+        status=status, result_description=description[:255], receipt_number=receipt,
+    )
+
+
+def sweep_pending_payments(limit=SWEEP_LIMIT):
+    """
+    Settles payments whose callback is overdue: sent pushes are looked up
+    with an STK query, stale queued ones are failed. Returns a count of
+    payments 'settled', 'expired' and still 'pending'.
+    """
+    now = timezone.now()
+    counts = {'settled': 0, 'expired': 0, 'pending': 0}
+    counts['expired'] += MpesaTransaction.objects.filter(
+        status=STATUS_QUEUED, created_at__lt=now - timedelta(seconds=QUEUED_TIMEOUT_SECONDS),
+    ).update(status=STATUS_FAILED, result_description="The payment request was never sent to M-Pesa.")
+    counts['expired'] += MpesaTransaction.objects.filter(
+        status=STATUS_SENT, created_at__lt=now - timedelta(seconds=PENDING_TIMEOUT_SECONDS),
+    ).update(status=STATUS_FAILED, result_description="No result was received from M-Pesa.")
+
+    overdue = (
+        MpesaTransaction.objects.filter(
+            status=STATUS_SENT, created_at__lt=now - timedelta(seconds=SWEEP_AFTER_SECONDS),
+        )
+        .exclude(transaction_code__isnull=True)
+        .order_by('created_at')
+        .values_list('pk', 'transaction_code')[:limit]
+    )
+    gateway = get_gateway()
+    for payment_id, code in overdue:
+        result = gateway.stk_query(code)
+        if result is None:
+            counts['pending'] += 1
+            continue
+        result_code, description = result
+        counts['settled'] += _settle(payment_id, result_status(result_code), description)
+    return counts
@@ -0,0 +1,473 @@
+"""
+M-Pesa (Daraja) payment gateway.
+
+One DarajaGateway per process keeps a pooled ``requests.Session``, so STK
+pushes reuse open HTTPS connections, and caches the OAuth token until
+shortly before it expires instead of fetching one per payment.
+
+Views do not wait for Safaricom: ``queue_stk_push`` records the payment
+as queued and, once the transaction commits, hands it to a small thread
+pool that sends the push and records the outcome. The payment page then
+polls ``payment_status`` for the result.
+
+Under ASGI, ``aqueue_stk_push`` does the same from async views without
+threads: the push is sent by a task on the worker's event loop through an
+``httpx.AsyncClient``, so a slow Daraja holds no thread at all.
+"""
+import asyncio
+import base64
+import contextvars
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from requests.adapters import HTTPAdapter
+
+from .models import MpesaTransaction
+from .phones import to_e164
+
+logger = logging.getLogger(__name__)
+
+API_URLS = {
+    'sandbox': 'https://sandbox.safaricom.co.ke/',
+    'production': 'https://api.safaricom.co.ke/',
+}
+DEFAULT_CALLBACK_URL = 'https://water-management-system-ouep.onrender.com/api/mpesa/callback/'
+# A token is renewed this long before Daraja says it expires.
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
+REQUEST_TIMEOUT_SECONDS = 30
+POOL_SIZE = 16
+
+STATUS_QUEUED = MpesaTransaction.QUEUED
+STATUS_SENT = MpesaTransaction.SENT
+STATUS_COMPLETED = MpesaTransaction.COMPLETED
+STATUS_CANCELLED = MpesaTransaction.CANCELLED
+STATUS_FAILED = MpesaTransaction.FAILED
+# Daraja result codes with their own final status; any other non-zero code is a failure.
+RESULT_STATUSES = {0: STATUS_COMPLETED, 1032: STATUS_CANCELLED}
+
+PHONE_RE = re.compile(r'^\+254[17]\d{8}$')
+REFERENCE_SALT = 'waterapp.payments'
+
+
+class PaymentError(ValueError):
+    """Raised for a payment request that cannot be sent (bad phone or amount)."""
+
+
+@dataclass
+class StkPushResult:
+    ok: bool
+    checkout_request_id: str = ''
+    merchant_request_id: str = ''
+    message: str = ''
+
+
+def normalize_phone(phone):
+    """'0712 345 678' / '254712345678' -> '+254712345678' (E.164); raises PaymentError."""
+    number = to_e164(phone)
+    if not PHONE_RE.match(number):
+        raise PaymentError("Enter a Safaricom number such as 0712345678.")
+    return number
+
+
+def daraja_phone(number):
+    """Daraja takes the E.164 number without the '+'."""
+    return number.removeprefix('+')
+
+
+def parse_amount(amount):
+    try:
+        amount = int(str(amount).strip())
+    except ValueError:
+        raise PaymentError("Enter a whole number of shillings.")
+    if amount < 1:
+        raise PaymentError("The amount must be at least KES 1.")
+    return amount
+
+
+class DarajaGateway:
+    def __init__(self, base_url, consumer_key, consumer_secret, shortcode, passkey, callback_url,
+                 timeout=REQUEST_TIMEOUT_SECONDS, pool_size=POOL_SIZE):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_url = callback_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.pool_size = pool_size
+        self._token = None
+        self._token_expires = 0.0
+        self._token_lock = threading.Lock()
+        self._async_client = None
+        self._async_token_lock = None
+        self._async_loop = None
+
+    @classmethod
+    def from_settings(cls):
+        environment = getattr(settings, 'MPESA_ENVIRONMENT', 'sandbox')
+        return cls(
+            base_url=getattr(settings, 'MPESA_API_BASE_URL', None) or API_URLS[environment],
+            consumer_key=settings.MPESA_CONSUMER_KEY or '',
+            consumer_secret=settings.MPESA_CONSUMER_SECRET or '',
+            shortcode=settings.MPESA_SHORTCODE,
+            passkey=settings.MPESA_PASSKEY,
+            callback_url=getattr(settings, 'MPESA_CALLBACK_URL', DEFAULT_CALLBACK_URL),
+        )
+
+    def _token_expired(self):
+        return self._token is None or time.monotonic() >= self._token_expires
+
+    def _store_token(self, payload):
+        self._token = payload['access_token']
+        lifetime = int(payload.get('expires_in', 3599)) - TOKEN_EXPIRY_MARGIN_SECONDS
+        self._token_expires = time.monotonic() + max(lifetime, 0)
+
+    def access_token(self):
+        """The cached OAuth token, fetched again only when close to expiry."""
+        with self._token_lock:
+            if self._token_expired():
+                response = self.session.get(
+                    self.base_url + 'oauth/v1/generate',
+                    params={'grant_type': 'client_credentials'},
+                    auth=(self.consumer_key, self.consumer_secret),
+                    timeout=self.timeout,
+                )
+                response.raise_for_status()
+                self._store_token(response.json())
+            return self._token
+
+    def _forget_token(self, token):
+        with self._token_lock:
+            if self._token == token:
+                self._token = None
+
+    def _post(self, path, payload):
+        """POSTs with the cached token, renewing it once if Daraja rejects it."""
+        for attempt in range(2):
+            token = self.access_token()
+            response = self.session.post(
+                self.base_url + path, json=payload, timeout=self.timeout,
+                headers={'Authorization': f'Bearer {token}'},
+            )
+            if response.status_code != 401 or attempt:
+                return response
+            self._forget_token(token)
+
+    def _credentials(self):
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(f"{self.shortcode}{self.passkey}{timestamp}".encode()).decode()
+        return {'BusinessShortCode': self.shortcode, 'Password': password, 'Timestamp': timestamp}
+
+    def _stk_push_payload(self, phone, amount, account_reference, description):
+        return {
+            **self._credentials(),
+            'TransactionType': 'CustomerPayBillOnline',
+            'Amount': amount,
+            'PartyA': phone,
+            'PartyB': self.shortcode,
+            'PhoneNumber': phone,
+            'CallBackURL': self.callback_url,
+            'AccountReference': account_reference[:12],
+            'TransactionDesc': description[:13],
+        }
+
+    @staticmethod
+    def _push_result(body):
+        if body.get('ResponseCode') == '0':
+            return StkPushResult(
+                True, body.get('CheckoutRequestID', ''), body.get('MerchantRequestID', ''),
+                body.get('CustomerMessage', ''),
+            )
+        return StkPushResult(False, message=body.get('errorMessage') or body.get('ResponseDescription') or "Rejected")
+
+    def stk_push(self, phone, amount, account_reference, description):
+        payload = self._stk_push_payload(phone, amount, account_reference, description)
+        try:
+            body = self._post('mpesa/stkpush/v1/processrequest', payload).json()
+        except (requests.RequestException, ValueError) as e:
+            logger.error("M-Pesa STK push failed: %s", e)
+            return StkPushResult(False, message="Could not reach M-Pesa. Please try again.")
+        return self._push_result(body)
+
+    def stk_query(self, checkout_request_id):
+        """
+        Asks Daraja for the result of a push: (ResultCode, ResultDesc), or
+        None while it is still being processed or Daraja cannot be reached.
+        """
+        payload = {**self._credentials(), 'CheckoutRequestID': checkout_request_id}
+        try:
+            body = self._post('mpesa/stkpushquery/v1/query', payload).json()
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("M-Pesa STK query for %s failed: %s", checkout_request_id, e)
+            return None
+        if body.get('ResultCode') in (None, ''):
+            return None
+        return int(body['ResultCode']), body.get('ResultDesc', '')
+
+    def _client_for_loop(self):
+        """
+        The AsyncClient and token lock of the running event loop. Clients
+        cannot be shared across loops, so one is made per loop (in practice
+        one per ASGI worker).
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            self._close_async_client()
+            self._async_client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+            self._async_token_lock = asyncio.Lock()
+            self._async_loop = loop
+        return self._async_client
+
+    def _close_async_client(self):
+        """
+        Closes the AsyncClient on the loop it belongs to. A client whose
+        loop has stopped can no longer be closed; it is only dropped.
+        """
+        client, loop = self._async_client, self._async_loop
+        self._async_client = self._async_token_lock = self._async_loop = None
+        if client is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+
+    async def aaccess_token(self):
+        client = self._client_for_loop()
+        async with self._async_token_lock:
+            if self._token_expired():
+                response = await client.get(
+                    self.base_url + 'oauth/v1/generate',
+                    params={'grant_type': 'client_credentials'},
+                    auth=(self.consumer_key, self.consumer_secret),
+                )
+                response.raise_for_status()
+                self._store_token(response.json())
+            return self._token
+
+    async def _apost(self, path, payload):
+        client = self._client_for_loop()
+        for attempt in range(2):
+            token = await self.aaccess_token()
+            response = await client.post(
+                self.base_url + path, json=payload, headers={'Authorization': f'Bearer {token}'},
+            )
+            if response.status_code != 401 or attempt:
+                return response
+            self._forget_token(token)
+
+    async def astk_push(self, phone, amount, account_reference, description):
+        """``stk_push`` on the event loop."""
+        payload = self._stk_push_payload(phone, amount, account_reference, description)
+        try:
+            body = (await self._apost('mpesa/stkpush/v1/processrequest', payload)).json()
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error("M-Pesa STK push failed: %s", e)
+            return StkPushResult(False, message="Could not reach M-Pesa. Please try again.")
+        return self._push_result(body)
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = DarajaGateway.from_settings()
+    return _gateway
+
+
+def reset_gateway():
+    """Drops the shared gateway, e.g. after settings change in tests."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is not None:
+            _gateway.session.close()
+            _gateway._close_async_client()
+        _gateway = None
+
+
+def _push_outcome(result):
+    """The field updates recording a push result on its still-queued payment."""
+    if result.ok:
+        return {
+            'status': STATUS_SENT, 'transaction_code': result.checkout_request_id,
+            'result_description': result.message,
+        }
+    return {'status': STATUS_FAILED, 'result_description': result.message[:255]}
+
+
+def send_stk_push(payment_id, account_reference, description):
+    """Sends the push for a queued payment and records the outcome."""
+    payment = MpesaTransaction.objects.get(pk=payment_id)
+    result = get_gateway().stk_push(
+        daraja_phone(payment.phone_number), int(payment.amount), account_reference, description
+    )
+    MpesaTransaction.objects.filter(pk=payment_id, status=STATUS_QUEUED).update(**_push_outcome(result))
+    return result
+
+
+async def asend_stk_push(payment_id, account_reference, description):
+    """``send_stk_push`` on the event loop."""
+    payment = await MpesaTransaction.objects.aget(pk=payment_id)
+    result = await get_gateway().astk_push(
+        daraja_phone(payment.phone_number), int(payment.amount), account_reference, description
+    )
+    await MpesaTransaction.objects.filter(pk=payment_id, status=STATUS_QUEUED).aupdate(**_push_outcome(result))
+    return result
+
+
+def _send_in_thread(*args):
+    try:
+        return send_stk_push(*args)
+    except Exception:
+        logger.exception("Queued STK push %s failed", args[0])
+    finally:
+        close_old_connections()
+
+
+async def _send_in_task(*args):
+    try:
+        return await asend_stk_push(*args)
+    except Exception:
+        logger.exception("Queued STK push %s failed", args[0])
+
+
+class StkPushQueue:
+    """
+    Sends queued pushes from a thread pool of MPESA_PUSH_WORKERS threads,
+    started on first use. With 0 workers pushes are sent on the calling
+    thread (used by tests).
+
+    ``asubmit`` sends a push from a task on the running event loop instead;
+    ``ajoin`` waits for those still in flight.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._tasks = set()
+
+    def submit(self, *args):
+        workers = getattr(settings, 'MPESA_PUSH_WORKERS', 8)
+        if not workers:
+            return send_stk_push(*args)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stk-push')
+        return self._executor.submit(_send_in_thread, *args)
+
+    def asubmit(self, *args):
+        # A fresh context: the request's would tie the task's database calls
+        # to the request's thread, which goes away when the response is sent.
+        task = asyncio.get_running_loop().create_task(_send_in_task(*args), context=contextvars.Context())
+        # The loop only keeps weak references to tasks; hold them until done.
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def ajoin(self):
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+
+push_queue = StkPushQueue()
+
+
+def queue_stk_push(phone, amount, account_reference, description, vendor=None, user=None):
+    """
+    Validates and records a payment, then queues its STK push for after
+    the current transaction commits. Returns the MpesaTransaction.
+    """
+    payment = MpesaTransaction.objects.create(
+        phone_number=normalize_phone(phone), amount=parse_amount(amount), vendor=vendor, user=user,
+        status=STATUS_QUEUED,
+    )
+    transaction.on_commit(lambda: push_queue.submit(payment.pk, account_reference, description))
+    return payment
+
+
+async def aqueue_stk_push(phone, amount, account_reference, description, vendor=None, user=None,
+                          on_event_loop=True):
+    """
+    ``queue_stk_push`` for async views. The payment row is committed
+    straight away; with ``on_event_loop`` the push is sent by a task on the
+    running loop, which must outlive the request (an ASGI server's does;
+    the per-request loop Django runs async views in under WSGI does not,
+    so there the thread pool is used).
+    """
+    payment = await MpesaTransaction.objects.acreate(
+        phone_number=normalize_phone(phone), amount=parse_amount(amount), vendor=vendor, user=user,
+        status=STATUS_QUEUED,
+    )
+    if on_event_loop:
+        push_queue.asubmit(payment.pk, account_reference, description)
+    else:
+        await sync_to_async(transaction.on_commit)(
+            lambda: push_queue.submit(payment.pk, account_reference, description)
+        )
+    return payment
+
+
+def link_payments(user):
+    """
+    Attaches unclaimed payments made from the phone number in ``user``'s
+    username, e.g. before they signed up. Returns the number linked.
+    """
+    phone = to_e164(user.username)
+    if not phone:
+        return 0
+    return MpesaTransaction.objects.filter(phone_number=phone, user__isnull=True).update(user=user)
+
+
+def user_payments(user):
+    """
+    ``user``'s payments, including unclaimed ones from the phone number in
+    their username (anonymous donations made after they signed up, which
+    ``link_payments`` never saw). Each branch has its own index.
+    """
+    mine = Q(user=user)
+    phone = to_e164(user.username)
+    if phone:
+        mine |= Q(user__isnull=True, phone_number=phone)
+    return MpesaTransaction.objects.filter(mine)
+
+def payment_reference(payment):
+    """An opaque token the payer can poll with, without exposing other payments."""
+    return signing.dumps(payment.pk, salt=REFERENCE_SALT)
+
+
+def payment_from_reference(reference):
+    try:
+        return MpesaTransaction.objects.get(pk=signing.loads(reference, salt=REFERENCE_SALT))
+    except (signing.BadSignature, MpesaTransaction.DoesNotExist):
+        return None
+
+
+def payment_status(payment):
+    finished = payment.status not in (STATUS_QUEUED, STATUS_SENT)
+    return {
+        'status': payment.status,
+        'message': payment.result_description,
+        'amount': float(payment.amount),
+        'receipt': payment.receipt_number,
+        'finished': finished,
+    }
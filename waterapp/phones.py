@@ -0,0 +1,27 @@
+"""
+Phone numbers in canonical E.164 form (``+254712345678``).
+
+Stored numbers go through ``to_e164`` so lookups can use equality (and an
+index) instead of matching every way a number can be typed. Local numbers
+are taken to be Kenyan.
+"""
+import re
+
+COUNTRY_CODE = '254'
+E164_RE = re.compile(r'^\+[1-9]\d{7,14}$')
+
+
+def to_e164(raw):
+    """'0712 345 678' / '254712345678' / '+254712345678' -> '+254712345678'; '' if not a phone number."""
+    number = re.sub(r'[\s\-().]', '', str(raw or ''))
+    if number.startswith('+'):
+        pass
+    elif number.startswith('00'):
+        number = '+' + number[2:]
+    elif number.startswith('0'):
+        number = f'+{COUNTRY_CODE}{number[1:]}'
+    elif len(number) == 9:
+        number = f'+{COUNTRY_CODE}{number}'
+    else:
+        number = '+' + number
+    return number if E164_RE.match(number) else ''
@@ -0,0 +1,56 @@
+"""
+Denormalized vendor ratings.
+
+WaterVendor.rating_count/rating_sum are adjusted with atomic F() updates as
+reviews are created, changed or deleted, so profile and list pages never
+scan VendorReview to show or sort by the average.
+"""
+from django.db.models import Count, ExpressionWrapper, F, FloatField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, NullIf
+
+from .caching import bump_version
+from .models import VendorReview, WaterVendor
+
+
+def adjust_rating(vendor_id, count, rating_sum):
+    WaterVendor.objects.filter(pk=vendor_id).update(
+        rating_count=F('rating_count') + count,
+        rating_sum=F('rating_sum') + rating_sum,
+    )
+
+
+def review_changed(previous, current):
+    """
+    Moves a review's contribution from ``previous`` to ``current`` values
+    (dicts with ``vendor_id`` and ``rating``; None when created or deleted).
+    """
+    if previous == current:
+        return
+    if previous:
+        adjust_rating(previous['vendor_id'], -1, -previous['rating'])
+    if current:
+        adjust_rating(current['vendor_id'], 1, current['rating'])
+
+
+def recompute_ratings(vendors=None):
+    """
+    Rewrites the counters from the reviews table in one UPDATE and retires
+    the cached vendor pages; returns the row count.
+    """
+    reviews = VendorReview.objects.filter(vendor=OuterRef('pk')).order_by().values('vendor')
+    vendors = WaterVendor.objects.all() if vendors is None else vendors
+    updated = vendors.update(
+        rating_count=Coalesce(Subquery(reviews.annotate(n=Count('pk')).values('n')), 0),
+        rating_sum=Coalesce(Subquery(reviews.annotate(total=Sum('rating')).values('total')), 0),
+    )
+    if updated:
+        # update() skips the save signals that normally bump it.
+        bump_version('vendors')
+    return updated
+
+
+def with_average_rating(vendors):
+    """Annotates ``avg_rating`` (NULL for unrated vendors) for ordering in SQL."""
+    return vendors.annotate(avg_rating=ExpressionWrapper(
+        F('rating_sum') * 1.0 / NullIf(F('rating_count'), 0), output_field=FloatField()
+    ))
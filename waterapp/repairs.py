@@ -0,0 +1,43 @@
+"""
+Logging repairs.
+
+A repair is written in one transaction: the log row, the source back to
+Operational (a partial save, so the map, search and status history signals
+still see it) and every open issue resolved by a single UPDATE whose row
+count is the number resolved, with the source's open-issue counters zeroed.
+Receivers of ``repair_completed`` run once the transaction has committed.
+"""
+from django.db import transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .issue_counts import clear_open_issues
+from .models import WaterSource
+
+# Sent with sender=WaterSource and source=, repair=, resolved_issues= after
+# a repair has committed.
+repair_completed = Signal()
+
+
+def log_repair(source, repair, technician=None):
+    """
+    Saves an unsaved RepairLog against ``source``, marks the source
+    Operational and resolves its open issues. Returns the number resolved.
+    """
+    with transaction.atomic():
+        # Serializes repairs and high-priority reports on the same source
+        # where the database has row locks.
+        source = WaterSource.objects.select_for_update().get(pk=source.pk)
+        repair.water_source = source
+        repair.technician = technician
+        repair.save()
+
+        source.status = 'O'
+        source.save(update_fields=['status', 'last_updated'])
+        resolved = source.issues.filter(is_resolved=False).update(is_resolved=True, resolved_at=timezone.now())
+        clear_open_issues(source.pk)
+
+        transaction.on_commit(lambda: repair_completed.send(
+            sender=WaterSource, source=source, repair=repair, resolved_issues=resolved
+        ))
+    return resolved
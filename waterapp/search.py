@@ -0,0 +1,169 @@
+"""
+Trigram search over water sources and vendors.
+
+Searchable text is split into words, and each word into overlapping
+three-letter grams (``"  kibera "`` -> ``"  k", " ki", "kib", ...``, the
+padding used by PostgreSQL's pg_trgm). SearchTrigram holds one row per
+distinct gram of each object, so a query is a single indexed
+``trigram IN (...)`` lookup, grouped and ranked per object in SQL, and
+works the same on SQLite and PostgreSQL. Objects sharing most of the
+query's grams match even when a letter or two is wrong, and matches in
+names outrank matches in descriptions.
+"""
+import math
+import re
+import unicodedata
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from .models import SearchTrigram, WaterSource, WaterVendor
+
+NAME_WEIGHT = 3
+TEXT_WEIGHT = 1
+# Share of the query's trigrams a result must contain.
+MIN_MATCH = 0.4
+MAX_TEXT_LENGTH = 2000
+# Best-ranked index hits considered before filtering by the caller's queryset.
+MAX_CANDIDATES = 500
+
+WORD_RE = re.compile(r'\w+')
+
+INDEXED_FIELDS = {
+    'source': (WaterSource, (('name', NAME_WEIGHT), ('description', TEXT_WEIGHT))),
+    'vendor': (WaterVendor, (('business_name', NAME_WEIGHT), ('location_name', TEXT_WEIGHT))),
+}
+KIND_OF = {model: kind for kind, (model, _) in INDEXED_FIELDS.items()}
+
+
+def normalize(text):
+    """Lowercases and strips accents, so 'Kisumu Café' matches 'cafe'."""
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(char for char in text if not unicodedata.combining(char)).lower()
+
+
+def trigrams(text, prefix=False):
+    """
+    The set of trigrams of ``text``. With ``prefix``, the last word is
+    treated as unfinished (no end-of-word gram), for search-as-you-type.
+    """
+    words = WORD_RE.findall(normalize(text)[:MAX_TEXT_LENGTH])
+    grams = set()
+    for i, word in enumerate(words):
+        padded = f"  {word}" if prefix and i == len(words) - 1 else f"  {word} "
+        grams.update(padded[j:j + 3] for j in range(len(padded) - 2))
+    return grams
+
+
+def document_trigrams(kind, values):
+    """{trigram: weight} for an object's field values, keeping the best weight."""
+    _, fields = INDEXED_FIELDS[kind]
+    weights = {}
+    for name, weight in fields:
+        for gram in trigrams(values.get(name)):
+            weights[gram] = max(weight, weights.get(gram, 0))
+    return weights
+
+
+def index_object(instance, update_fields=None):
+    """
+    Brings an object's index rows in line with its current text, touching
+    only the trigrams that changed. Saves that did not write a searchable
+    field are skipped without a query.
+    """
+    kind = KIND_OF[type(instance)]
+    _, fields = INDEXED_FIELDS[kind]
+    if update_fields is not None and not {name for name, _ in fields} & set(update_fields):
+        return
+
+    wanted = document_trigrams(kind, {name: getattr(instance, name) for name, _ in fields})
+    rows = SearchTrigram.objects.filter(kind=kind, object_id=instance.pk)
+    existing = dict(rows.values_list('trigram', 'weight'))
+    if existing == wanted:
+        return
+
+    stale = [gram for gram, weight in existing.items() if wanted.get(gram) != weight]
+    with transaction.atomic():
+        if stale:
+            rows.filter(trigram__in=stale).delete()
+        SearchTrigram.objects.bulk_create([
+            SearchTrigram(kind=kind, object_id=instance.pk, trigram=gram, weight=weight)
+            for gram, weight in wanted.items() if existing.get(gram) != weight
+        ])
+
+
+def index_many(kind, objects):
+    """Re-indexes a batch of saved objects, e.g. after ``bulk_create``."""
+    _, fields = INDEXED_FIELDS[kind]
+    with transaction.atomic():
+        SearchTrigram.objects.filter(kind=kind, object_id__in=[obj.pk for obj in objects]).delete()
+        SearchTrigram.objects.bulk_create(
+            [
+                SearchTrigram(kind=kind, object_id=obj.pk, trigram=gram, weight=weight)
+                for obj in objects
+                for gram, weight in document_trigrams(kind, {name: getattr(obj, name) for name, _ in fields}).items()
+            ],
+            batch_size=5000,
+        )
+
+
+def remove_object(kind, object_id):
+    SearchTrigram.objects.filter(kind=kind, object_id=object_id).delete()
+
+
+def rebuild_index(kinds=None, batch_size=5000):
+    """Re-creates the index from scratch; returns the number of objects indexed."""
+    indexed = 0
+    for kind in kinds or INDEXED_FIELDS:
+        model, fields = INDEXED_FIELDS[kind]
+        names = [name for name, _ in fields]
+        with transaction.atomic():
+            SearchTrigram.objects.filter(kind=kind).delete()
+            batch = []
+            for values in model.objects.values('pk', *names).iterator(chunk_size=2000):
+                batch += [
+                    SearchTrigram(kind=kind, object_id=values['pk'], trigram=gram, weight=weight)
+                    for gram, weight in document_trigrams(kind, values).items()
+                ]
+                indexed += 1
+                if len(batch) >= batch_size:
+                    SearchTrigram.objects.bulk_create(batch)
+                    batch = []
+            SearchTrigram.objects.bulk_create(batch)
+    return indexed
+
+
+def search(kind, query, queryset=None, limit=50, prefix=False):
+    """
+    Returns up to ``limit`` objects from ``queryset`` (default: all objects
+    of ``kind``) matching ``query``, best first, each with a
+    ``search_score`` between 0 and 1.
+    """
+    model, _ = INDEXED_FIELDS[kind]
+    queryset = model.objects.all() if queryset is None else queryset
+    grams = trigrams(query, prefix=prefix)
+    if not grams:
+        return []
+
+    # Grouped by object_id + 0 rather than object_id: grouping on the column
+    # lets the planner walk the (kind, object_id) index, which visits every
+    # indexed object, instead of looking the trigrams up.
+    needed = max(1, math.ceil(len(grams) * MIN_MATCH))
+    ranked = (
+        SearchTrigram.objects.filter(kind=kind, trigram__in=grams)
+        .values(document=F('object_id') + 0)
+        .annotate(matched=Count('pk'), total=Sum('weight'))
+        .filter(matched__gte=needed)
+        .order_by('-total', '-matched', 'document')
+        .values_list('document', 'total')[:MAX_CANDIDATES]
+    )
+    scores = {object_id: total / (NAME_WEIGHT * len(grams)) for object_id, total in ranked}
+    objects = queryset.in_bulk(list(scores))
+
+    results = []
+    for object_id, score in scores.items():
+        if object_id in objects:
+            objects[object_id].search_score = round(score, 3)
+            results.append(objects[object_id])
+            if len(results) == limit:
+                break
+    return results
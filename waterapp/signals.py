@@ -1,6 +1,14 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from .models import IssueReport, WaterSource
+from .caching import bump_version
+from .issue_counts import issue_changed
+from .map_data import record_removal, update_clusters
+from .live_map import broker as live_map_broker
+from .models import IssueReport, VendorReview, VendorStatusEvent, WaterSource, WaterSourceStatusEvent, WaterVendor
+from .ratings import review_changed
+from .search import KIND_OF, index_object, remove_object
+from .status_log import record_status_change, record_vendor_status_change
 
 @receiver(post_save, sender=IssueReport)
 def update_source_status(sender, instance, created, **kwargs):
@@ -12,5 +20,119 @@ def update_source_status(sender, instance, created, **kwargs):
     """
     if created and instance.priority_level == 3 and instance.water_source:
         source = instance.water_source
-        source.status = 'M'
-        source.save()
\ No newline at end of file
+        if source.status != 'M':
+            source.status = 'M'
+            source.save(update_fields=['status', 'last_updated'])
+
+def _issue_values(issue):
+    return {name: getattr(issue, name) for name in IssueReport.TRACKED_FIELDS}
+
+@receiver(post_save, sender=IssueReport)
+def update_open_issue_count(sender, instance, created, **kwargs):
+    issue_changed(instance.previous_values, _issue_values(instance))
+
+@receiver(post_delete, sender=IssueReport)
+def remove_open_issue_count(sender, instance, **kwargs):
+    previous = getattr(instance, '_loaded_values', None) or _issue_values(instance)
+    issue_changed(previous, None)
+
+def _map_values(source):
+    return {name: getattr(source, name) for name in WaterSource.TRACKED_FIELDS}
+
+@receiver(post_save, sender=WaterSource)
+def update_map_clusters(sender, instance, created, **kwargs):
+    """Keeps the pre-aggregated map grid in step with the saved source."""
+    update_clusters(instance.previous_values, _map_values(instance))
+
+@receiver(post_save, sender=WaterSource)
+def log_status_change(sender, instance, created, **kwargs):
+    """Appends to the status history, diffing against the loaded snapshot."""
+    previous = instance.previous_values
+    record_status_change(instance, previous['status'] if previous else None)
+
+@receiver(post_delete, sender=WaterSource)
+def remove_from_map_clusters(sender, instance, **kwargs):
+    previous = getattr(instance, '_loaded_values', None) or _map_values(instance)
+    update_clusters(previous, None)
+    record_removal('source', instance.pk)
+
+@receiver(post_save, sender=WaterVendor)
+def record_vendor_leaving_map(sender, instance, created, **kwargs):
+    """
+    A vendor that closes, loses verification or its location drops off the
+    map; leave a tombstone so delta-sync clients remove it too.
+    """
+    previous = instance.previous_values
+    current = {name: getattr(instance, name) for name in WaterVendor.TRACKED_FIELDS}
+    if previous and WaterVendor.shows_on_map(previous) and not WaterVendor.shows_on_map(current):
+        record_removal('vendor', instance.pk)
+
+@receiver(post_save, sender=WaterVendor)
+def log_vendor_status_change(sender, instance, created, **kwargs):
+    previous = instance.previous_values
+    record_vendor_status_change(instance, previous['is_open'] if previous else None)
+
+@receiver(post_save, sender=WaterSourceStatusEvent)
+@receiver(post_save, sender=VendorStatusEvent)
+def wake_live_map(sender, **kwargs):
+    """Sends the change to this process's live map clients without waiting for the next poll."""
+    transaction.on_commit(live_map_broker.notify)
+
+@receiver(post_delete, sender=WaterVendor)
+def record_vendor_deleted(sender, instance, **kwargs):
+    record_removal('vendor', instance.pk)
+
+@receiver(post_save, sender=WaterSource)
+@receiver(post_delete, sender=WaterSource)
+@receiver(post_save, sender=WaterVendor)
+@receiver(post_delete, sender=WaterVendor)
+@receiver(post_save, sender=IssueReport)
+@receiver(post_delete, sender=IssueReport)
+def invalidate_map_payload(sender, **kwargs):
+    """Any change to what the map shows (issue counters included) retires the cached payloads."""
+    bump_version('map')
+
+@receiver(post_save, sender=IssueReport)
+@receiver(post_delete, sender=IssueReport)
+@receiver(post_save, sender=WaterSource)
+@receiver(post_delete, sender=WaterSource)
+def invalidate_dashboard_stats(sender, **kwargs):
+    bump_version('dashboard')
+
+@receiver(post_save, sender=IssueReport)
+@receiver(post_delete, sender=IssueReport)
+@receiver(post_save, sender=WaterSource)
+@receiver(post_delete, sender=WaterSource)
+def invalidate_source_list(sender, **kwargs):
+    """Retires the cached source list pages (names, statuses, issue counts)."""
+    bump_version('sources')
+
+@receiver(post_save, sender=WaterVendor)
+@receiver(post_delete, sender=WaterVendor)
+@receiver(post_save, sender=VendorReview)
+@receiver(post_delete, sender=VendorReview)
+def invalidate_vendor_pages(sender, **kwargs):
+    """Retires the cached vendor directory and home page (listings, ratings)."""
+    bump_version('vendors')
+
+def _review_values(review):
+    return {name: getattr(review, name) for name in VendorReview.TRACKED_FIELDS}
+
+@receiver(post_save, sender=VendorReview)
+def update_vendor_rating(sender, instance, created, **kwargs):
+    review_changed(instance.previous_values, _review_values(instance))
+
+@receiver(post_delete, sender=VendorReview)
+def remove_vendor_rating(sender, instance, **kwargs):
+    previous = getattr(instance, '_loaded_values', None) or _review_values(instance)
+    review_changed(previous, None)
+
+@receiver(post_save, sender=WaterSource)
+@receiver(post_save, sender=WaterVendor)
+def update_search_index(sender, instance, update_fields=None, **kwargs):
+    index_object(instance, update_fields)
+
+@receiver(post_delete, sender=WaterSource)
+@receiver(post_delete, sender=WaterVendor)
+def remove_from_search_index(sender, instance, **kwargs):
+    remove_object(KIND_OF[sender], instance.pk)
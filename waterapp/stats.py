@@ -0,0 +1,75 @@
+"""
+Headline counters for the staff dashboard and the home page.
+"""
+from django.core.cache import cache
+from django.db.models import Count, Max, Q, Subquery, Sum
+
+from .caching import get_version
+from .issue_counts import PRIORITY_FIELDS
+from .models import IssueReport, WaterSource
+
+# The counters are also invalidated by the IssueReport/WaterSource signals;
+# the timeout only bounds staleness from writes that bypass them.
+STATS_CACHE_TIMEOUT = 60
+
+
+def _open_vendor_issue_count():
+    return (
+        IssueReport.objects.filter(is_resolved=False, water_source__isnull=True)
+        .order_by()
+        .values('is_resolved')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+
+
+def compute_dashboard_stats():
+    """
+    Computes every counter in a single conditional-aggregate query over
+    WaterSource. Source issues come from the denormalized per-source
+    counters; vendor issues, which have none, are a scalar subquery.
+    """
+    counters = {
+        'total_sources': Count('pk'),
+        'open_source_issues': Sum('open_issue_count'),
+        'open_vendor_issues': Max(Subquery(_open_vendor_issue_count())),
+    }
+    for priority, field in PRIORITY_FIELDS.items():
+        counters[f'priority_{priority}'] = Sum(field)
+    for code, _ in WaterSource.STATUS_CHOICES:
+        counters[f'status_{code}'] = Count('pk', filter=Q(status=code))
+    for code, _ in WaterSource.SOURCE_TYPES:
+        counters[f'type_{code}'] = Count('pk', filter=Q(source_type=code))
+
+    row = WaterSource.objects.aggregate(**counters)
+    if not row['total_sources']:
+        # No sources at all, so the subquery was never evaluated.
+        row['open_vendor_issues'] = IssueReport.objects.filter(is_resolved=False, water_source__isnull=True).count()
+
+    return {
+        'total_sources': row['total_sources'],
+        'open_issues': (row['open_source_issues'] or 0) + (row['open_vendor_issues'] or 0),
+        'open_by_priority': [
+            {'priority': priority, 'label': label, 'count': row[f'priority_{priority}'] or 0}
+            for priority, label in IssueReport.PRIORITY_CHOICES
+        ],
+        'operational_sources': row['status_O'],
+        'status_counts': [
+            {'status': code, 'count': row[f'status_{code}']}
+            for code, _ in WaterSource.STATUS_CHOICES if row[f'status_{code}']
+        ],
+        'source_type_counts': [
+            {'source_type': code, 'count': row[f'type_{code}']}
+            for code, _ in WaterSource.SOURCE_TYPES if row[f'type_{code}']
+        ],
+    }
+
+
+def get_dashboard_stats():
+    """The dashboard counters, cached until the next source or issue change."""
+    key = f"dashboard-stats:{get_version('dashboard')}"
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute_dashboard_stats()
+        cache.set(key, stats, STATS_CACHE_TIMEOUT)
+    return stats
@@ -0,0 +1,102 @@
+"""
+Queries over the WaterSourceStatusEvent log.
+
+Every lookup is a range scan on the (source, at) or (at) index: the status
+at a moment is the latest event at or before it, and downtime is the time
+between events spent in a DOWN_STATUSES status. Time before a source's
+first event is unknown and never counted as downtime.
+"""
+from collections import defaultdict
+
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from .models import VendorStatusEvent, WaterSource, WaterSourceStatusEvent
+
+DOWN_STATUSES = frozenset(code for code, _ in WaterSource.STATUS_CHOICES if code != 'O')
+
+
+def record_status_change(source, previous_status):
+    """Appends an event if ``source.status`` differs from ``previous_status``."""
+    if source.status != previous_status:
+        WaterSourceStatusEvent.objects.create(
+            source=source, previous_status=previous_status or '', status=source.status
+        )
+
+
+def record_vendor_status_change(vendor, previous_is_open):
+    """Appends an event if the vendor opened or closed (not for new vendors)."""
+    if previous_is_open is not None and vendor.is_open != previous_is_open:
+        VendorStatusEvent.objects.create(vendor=vendor, is_open=vendor.is_open)
+
+
+def record_status_changes(changes):
+    """Bulk version for writes that bypass save(): (source, previous_status) pairs."""
+    now = timezone.now()
+    WaterSourceStatusEvent.objects.bulk_create(
+        [
+            WaterSourceStatusEvent(source=source, previous_status=previous or '', status=source.status, at=now)
+            for source, previous in changes if source.status != previous
+        ],
+        batch_size=1000,
+    )
+
+
+def _latest_before(at):
+    return (
+        WaterSourceStatusEvent.objects.filter(source=OuterRef('pk'), at__lt=at)
+        .order_by('-at', '-id')
+        .values('status')[:1]
+    )
+
+
+def status_at(source, at):
+    """The status ``source`` had at ``at``, or None before its history starts."""
+    return (
+        WaterSourceStatusEvent.objects.filter(source=source, at__lte=at)
+        .order_by('-at', '-id')
+        .values_list('status', flat=True)
+        .first()
+    )
+
+
+def down_intervals(start, end, sources=None):
+    """
+    {source_id: [(from, to), ...]} of the time each source spent down
+    within [start, end), capped at now. ``sources`` narrows it to a
+    WaterSource queryset.
+    """
+    end = min(end, timezone.now())
+    if start >= end:
+        return {}
+    events = WaterSourceStatusEvent.objects.filter(at__gte=start, at__lt=end)
+    if sources is None:
+        sources = WaterSource.objects.all()
+    else:
+        events = events.filter(source__in=sources.values('pk'))
+
+    # Status at ``start``: one index probe per source, in one query.
+    down_since = {
+        pk: start
+        for pk in sources.annotate(status_then=Subquery(_latest_before(start)))
+        .filter(status_then__in=DOWN_STATUSES).values_list('pk', flat=True)
+    }
+    events = events.order_by('source_id', 'at', 'id').values_list('source_id', 'status', 'at')
+    intervals = defaultdict(list)
+    for source_id, status, at in events.iterator(chunk_size=2000):
+        was_down_since = down_since.get(source_id)
+        if status in DOWN_STATUSES:
+            down_since.setdefault(source_id, at)
+        elif was_down_since is not None:
+            if at > was_down_since:
+                intervals[source_id].append((was_down_since, at))
+            del down_since[source_id]
+    for source_id, since in down_since.items():
+        intervals[source_id].append((since, end))
+    return dict(intervals)
+
+
+def downtime(source, start, end):
+    """Hours ``source`` spent down between ``start`` and ``end``."""
+    spans = down_intervals(start, end, WaterSource.objects.filter(pk=source.pk)).get(source.pk, ())
+    return sum((to - since).total_seconds() for since, to in spans) / 3600
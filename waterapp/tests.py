@@ -1,5 +1,51 @@
-from django.test import TestCase
-from .models import WaterSource
+import asyncio
+import csv
+import gzip
+import io
+import json
+import threading
+import time
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.core import mail
+from django.db import OperationalError, connection, transaction
+from django.db.models import Sum
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from . import geo, live_map, map_data
+from .analytics import refresh_analytics
+from .fake_daraja import REJECTED_PHONE, FakeDaraja
+from .clicks import ClickBuffer, compact_click_logs, write_clicks
+from .models import (
+    IssueReport, MapCluster, RollupWatermark, SourceDailyStats, SourceTypeDailyStats, WaterSourceStatusEvent, MpesaCallback, MpesaTransaction, OutboundEmail, RepairLog, SearchTrigram, MapTombstone, VendorClickLog, VendorDailyStats, VendorReview, VendorStatusEvent, WaterSource,
+    WaterVendor
+)
+from .caching import get_version
+from .nearest import k_nearest
+from .imports import ImportFileError, import_sources
+from .issue_counts import reconcile, recompute_open_issue_counts
+from .outbox import MAX_ATTEMPTS, process_outbox, queue_email
+from .pagination import InvalidCursor, encode_cursor, keyset_page
+from .phones import to_e164
+from .payment_callbacks import process_callbacks, sweep_pending_payments
+from .payments import (
+    DarajaGateway, PaymentError, get_gateway, link_payments, normalize_phone, payment_reference, push_queue, reset_gateway,
+    user_payments,
+)
+from .ratings import recompute_ratings
+from .repairs import log_repair, repair_completed
+from .search import rebuild_index, search, trigrams
+from .status_log import downtime, status_at
+from .stats import compute_dashboard_stats, get_dashboard_stats
 
 class WaterSourceModelTest(TestCase):
     def setUp(self):
@@ -13,4 +59,1613 @@ class WaterSourceModelTest(TestCase):
     def test_water_source_creation(self):
         source = WaterSource.objects.get(name="Test Pump")
         self.assertEqual(source.source_type, "P")
-        self.assertEqual(source.status, "O") 
\ No newline at end of file
+        self.assertEqual(source.status, "O") 
+
+class MapDataViewportTest(TestCase):
+    def setUp(self):
+        self.nairobi = WaterSource.objects.create(
+            name="Kibera Tap", source_type="TP", latitude=-1.3128, longitude=36.7880
+        )
+        self.mombasa = WaterSource.objects.create(
+            name="Likoni Borehole", source_type="BH", latitude=-4.0803, longitude=39.6620
+        )
+
+    def test_geokey_follows_coordinates(self):
+        self.assertEqual(self.nairobi.geokey, geo.encode(-1.3128, 36.7880))
+        self.nairobi.latitude = -4.0803
+        self.nairobi.longitude = 39.6620
+        self.nairobi.save(update_fields=['latitude', 'longitude'])
+        self.nairobi.refresh_from_db()
+        self.assertEqual(self.nairobi.geokey, self.mombasa.geokey)
+
+    def test_full_payload_without_viewport(self):
+        response = self.client.get(reverse('water_source_map_data'))
+        self.assertEqual({p['id'] for p in response.json()}, {self.nairobi.pk, self.mombasa.pk})
+
+    def test_bbox_returns_only_points_in_view(self):
+        response = self.client.get(reverse('water_source_map_data'), {'bbox': '36.6,-1.5,37.0,-1.1'})
+        self.assertEqual([p['id'] for p in response.json()], [self.nairobi.pk])
+
+    def test_radius_filters_by_distance(self):
+        url = reverse('water_source_map_data')
+        near = self.client.get(url, {'lat': -1.30, 'lon': 36.80, 'radius': 5}).json()
+        self.assertEqual([p['id'] for p in near], [self.nairobi.pk])
+        far = self.client.get(url, {'lat': -1.30, 'lon': 36.80, 'radius': 490}).json()
+        self.assertEqual(len(far), 2)
+
+    def test_invalid_viewport_is_rejected(self):
+        response = self.client.get(reverse('water_source_map_data'), {'bbox': 'nairobi'})
+        self.assertEqual(response.status_code, 400)
+
+
+class MapClusterTest(TestCase):
+    def setUp(self):
+        self.a = WaterSource.objects.create(
+            name="Kibera Tap", source_type="TP", latitude=-1.3128, longitude=36.7880
+        )
+        self.b = WaterSource.objects.create(
+            name="Kibera Well", source_type="WL", latitude=-1.3130, longitude=36.7885, status='B'
+        )
+
+    def clusters(self, level):
+        return {
+            c.cell: (c.count, c.operational, c.broken, c.maintenance)
+            for c in MapCluster.objects.filter(level=level, count__gt=0)
+        }
+
+    def assertMatchesRebuild(self):
+        incremental = {level: self.clusters(level) for level in map_data.CLUSTER_LEVELS}
+        map_data.rebuild_clusters()
+        rebuilt = {level: self.clusters(level) for level in map_data.CLUSTER_LEVELS}
+        self.assertEqual(incremental, rebuilt)
+
+    def test_sources_are_counted_per_cell(self):
+        level = map_data.cluster_level(10)
+        self.assertEqual(list(self.clusters(level).values()), [(2, 1, 1, 0)])
+        self.assertMatchesRebuild()
+
+    def test_status_change_and_move_update_cells(self):
+        self.b.status = 'M'
+        self.b.save()
+        self.a.latitude = -4.0803
+        self.a.longitude = 39.6620
+        self.a.save()
+        self.assertEqual(len(self.clusters(map_data.cluster_level(10))), 2)
+        self.assertMatchesRebuild()
+
+    def test_delete_removes_source_from_cells(self):
+        self.b.delete()
+        level = map_data.cluster_level(10)
+        self.assertEqual(list(self.clusters(level).values()), [(1, 1, 0, 0)])
+        self.assertMatchesRebuild()
+
+    def test_low_zoom_returns_clusters_high_zoom_returns_points(self):
+        url = reverse('water_source_map_data')
+        bbox = '36.6,-1.5,37.0,-1.1'
+        clustered = self.client.get(url, {'bbox': bbox, 'zoom': 8}).json()
+        self.assertEqual([(p['type'], p['count']) for p in clustered], [('cluster', 2)])
+        self.assertEqual(clustered[0]['statuses'], {'Operational': 1, 'Broken/Non-Operational': 1})
+
+        detailed = self.client.get(url, {'bbox': bbox, 'zoom': 17}).json()
+        self.assertEqual({p['type'] for p in detailed}, {'source'})
+        self.assertEqual(len(detailed), 2)
+
+    def test_default_view_and_lone_sources_get_source_points(self):
+        url = reverse('water_source_map_data')
+        # The map page opens at zoom 13.
+        default = self.client.get(url, {'bbox': '36.7,-1.35,36.9,-1.25', 'zoom': 13}).json()
+        self.assertEqual({(p['type'], p['color']) for p in default}, {('source', 'success'), ('source', 'brown-custom')})
+
+        far = WaterSource.objects.create(name="Malindi Well", source_type="WL", latitude=-3.2192, longitude=40.1169)
+        points = self.client.get(url, {'zoom': 8}).json()
+        self.assertEqual(
+            sorted((p['type'], p.get('count', 1)) for p in points), [('cluster', 2), ('source', 1)]
+        )
+        self.assertEqual(next(p for p in points if p['type'] == 'source')['id'], far.pk)
+
+
+class MapDataCacheTest(TestCase):
+    def setUp(self):
+        self.url = reverse('water_source_map_data')
+        self.source = WaterSource.objects.create(
+            name="Kibera Tap", source_type="TP", latitude=-1.3128, longitude=36.7880
+        )
+
+    def test_unchanged_data_returns_not_modified(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertTrue(first['ETag'].startswith('"'))
+
+        second = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_cluster_rebuild_invalidates_payload(self):
+        params = {'bbox': '36.6,-1.5,37.0,-1.1', 'zoom': 8}
+        first = self.client.get(self.url, params)
+        MapCluster.objects.update(count=7)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('rebuild_map_clusters', stdout=io.StringIO())
+        second = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual([p['type'] for p in second.json()], ['source'])
+
+    def test_source_change_invalidates_payload(self):
+        first = self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.source.status = 'B'
+            self.source.save()
+
+        second = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        self.assertEqual(second.json()[0]['status'], 'Broken/Non-Operational')
+
+    def test_vendor_change_invalidates_payload(self):
+        first = self.client.get(self.url)
+        user = User.objects.create_user('vendor', password='pass12345')
+        with self.captureOnCommitCallbacks(execute=True):
+            WaterVendor.objects.create(
+                user=user, business_name="Maji Safi", phone_number="0712345678",
+                location_name="Kibera", latitude=-1.31, longitude=36.79, is_verified=True
+            )
+
+        second = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual({p['type'] for p in second.json()}, {'source', 'vendor'})
+
+    def test_payload_is_served_gzipped(self):
+        plain = self.client.get(self.url)
+        compressed = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertNotEqual(compressed['ETag'], plain['ETag'])
+        self.assertIn('Accept-Encoding', compressed['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(compressed.content)), plain.json())
+
+    async def test_served_on_the_event_loop_under_asgi(self):
+        first = await self.async_client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()[0]['name'], "Kibera Tap")
+        second = await self.async_client.get(self.url, headers={'If-None-Match': first['ETag']})
+        self.assertEqual(second.status_code, 304)
+
+        # A cached payload is never rebuilt.
+        with mock.patch('waterapp.map_data.build_map_payload', side_effect=AssertionError):
+            third = await self.async_client.get(self.url)
+        self.assertEqual(third.content, first.content)
+
+class MapDeltaSyncTest(TestCase):
+    def setUp(self):
+        self.url = reverse('water_source_map_changes')
+        self.source = WaterSource.objects.create(
+            name="Kibera Tap", source_type="TP", latitude=-1.3128, longitude=36.7880
+        )
+        self.vendor = WaterVendor.objects.create(
+            user=User.objects.create_user('vendor', password='pass12345'),
+            business_name="Maji Safi", phone_number="0712345678", location_name="Kibera",
+            latitude=-1.31, longitude=36.79, is_verified=True
+        )
+
+    def sync(self, cursor=None):
+        params = {'since': cursor} if cursor else {}
+        return self.client.get(self.url, params).json()
+
+    def age_everything(self):
+        old = timezone.now() - timedelta(minutes=10)
+        WaterSource.objects.update(last_updated=old)
+        WaterVendor.objects.update(last_updated=old)
+        MapTombstone.objects.update(removed_at=old)
+
+    def test_first_sync_is_full(self):
+        data = self.sync()
+        self.assertTrue(data['full'])
+        self.assertEqual({(p['type'], p['id']) for p in data['upserted']},
+                         {('source', self.source.pk), ('vendor', self.vendor.pk)})
+
+    def test_only_changes_are_sent(self):
+        cursor = self.sync()['cursor']
+        self.age_everything()
+        self.assertEqual(self.sync(cursor)['upserted'], [])
+
+        self.source.status = 'B'
+        self.source.save()
+        data = self.sync(cursor)
+        self.assertFalse(data['full'])
+        self.assertEqual([(p['id'], p['status']) for p in data['upserted']],
+                         [(self.source.pk, 'Broken/Non-Operational')])
+
+    def test_deleted_source_and_closed_vendor_are_removed(self):
+        cursor = self.sync()['cursor']
+        self.age_everything()
+        source_pk = self.source.pk
+        self.client.force_login(User.objects.create_superuser('admin', password='pass12345'))
+        self.client.post(reverse('water_source_delete', args=[source_pk]))
+        self.vendor.is_open = False
+        self.vendor.save()
+
+        data = self.sync(cursor)
+        self.assertEqual(data['upserted'], [])
+        self.assertEqual(sorted((r['type'], r['id']) for r in data['removed']),
+                         [('source', source_pk), ('vendor', self.vendor.pk)])
+
+    def test_reopened_vendor_is_upserted_not_removed(self):
+        cursor = self.sync()['cursor']
+        self.vendor.is_open = False
+        self.vendor.save()
+        self.vendor.is_open = True
+        self.vendor.save()
+
+        data = self.sync(cursor)
+        self.assertEqual(data['removed'], [])
+        self.assertIn(('vendor', self.vendor.pk), {(p['type'], p['id']) for p in data['upserted']})
+
+    def test_bad_cursor_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {'since': 'yesterday'}).status_code, 400)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DashboardStatsTest(TestCase):
+    # Session, user, vendor-profile check, the stats aggregate and the
+    # open-issue list. Must not grow with the number of issues.
+    MAX_STAFF_DASHBOARD_QUERIES = 5
+
+    def setUp(self):
+        cache.clear()
+        self.staff = User.objects.create_user('tech', password='pass12345', is_staff=True)
+        self.source = WaterSource.objects.create(
+            name="Kibera Tap", source_type="TP", latitude=-1.3128, longitude=36.7880
+        )
+        WaterSource.objects.create(
+            name="Likoni Borehole", source_type="BH", latitude=-4.0803, longitude=39.6620, status='B'
+        )
+        vendor = WaterVendor.objects.create(
+            user=User.objects.create_user('vendor', password='pass12345'),
+            business_name="Maji Safi", phone_number="0712345678", location_name="Kibera"
+        )
+        for i in range(5):
+            IssueReport.objects.create(water_source=self.source, description=f"Leak {i}")
+            IssueReport.objects.create(vendor=vendor, description=f"Pump {i}")
+        IssueReport.objects.create(water_source=self.source, description="Fixed", is_resolved=True)
+
+    def test_counters(self):
+        stats = compute_dashboard_stats()
+        self.assertEqual(stats['total_sources'], 2)
+        self.assertEqual(stats['open_issues'], 10)
+        self.assertEqual(stats['operational_sources'], 1)
+        self.assertEqual(stats['status_counts'], [{'status': 'O', 'count': 1}, {'status': 'B', 'count': 1}])
+        self.assertEqual(
+            stats['source_type_counts'], [{'source_type': 'BH', 'count': 1}, {'source_type': 'TP', 'count': 1}]
+        )
+
+    def test_counters_without_sources(self):
+        WaterSource.objects.all().delete()
+        self.assertEqual(compute_dashboard_stats()['open_issues'], 5)
+
+    def test_cached_counters_follow_new_issues(self):
+        self.assertEqual(get_dashboard_stats()['open_issues'], 10)
+        with self.captureOnCommitCallbacks(execute=True):
+            IssueReport.objects.create(water_source=self.source, description="New leak")
+        self.assertEqual(get_dashboard_stats()['open_issues'], 11)
+
+    def test_staff_dashboard_query_budget(self):
+        self.client.force_login(self.staff)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['open_issues']), 10)
+        self.assertLessEqual(len(queries), self.MAX_STAFF_DASHBOARD_QUERIES)
+
+
+class VendorClickStatsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('vendor', password='pass12345')
+        self.vendor = WaterVendor.objects.create(
+            user=self.user, business_name="Maji Safi", phone_number="0712345678", location_name="Kibera"
+        )
+
+    def test_clicks_roll_up_into_daily_buckets(self):
+        url = reverse('track_vendor_click', args=[self.vendor.pk])
+        buffer = ClickBuffer(autostart=False)
+        with mock.patch('waterapp.views.click_buffer', buffer):
+            for _ in range(3):
+                self.assertEqual(self.client.get(url).status_code, 202)
+        self.assertEqual(VendorClickLog.objects.count(), 0)
+        self.assertEqual(buffer.flush(), 3)
+
+        bucket = VendorDailyStats.objects.get(vendor=self.vendor)
+        self.assertEqual((bucket.date, bucket.clicks), (timezone.localdate(), 3))
+        self.assertEqual(VendorClickLog.objects.count(), 3)
+
+    def test_full_buffer_drops_clicks(self):
+        buffer = ClickBuffer(max_pending=2, autostart=False)
+        url = reverse('track_vendor_click', args=[self.vendor.pk])
+        with mock.patch('waterapp.views.click_buffer', buffer):
+            codes = [self.client.get(url).status_code for _ in range(3)]
+        self.assertEqual(codes, [202, 202, 503])
+        self.assertEqual(buffer.stats()['dropped'], 1)
+        self.assertEqual(buffer.stats()['pending'], 2)
+
+    def test_clicks_for_unknown_vendors_are_skipped(self):
+        buffer = ClickBuffer(autostart=False)
+        buffer.add(self.vendor.pk)
+        buffer.add(self.vendor.pk + 1000)
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.stats()['unknown_vendor'], 1)
+        self.assertEqual(VendorDailyStats.objects.get(vendor=self.vendor).clicks, 1)
+
+    def test_vendor_chart_reads_rollup(self):
+        today = timezone.localdate()
+        VendorDailyStats.objects.create(vendor=self.vendor, date=today, clicks=4)
+        VendorDailyStats.objects.create(vendor=self.vendor, date=today - timedelta(days=2), clicks=2)
+        VendorDailyStats.objects.create(vendor=self.vendor, date=today - timedelta(days=9), clicks=50)
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['chart_data'], [0, 0, 0, 0, 2, 0, 4])
+        self.assertEqual(response.context['total_clicks_7days'], 6)
+
+    def test_compaction_prunes_old_logs_and_rebuilds(self):
+        write_clicks([(self.vendor.pk, timezone.now())] * 2)
+        old = VendorClickLog.objects.create(vendor=self.vendor)
+        VendorClickLog.objects.filter(pk=old.pk).update(timestamp=timezone.now() - timedelta(days=40))
+        VendorDailyStats.objects.filter(vendor=self.vendor).update(clicks=99)
+
+        rebuilt, deleted = compact_click_logs(keep_days=30, rebuild=True)
+        self.assertEqual((rebuilt, deleted), (1, 1))
+        self.assertEqual(VendorDailyStats.objects.get(vendor=self.vendor).clicks, 2)
+
+
+class VendorRatingTest(TestCase):
+    def setUp(self):
+        self.vendor = WaterVendor.objects.create(
+            user=User.objects.create_user('vendor', password='pass12345'),
+            business_name="Maji Safi", phone_number="0712345678", location_name="Kibera",
+            is_verified=True
+        )
+        self.other = WaterVendor.objects.create(
+            user=User.objects.create_user('vendor2', password='pass12345'),
+            business_name="Blue Drop", phone_number="0722345678", location_name="Kasarani",
+            is_verified=True
+        )
+        self.author = User.objects.create_user('resident', password='pass12345')
+
+    def review(self, vendor, rating):
+        return VendorReview.objects.create(vendor=vendor, author=self.author, rating=rating, comment="ok")
+
+    def test_counters_follow_review_changes(self):
+        first = self.review(self.vendor, 5)
+        self.review(self.vendor, 2)
+        self.vendor.refresh_from_db()
+        self.assertEqual((self.vendor.rating_count, self.vendor.rating_sum, self.vendor.average_rating), (2, 7, 3.5))
+
+        first.rating = 3
+        first.save()
+        first = VendorReview.objects.get(pk=first.pk)
+        first.delete()
+        self.vendor.refresh_from_db()
+        self.assertEqual((self.vendor.rating_count, self.vendor.rating_sum), (1, 2))
+
+    def test_recompute_repairs_drift(self):
+        self.review(self.vendor, 4)
+        WaterVendor.objects.update(rating_count=9, rating_sum=1)
+        before = get_version('vendors')
+        with self.captureOnCommitCallbacks(execute=True):
+            recompute_ratings()
+        self.assertNotEqual(get_version('vendors'), before)
+        self.vendor.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.vendor.rating_count, self.vendor.rating_sum), (1, 4))
+        self.assertEqual((self.other.rating_count, self.other.rating_sum), (0, 0))
+
+    def test_vendor_list_sorts_by_rating(self):
+        self.review(self.vendor, 2)
+        self.review(self.other, 5)
+        response = self.client.get(reverse('vendor_list'), {'sort': 'rating'})
+        self.assertEqual([v.pk for v in response.context['vendors']], [self.other.pk, self.vendor.pk])
+
+    def test_profile_reads_counters(self):
+        self.review(self.vendor, 4)
+        self.review(self.vendor, 5)
+        # The vendor, then its reviews with their authors; no per-review queries.
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('vendor_public_profile', args=[self.vendor.pk]))
+        self.assertEqual(response.context['average_rating'], 4.5)
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('resident', password='pass12345')
+        self.source = WaterSource.objects.create(
+            name="Kiosk", source_type='KIOSK', latitude=-1.28, longitude=36.82, status='O'
+        )
+        # Several reports share a timestamp, so the id tie-break matters.
+        moments = [timezone.now() - timedelta(hours=h // 2) for h in range(7)]
+        self.issues = []
+        for moment in moments:
+            issue = IssueReport.objects.create(water_source=self.source, reporter=self.user, description="Broken tap")
+            IssueReport.objects.filter(pk=issue.pk).update(reported_at=moment)
+            self.issues.append(issue.pk)
+        self.client.login(username='resident', password='pass12345')
+
+    def walk(self, per_page):
+        seen, cursor = [], None
+        while True:
+            page = keyset_page(IssueReport.objects.all(), ('-reported_at', '-id'), cursor, per_page=per_page)
+            seen += [issue.pk for issue in page.items]
+            if not page.has_next:
+                return seen
+            cursor = page.next_cursor
+
+    def test_pages_cover_every_row_once_in_order(self):
+        expected = list(IssueReport.objects.order_by('-reported_at', '-id').values_list('pk', flat=True))
+        for per_page in (1, 2, 3, 7, 10):
+            self.assertEqual(self.walk(per_page), expected)
+
+    def test_rejects_garbage_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            keyset_page(IssueReport.objects.all(), ('-reported_at', '-id'), 'not-a-cursor')
+        response = self.client.get(reverse('my_issues_api'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_cursor_with_bad_values(self):
+        for values in (["notadate", 1], ["2024-01-01T00:00:00", "x"], [None, 1]):
+            cursor = encode_cursor(values)
+            with self.assertRaises(InvalidCursor):
+                keyset_page(IssueReport.objects.all(), ('-reported_at', '-id'), cursor)
+            self.assertEqual(self.client.get(reverse('my_issues_api'), {'cursor': cursor}).status_code, 400)
+            self.assertEqual(self.client.get(reverse('transaction_history'), {'cursor': cursor}).status_code, 404)
+
+    def test_json_feed_follows_cursor(self):
+        first = self.client.get(reverse('my_issues_api')).json()
+        self.assertEqual(len(first['results']), 7)
+        self.assertIsNone(first['next_cursor'])
+        self.assertEqual(first['results'][0]['target'], "Kiosk")
+
+    def test_dashboard_shows_older_link(self):
+        with mock.patch('waterapp.pagination.PAGE_SIZE', 5):
+            response = self.client.get(reverse('dashboard'))
+            self.assertEqual(len(response.context['user_issues']), 5)
+            cursor = response.context['next_cursor']
+            rest = self.client.get(reverse('dashboard'), {'cursor': cursor})
+        self.assertEqual(len(rest.context['user_issues']), 2)
+        self.assertIsNone(rest.context['next_cursor'])
+
+    def test_review_feed(self):
+        vendor = WaterVendor.objects.create(
+            user=User.objects.create_user('vendor', password='pass12345'),
+            business_name="Maji Safi", phone_number="0712345678", location_name="Kibera", is_verified=True
+        )
+        for rating in (3, 4, 5):
+            VendorReview.objects.create(vendor=vendor, author=self.user, rating=rating, comment="ok")
+        data = self.client.get(reverse('vendor_reviews_api', args=[vendor.pk])).json()
+        self.assertEqual([r['rating'] for r in data['results']], [5, 4, 3])
+
+
+class EmailOutboxTest(TestCase):
+    def setUp(self):
+        for name in ('tech1', 'tech2'):
+            User.objects.create_user(name, email=f'{name}@example.com', password='pass12345', is_staff=True)
+        self.resident = User.objects.create_user('resident', password='pass12345')
+        self.source = WaterSource.objects.create(
+            name="Kiosk", source_type='KIOSK', latitude=-1.28, longitude=36.82, status='O'
+        )
+
+    def test_report_queues_instead_of_sending(self):
+        self.client.login(username='resident', password='pass12345')
+        response = self.client.post(reverse('issue_report_create'), {
+            'water_source': self.source.pk, 'description': "Tap broken", 'priority_level': 2,
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(
+            sorted(OutboundEmail.objects.values_list('recipient', flat=True)),
+            ['tech1@example.com', 'tech2@example.com']
+        )
+
+        self.assertEqual(process_outbox(workers=1), {'sent': 2, 'retry': 0, 'failed': 0})
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['tech1@example.com', 'tech2@example.com'])
+        self.assertFalse(OutboundEmail.objects.exclude(status=OutboundEmail.SENT).exists())
+
+    def test_batch_reuses_one_connection(self):
+        queue_email("Hello", "Body", [f'user{i}@example.com' for i in range(5)])
+        with mock.patch('waterapp.outbox.get_connection', wraps=mail.get_connection) as get_connection:
+            process_outbox(batch_size=5, workers=1)
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_failures_back_off_then_give_up(self):
+        email, = queue_email("Hello", "Body", ['tech1@example.com'])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError("down")):
+            self.assertEqual(process_outbox(workers=1)['retry'], 1)
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts, email.last_error), ('pending', 1, "down"))
+            self.assertGreater(email.next_attempt_at, timezone.now())
+            # Not due yet, so nothing is retried immediately.
+            self.assertEqual(process_outbox(workers=1)['retry'], 0)
+
+            OutboundEmail.objects.update(attempts=MAX_ATTEMPTS - 1, next_attempt_at=timezone.now())
+            self.assertEqual(process_outbox(workers=1)['failed'], 1)
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.FAILED)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        User.objects.create_user('staff', password='pass12345', is_staff=True)
+        self.client.login(username='staff', password='pass12345')
+        self.source = WaterSource.objects.create(
+            name="Kiosk", source_type='KIOSK', latitude=-1.28, longitude=36.82, status='O'
+        )
+        vendor = WaterVendor.objects.create(
+            user=User.objects.create_user('vendor', password='pass12345'),
+            business_name="Maji Safi", phone_number="0712345678", location_name="Kibera"
+        )
+        IssueReport.objects.create(water_source=self.source, description="Tap broken")
+        IssueReport.objects.create(vendor=vendor, description="Pump down")
+        IssueReport.objects.create(water_source=self.source, description="Fixed", is_resolved=True)
+        old = IssueReport.objects.create(water_source=self.source, description="Last year")
+        IssueReport.objects.filter(pk=old.pk).update(reported_at=timezone.now() - timedelta(days=400))
+        MpesaTransaction.objects.create(phone_number="254712345678", amount=50, status="Pending (STK Sent)")
+        MpesaTransaction.objects.create(phone_number="254712345678", amount=70, status="Completed")
+
+    def rows(self, response):
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content).decode()
+        return list(csv.reader(io.StringIO(content)))
+
+    def test_open_issues_include_vendor_issues(self):
+        rows = self.rows(self.client.get(reverse('export_issues_csv')))
+        self.assertEqual(rows[0][:2], ['ID', 'Source'])
+        self.assertEqual(sorted(row[1] for row in rows[1:]), ["Kiosk", "Kiosk", "Maji Safi"])
+
+    def test_date_and_status_filters(self):
+        today = timezone.localdate().isoformat()
+        rows = self.rows(self.client.get(reverse('export_data', args=['issues']), {'start': today, 'end': today}))
+        self.assertEqual(len(rows) - 1, 3)
+        rows = self.rows(self.client.get(reverse('export_data', args=['payments']), {'status': 'pending'}))
+        self.assertEqual([row[3] for row in rows[1:]], ['50.00'])
+        MpesaTransaction.objects.create(phone_number="254712345678", amount=90, status=MpesaTransaction.QUEUED)
+        rows = self.rows(self.client.get(reverse('export_data', args=['payments']), {'status': 'Queued'}))
+        self.assertEqual([row[3] for row in rows[1:]], ['90.00'])
+
+    def test_xlsx(self):
+        from openpyxl import load_workbook
+
+        RepairLog.objects.create(water_source=self.source, work_done="New tap", cost=1500)
+        response = self.client.get(reverse('export_data', args=['repairs']), {'format': 'xlsx'})
+        self.assertEqual(response.status_code, 200)
+        sheet = load_workbook(io.BytesIO(b''.join(response.streaming_content))).active
+        self.assertEqual([cell.value for cell in sheet[2]][1:3], ["Kiosk", None])
+        self.assertEqual(sheet.max_row, 2)
+
+    def test_rejects_bad_input_and_non_staff(self):
+        url = reverse('export_data', args=['issues'])
+        self.assertEqual(self.client.get(url, {'start': '2025-13-01'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'status': 'maybe'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'format': 'pdf'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('export_data', args=['users'])).status_code, 400)
+        User.objects.create_user('resident', password='pass12345')
+        self.client.login(username='resident', password='pass12345')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.borehole = WaterSource.objects.create(
+            name="Kibera Borehole", source_type='BH', latitude=-1.31, longitude=36.79,
+            description="Deep well near the chief's camp"
+        )
+        self.tap = WaterSource.objects.create(
+            name="Olympic Tap", source_type='TP', latitude=-1.30, longitude=36.78,
+            description="Shared tap beside the borehole road"
+        )
+        self.vendor = WaterVendor.objects.create(
+            user=User.objects.create_user('vendor', password='pass12345'),
+            business_name="Maji Safi Refills", phone_number="0712345678", location_name="Kasarani",
+            is_verified=True
+        )
+
+    def names(self, kind, query, **kwargs):
+        return [getattr(obj, 'name', None) or obj.business_name for obj in search(kind, query, **kwargs)]
+
+    def test_ranks_name_matches_first_and_tolerates_typos(self):
+        self.assertEqual(self.names('source', "borehole"), ["Kibera Borehole", "Olympic Tap"])
+        self.assertEqual(self.names('source', "borehlle")[0], "Kibera Borehole")
+        self.assertEqual(self.names('vendor', "kasarni"), ["Maji Safi Refills"])
+        self.assertEqual(self.names('source', "xyzzy"), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.tap.name = "Olympic Kiosk"
+        self.tap.save()
+        self.assertEqual(self.names('source', "kiosk"), ["Olympic Kiosk"])
+        # Saves that do not touch searchable fields leave the index alone.
+        with self.assertNumQueries(1):
+            self.tap.save(update_fields=['status'])
+        self.tap.delete()
+        self.assertFalse(SearchTrigram.objects.filter(kind='source', object_id=self.tap.pk).exists())
+
+    def test_rebuild_matches_incremental_index(self):
+        before = set(SearchTrigram.objects.values_list('kind', 'object_id', 'trigram', 'weight'))
+        self.assertEqual(rebuild_index(), 3)
+        self.assertEqual(set(SearchTrigram.objects.values_list('kind', 'object_id', 'trigram', 'weight')), before)
+
+    def test_prefix_trigrams(self):
+        self.assertEqual(trigrams("Bor", prefix=True), {'  b', ' bo', 'bor'})
+        self.assertIn('or ', trigrams("Bor"))
+
+    def test_list_views_and_autocomplete(self):
+        response = self.client.get(reverse('water_source_list'), {'q': 'kibera'})
+        self.assertEqual([s.pk for s in response.context['sources']], [self.borehole.pk])
+        response = self.client.get(reverse('vendor_list'), {'q': 'maji'})
+        self.assertEqual([v.pk for v in response.context['vendors']], [self.vendor.pk])
+
+        results = self.client.get(reverse('search_suggestions'), {'q': 'bore'}).json()['results']
+        self.assertEqual(results[0]['label'], "Kibera Borehole")
+        self.assertEqual(results[0]['url'], reverse('water_source_detail', args=[self.borehole.pk]))
+        results = self.client.get(reverse('search_suggestions'), {'q': 'maji', 'kind': 'vendor'}).json()['results']
+        self.assertEqual([r['type'] for r in results], ['vendor'])
+
+
+class NearestWaterTest(TestCase):
+    def setUp(self):
+        # Sources strung out east of the user at known spacings.
+        self.here = (-1.2921, 36.8219)
+        for i, (offset, status) in enumerate([(0.001, 'B'), (0.002, 'O'), (0.01, 'O'), (0.05, 'O'), (1.0, 'O')]):
+            WaterSource.objects.create(
+                name=f"Source {i}", source_type='TP', latitude=self.here[0],
+                longitude=round(self.here[1] + offset, 6), status=status
+            )
+        self.near = self.vendor('near', 0.003, price=80, fee=50)
+        self.cheap = self.vendor('cheap', 0.02, price=40, fee=0)
+        self.vendor('closed', 0.001, price=10, fee=0, is_open=False)
+
+    def vendor(self, name, offset, price, fee, is_open=True):
+        return WaterVendor.objects.create(
+            user=User.objects.create_user(name, password='pass12345'), business_name=name,
+            phone_number="0712345678", location_name="Nairobi", latitude=self.here[0],
+            longitude=round(self.here[1] + offset, 6), price_per_20l=price, delivery_fee=fee,
+            is_open=is_open, is_verified=True
+        )
+
+    def get(self, **params):
+        return self.client.get(reverse('nearest_water'), {'lat': self.here[0], 'lon': self.here[1], **params})
+
+    def test_nearest_operational_sources_and_open_vendors(self):
+        data = self.get(k=3).json()
+        self.assertEqual([s['name'] for s in data['sources']], ["Source 1", "Source 2", "Source 3"])
+        self.assertAlmostEqual(data['sources'][0]['distance_km'], 0.222, places=2)
+        self.assertEqual([v['name'] for v in data['vendors']], ["near", "cheap"])
+
+    def test_search_widens_until_k_found(self):
+        hits = k_nearest(WaterSource.objects.filter(status='O'), *self.here, 4, ('name',))
+        self.assertEqual([row[2] for row, _ in hits], ["Source 1", "Source 2", "Source 3", "Source 4"])
+        self.assertGreater(hits[-1][1], 100)
+
+    def test_vendors_by_total_cost(self):
+        data = self.get(kind='vendor', sort='cost', qty=2).json()
+        self.assertNotIn('sources', data)
+        self.assertEqual([(v['name'], v['total_cost']) for v in data['vendors']], [("cheap", 80.0), ("near", 210.0)])
+
+    def test_rejects_bad_parameters(self):
+        self.assertEqual(self.client.get(reverse('nearest_water')).status_code, 400)
+        self.assertEqual(self.get(k=0).status_code, 400)
+        self.assertEqual(self.get(kind='river').status_code, 400)
+
+
+def zip_bytes(files):
+    import zipfile
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+class SourceImportTest(TestCase):
+    CSV = (
+        "Name,Type,Lat,Lng,Status,Description\n"
+        "Kibera Borehole,Borehole,-1.3123456789,36.7812345,,Deep well\n"
+        "Olympic Tap,TP,-1.3000,36.7800,M,\n"
+        "Same Tap Again,TP,-1.30001,36.78001,O,\n"
+        "Nowhere,Well,95,36.8,,\n"
+        ",Lake,-1.2,36.8,,\n"
+    )
+
+    def run_import(self, text=CSV, name='survey.csv', **kwargs):
+        return import_sources(io.BytesIO(text.encode()), name, **kwargs)
+
+    def test_validates_dedupes_and_creates(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            result = self.run_import()
+        self.assertEqual((result.rows, result.created, result.updated), (5, 2, 0))
+        self.assertEqual([number for number, _ in result.problems], [4, 5, 6])
+        self.assertIn("Duplicate of row 3", result.problems[0][1])
+        self.assertIn("latitude", result.problems[1][1])
+
+        borehole = WaterSource.objects.get(name="Kibera Borehole")
+        self.assertEqual((borehole.source_type, borehole.status), ('BH', 'O'))
+        self.assertEqual(str(borehole.latitude), '-1.312346')
+        self.assertEqual(borehole.geokey, geo.encode(borehole.latitude, borehole.longitude))
+        # Derived data that save() would have maintained.
+        self.assertEqual(MapCluster.objects.filter(level=5).aggregate(n=Sum('count'))['n'], 2)
+        self.assertEqual([s.pk for s in search('source', "kibera")], [borehole.pk])
+
+    def test_near_existing_source_updates_it(self):
+        existing = WaterSource.objects.create(
+            name="Old Name", source_type='TP', latitude=-1.3, longitude=36.78, status='B'
+        )
+        result = self.run_import("name,source_type,latitude,longitude,status\nOlympic Tap,TP,-1.30005,36.78,O\n")
+        self.assertEqual((result.created, result.updated), (0, 1))
+        existing.refresh_from_db()
+        self.assertEqual((existing.name, existing.status), ("Olympic Tap", 'O'))
+
+    def test_import_retires_the_cached_source_list(self):
+        cache.clear()
+        WaterSource.objects.create(name="Alpha Tap", source_type='TP', latitude=-1.2, longitude=36.9)
+        url = reverse('water_source_list')
+        self.assertEqual(len(self.client.get(url).context['sources']), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.run_import()
+        self.assertContains(self.client.get(url), "Olympic Tap")
+
+    def test_xlsx_and_bad_files(self):
+        from openpyxl import Workbook
+
+        workbook = Workbook()
+        workbook.active.append(['name', 'source_type', 'latitude', 'longitude'])
+        workbook.active.append(['Spring', 'WL', -0.5, 37.1])
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        buffer.seek(0)
+        self.assertEqual(import_sources(buffer, 'survey.xlsx').created, 1)
+
+        with self.assertRaises(ImportFileError):
+            self.run_import("name,latitude\nA,1\n")
+        with self.assertRaises(ImportFileError):
+            self.run_import(name='survey.txt')
+
+    def test_unreadable_files_import_nothing(self):
+        # Far enough down that the first batches are read before the bad byte.
+        rows = ''.join(f"Tap {n},TP,{-1 - n / 100:.2f},{36 + n / 100:.2f},,\n" for n in range(400))
+        latin1 = (self.CSV + rows + "Café Tap,TP,-1.2,36.9,,\n").encode('latin-1')
+        with self.assertRaisesMessage(ImportFileError, "UTF-8"):
+            import_sources(io.BytesIO(latin1), 'survey.csv', batch_size=50)
+        with self.assertRaisesMessage(ImportFileError, "not valid CSV"):
+            self.run_import(self.CSV + f"Long Tap,TP,-1.2,36.9,,{'x' * (csv.field_size_limit() + 1)}\n")
+        for junk in (self.CSV.encode(), zip_bytes({'hello.txt': 'not a workbook'})):
+            with self.assertRaisesMessage(ImportFileError, ".xlsx workbook"):
+                import_sources(io.BytesIO(junk), 'survey.xlsx')
+        self.assertFalse(WaterSource.objects.exists())
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass12345')
+        self.client.login(username='admin', password='pass12345')
+        response = self.client.post(
+            reverse('admin:waterapp_watersource_import'), {'file': SimpleUploadedFile('survey.csv', latin1)}
+        )
+        self.assertFormError(response.context['form'], 'file', "The file is not UTF-8 text; save it as UTF-8 CSV.")
+
+    def test_command_writes_report(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path, report = f"{tmp}/survey.csv", f"{tmp}/report.csv"
+            with open(path, 'w') as f:
+                f.write(self.CSV)
+            call_command('import_sources', path, '--report', report, stdout=io.StringIO())
+            with open(report) as f:
+                self.assertEqual(len(list(csv.reader(f))), 4)
+        self.assertEqual(WaterSource.objects.count(), 2)
+
+    def test_admin_upload(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass12345')
+        self.client.login(username='admin', password='pass12345')
+        url = reverse('admin:waterapp_watersource_import')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        response = self.client.post(url, {'file': SimpleUploadedFile('survey.csv', self.CSV.encode())})
+        self.assertEqual(response.context['result'].created, 2)
+        self.assertContains(response, "Duplicate of row 3")
+
+
+class AnalyticsRollupTest(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user('analyst', password='pw', is_staff=True)
+        self.source = WaterSource.objects.create(name="Kibera Tap", source_type="TP", latitude=-1.31, longitude=36.78)
+        self.today = timezone.localdate()
+        self.day1 = self.today - timedelta(days=3)
+        self.day2 = self.day1 + timedelta(days=1)
+        # The source has been operational since well before the report period.
+        WaterSourceStatusEvent.objects.filter(source=self.source).update(at=self.at(self.day1, 0) - timedelta(days=7))
+
+    def at(self, day, hour):
+        return timezone.make_aware(timezone.datetime.combine(day, timezone.datetime.min.time()).replace(hour=hour))
+
+    def status(self, status, at):
+        WaterSourceStatusEvent.objects.create(source=self.source, status=status, at=at)
+
+    def issue(self, reported_at, resolved_at=None, priority=1):
+        issue = IssueReport.objects.create(water_source=self.source, description="Dry", priority_level=priority)
+        IssueReport.objects.filter(pk=issue.pk).update(
+            reported_at=reported_at, resolved_at=resolved_at, is_resolved=resolved_at is not None
+        )
+        return issue
+
+    def test_resolving_records_the_time(self):
+        issue = IssueReport.objects.create(water_source=self.source, description="Leak")
+        self.assertIsNone(issue.resolved_at)
+        issue.is_resolved = True
+        issue.save(update_fields=['is_resolved'])
+        issue.refresh_from_db()
+        self.assertIsNotNone(issue.resolved_at)
+        issue.is_resolved = False
+        issue.save()
+        self.assertIsNone(IssueReport.objects.get(pk=issue.pk).resolved_at)
+
+    def test_rollup_splits_downtime_and_counts_facts(self):
+        # Down from 20:00 to 02:00 the next day; Maintenance -> Broken is still down.
+        self.status('M', self.at(self.day1, 20))
+        self.status('B', self.at(self.day1, 23))
+        self.status('O', self.at(self.day2, 2))
+        self.issue(self.at(self.day1, 20), self.at(self.day2, 2))
+        self.issue(self.at(self.day1, 23), self.at(self.day2, 1))
+        self.issue(self.at(self.day2, 9))
+        RepairLog.objects.create(water_source=self.source, repair_date=self.day2, work_done="Pipe", cost=1500)
+        RepairLog.objects.create(water_source=self.source, repair_date=self.day2, work_done="Valve", cost=500)
+
+        # History starts with the source's first status event.
+        self.assertEqual(refresh_analytics(), (self.day1 - timedelta(days=7), self.today))
+        first = SourceDailyStats.objects.get(source=self.source, day=self.day1)
+        second = SourceDailyStats.objects.get(source=self.source, day=self.day2)
+        self.assertAlmostEqual(first.downtime_hours, 4)
+        self.assertAlmostEqual(second.downtime_hours, 2)
+        self.assertEqual((first.issues_opened, first.issues_resolved), (2, 0))
+        self.assertEqual((second.issues_opened, second.issues_resolved), (1, 2))
+        self.assertAlmostEqual(second.resolution_hours, 6 + 2)
+        self.assertEqual((second.repairs, second.repair_cost), (2, 2000))
+
+        per_type = SourceTypeDailyStats.objects.get(source_type='TP', day=self.day2)
+        self.assertEqual((per_type.sources, per_type.issues_resolved), (1, 2))
+        self.assertEqual(RollupWatermark.objects.get().rolled_through, self.today)
+
+    def test_down_source_accrues_until_now_and_refresh_is_incremental(self):
+        self.status('B', self.at(self.day2, 12))
+        self.issue(self.at(self.day2, 12))
+        refresh_analytics()
+        self.assertAlmostEqual(SourceDailyStats.objects.get(day=self.day2).downtime_hours, 12)
+        self.assertTrue(SourceDailyStats.objects.filter(day=self.today, downtime_hours__gt=0).exists())
+
+        # A later run only re-rolls from the watermark, leaving older days alone.
+        SourceDailyStats.objects.filter(day=self.day2).update(issues_opened=99)
+        self.assertEqual(refresh_analytics()[0], self.today - timedelta(days=1))
+        self.assertEqual(SourceDailyStats.objects.get(day=self.day2).issues_opened, 99)
+        refresh_analytics(since=self.day1)
+        self.assertEqual(SourceDailyStats.objects.get(day=self.day2).issues_opened, 1)
+
+    def test_api_reads_rollups(self):
+        self.status('M', self.at(self.day1, 8))
+        self.status('O', self.at(self.day1, 12))
+        self.issue(self.at(self.day1, 8), self.at(self.day1, 12))
+        refresh_analytics()
+        self.client.force_login(self.staff)
+        url = reverse('analytics_api')
+        params = {'start': self.day1.isoformat(), 'end': self.today.isoformat()}
+
+        with CaptureQueriesContext(connection) as queries:
+            payload = self.client.get(url, params).json()
+        self.assertFalse([q for q in queries if 'waterapp_issuereport' in q['sql']])
+        self.assertEqual(payload['totals']['downtime_hours'], 4)
+        self.assertEqual(payload['totals']['mttr_hours'], 4)
+        self.assertEqual(len(payload['series']), 4)
+        self.assertEqual(payload['by_type'][0]['label'], 'Tap')
+        self.assertEqual(payload['worst_sources'][0]['name'], 'Kibera Tap')
+
+        self.assertEqual(self.client.get(url, {'type': 'XX'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('analytics')).status_code, 200)
+        self.client.force_login(User.objects.create_user('resident', password='pw'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+
+class StatusEventLogTest(TestCase):
+    def setUp(self):
+        self.source = WaterSource.objects.create(name="Kibera Tap", source_type="TP", latitude=-1.31, longitude=36.78)
+
+    def test_status_changes_are_logged_without_extra_selects(self):
+        source = WaterSource.objects.get(pk=self.source.pk)
+        with CaptureQueriesContext(connection) as queries:
+            source.status = 'B'
+            source.save()
+        self.assertFalse([q for q in queries if q['sql'].startswith('SELECT') and 'waterapp_watersource"' in q['sql']])
+        source.name = "Renamed"
+        source.save()
+
+        IssueReport.objects.create(water_source=source, description="Dry", priority_level=3)
+        events = list(WaterSourceStatusEvent.objects.filter(source=source).values_list('previous_status', 'status'))
+        self.assertEqual(events, [('', 'O'), ('O', 'B'), ('B', 'M')])
+
+        event = WaterSourceStatusEvent.objects.last()
+        with self.assertRaises(ValueError):
+            event.save()
+
+    def test_status_at_and_downtime(self):
+        start = timezone.now() - timedelta(days=2)
+        WaterSourceStatusEvent.objects.filter(source=self.source).update(at=start)
+        for hours, status in ((2, 'M'), (5, 'B'), (8, 'O'), (30, 'C')):
+            WaterSourceStatusEvent.objects.create(source=self.source, status=status, at=start + timedelta(hours=hours))
+
+        self.assertIsNone(status_at(self.source, start - timedelta(seconds=1)))
+        self.assertEqual(status_at(self.source, start + timedelta(hours=1)), 'O')
+        self.assertEqual(status_at(self.source, start + timedelta(hours=5)), 'B')
+        self.assertAlmostEqual(downtime(self.source, start, start + timedelta(hours=10)), 6)
+        # Starting mid-outage, and an outage still running at the end of the range.
+        self.assertAlmostEqual(downtime(self.source, start + timedelta(hours=4), start + timedelta(hours=32)), 6)
+
+    def test_import_logs_new_and_changed_statuses(self):
+        data = "name,source_type,latitude,longitude,status\nKibera Tap,TP,-1.31,36.78,Broken/Non-Operational\nNew Well,WL,-1.5,36.9,O\n"
+        import_sources(io.BytesIO(data.encode()), 'survey.csv')
+        self.assertEqual(
+            sorted(WaterSourceStatusEvent.objects.values_list('source__name', 'previous_status', 'status')),
+            [('Kibera Tap', '', 'O'), ('Kibera Tap', 'O', 'B'), ('New Well', '', 'O')],
+        )
+
+
+class RepairServiceTest(TestCase):
+    def setUp(self):
+        self.tech = User.objects.create_user('tech', password='pw', is_staff=True)
+        self.source = WaterSource.objects.create(name="Kibera Tap", source_type="TP", latitude=-1.31, longitude=36.78)
+        IssueReport.objects.create(water_source=self.source, description="Dry", priority_level=3)
+        IssueReport.objects.create(water_source=self.source, description="Leak")
+        self.client.force_login(self.tech)
+
+    def test_repair_resolves_issues_and_sends_one_event(self):
+        events = []
+        handler = lambda **kwargs: events.append(kwargs)
+        repair_completed.connect(handler)
+        self.addCleanup(repair_completed.disconnect, handler)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('repair_log_create', args=[self.source.pk]), {'work_done': "New pump", 'cost': '1500'}
+            )
+        self.assertRedirects(response, reverse('water_source_detail', args=[self.source.pk]))
+        self.source.refresh_from_db()
+        self.assertEqual(self.source.status, 'O')
+        self.assertFalse(self.source.issues.filter(is_resolved=False).exists())
+        self.assertFalse(self.source.issues.filter(resolved_at=None).exists())
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['resolved_issues'], 2)
+        self.assertEqual(events[0]['repair'].technician, self.tech)
+
+    def test_toggle_writes_only_the_resolution_columns(self):
+        issue = self.source.issues.first()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('issue_toggle_resolve', args=[issue.pk]))
+        update = next(q['sql'] for q in queries if q['sql'].startswith('UPDATE "waterapp_issuereport"'))
+        self.assertNotIn('"description"', update)
+        issue.refresh_from_db()
+        self.assertTrue(issue.is_resolved)
+        self.assertIsNotNone(issue.resolved_at)
+
+
+def retry_when_locked(func, attempts=50):
+    """
+    The in-memory SQLite test database reports lock conflicts immediately
+    instead of waiting; retry the (rolled back) transaction like a client would.
+    """
+    for attempt in range(attempts):
+        try:
+            return func()
+        except OperationalError as e:
+            if 'locked' not in str(e) or attempt == attempts - 1:
+                raise
+            time.sleep(0.01)
+
+
+class ConcurrentRepairTest(TransactionTestCase):
+    def test_parallel_repairs_and_reports(self):
+        tech = User.objects.create_user('tech', password='pw')
+        source = WaterSource.objects.create(name="Kibera Tap", source_type="TP", latitude=-1.31, longitude=36.78)
+
+        def repair(i):
+            try:
+                resolved = retry_when_locked(lambda: log_repair(source, RepairLog(work_done=f"Repair {i}"), tech))
+                return 'repair', resolved
+            finally:
+                connection.close()
+
+        def create_report(i):
+            with transaction.atomic():
+                issue = IssueReport(water_source=WaterSource.objects.get(pk=source.pk), description=f"Report {i}")
+                issue.priority_level = 3
+                issue.save()
+
+        def report(i):
+            try:
+                retry_when_locked(lambda: create_report(i))
+                return 'report', 1
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda i: (repair if i % 2 else report)(i), range(20)))
+
+        resolved = sum(count for kind, count in results if kind == 'repair')
+        still_open = IssueReport.objects.filter(is_resolved=False).count()
+        # Every report was either resolved by exactly one repair or is still open.
+        self.assertEqual(resolved + still_open, 10)
+        self.assertEqual(RepairLog.objects.count(), 10)
+        source.refresh_from_db()
+        self.assertEqual(source.status, 'M' if still_open else 'O')
+        events = list(WaterSourceStatusEvent.objects.filter(source=source).values_list('previous_status', 'status'))
+        self.assertTrue(all(previous != status for previous, status in events))
+
+
+class PaymentGatewayTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.daraja = FakeDaraja().start()
+        cls.addClassCleanup(cls.daraja.stop)
+
+    def setUp(self):
+        settings = override_settings(
+            MPESA_API_BASE_URL=self.daraja.url, MPESA_CONSUMER_KEY='key', MPESA_CONSUMER_SECRET='secret',
+            MPESA_PUSH_WORKERS=0,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        reset_gateway()
+        self.addCleanup(reset_gateway)
+        self.daraja.counters.clear()
+        vendor_user = User.objects.create_user('vendor', password='pw')
+        self.vendor = WaterVendor.objects.create(user=vendor_user, business_name="Maji Safi", phone_number="0712345678")
+        self.client.force_login(User.objects.create_user('buyer', password='pw'))
+
+    def test_normalize_phone(self):
+        for raw in ('0712 345 678', '+254712345678', '254712345678', '712345678'):
+            self.assertEqual(normalize_phone(raw), '+254712345678')
+        with self.assertRaises(PaymentError):
+            normalize_phone('12345')
+
+    def test_token_and_connection_are_reused(self):
+        gateway = get_gateway()
+        results = [gateway.stk_push('254712345678', 10, 'Ref', 'Desc') for _ in range(5)]
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(self.daraja.counters['tokens'], 1)
+        self.assertEqual(self.daraja.counters['connections'], 1)
+        self.assertEqual(self.daraja.counters['stk_pushes'], 5)
+
+        # A token Daraja stops accepting early is renewed once and the push retried.
+        self.daraja.expire_tokens()
+        self.assertTrue(gateway.stk_push('254712345678', 10, 'Ref', 'Desc').ok)
+        self.assertEqual(self.daraja.counters['tokens'], 2)
+
+    def test_rejected_and_unreachable(self):
+        self.assertFalse(get_gateway().stk_push(REJECTED_PHONE, 10, 'Ref', 'Desc').ok)
+        offline = DarajaGateway('http://127.0.0.1:9/', 'key', 'secret', '174379', 'pk', 'http://cb/', timeout=1)
+        result = offline.stk_push('254712345678', 10, 'Ref', 'Desc')
+        self.assertFalse(result.ok)
+        self.assertIn("Could not reach", result.message)
+
+    def test_payment_is_queued_then_polled(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(
+                reverse('initiate_payment', args=[self.vendor.pk]), {'phone': '0712345678', 'amount': '150'}
+            )
+        payment = MpesaTransaction.objects.get()
+        self.assertEqual((payment.status, payment.phone_number), ('Queued', '+254712345678'))
+        self.assertEqual(self.daraja.counters['stk_pushes'], 0)
+        status_url = reverse('payment_status_api', args=[payment_reference(payment)])
+        self.assertRedirects(response, reverse('payment_status_page', args=[payment_reference(payment)]))
+        self.assertEqual(self.client.get(status_url).json()['status'], 'Queued')
+
+        for callback in callbacks:
+            callback()
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'Pending (STK Sent)')
+        self.assertTrue(payment.transaction_code.startswith('ws_CO_'))
+        self.assertEqual((self.daraja.pushes[0]['Amount'], self.daraja.pushes[0]['PhoneNumber']), (150, '254712345678'))
+        self.assertEqual(payment.user.username, 'buyer')
+        self.assertFalse(self.client.get(status_url).json()['finished'])
+        self.assertEqual(self.client.get(reverse('payment_status_api', args=[f'{payment.pk}:forged'])).status_code, 404)
+
+    def test_rejected_push_and_invalid_input(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('donate'), {'phone': '0700000000', 'amount': '50'})
+        payment = MpesaTransaction.objects.get()
+        self.assertEqual(payment.status, 'Failed')
+        self.assertIn('Invalid PhoneNumber', payment.result_description)
+
+        response = self.client.post(reverse('donate'), {'phone': '0712345678', 'amount': 'lots'})
+        self.assertRedirects(response, reverse('donate'))
+        self.assertEqual(MpesaTransaction.objects.count(), 1)
+
+    def test_async_client_is_closed_on_its_own_loop_when_replaced(self):
+        gateway = get_gateway()
+        old_loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=old_loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(gateway.aaccess_token(), old_loop).result(5)
+            old_client = gateway._async_client
+            async_to_sync(gateway.aaccess_token)()
+            self.assertIsNot(gateway._async_client, old_client)
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0.05), old_loop).result(5)
+            self.assertTrue(old_client.is_closed)
+        finally:
+            old_loop.call_soon_threadsafe(old_loop.stop)
+            thread.join()
+            old_loop.close()
+
+    async def test_async_push_runs_on_the_event_loop(self):
+        await self.async_client.aforce_login(await User.objects.aget(username='buyer'))
+        response = await self.async_client.post(
+            reverse('initiate_payment', args=[self.vendor.pk]), {'phone': '0712345678', 'amount': '150'}
+        )
+        self.assertEqual(response.status_code, 302)
+        await push_queue.ajoin()
+        payment = await MpesaTransaction.objects.select_related('user').aget()
+        self.assertEqual(payment.status, 'Pending (STK Sent)')
+        self.assertTrue(payment.transaction_code.startswith('ws_CO_'))
+        self.assertEqual(payment.user.username, 'buyer')
+
+        # The async client reuses the token and its connection too.
+        await self.async_client.post(reverse('donate'), {'phone': '0712345678', 'amount': '20'})
+        await push_queue.ajoin()
+        self.assertEqual(self.daraja.counters['tokens'], 1)
+        self.assertEqual(self.daraja.counters['stk_pushes'], 2)
+        self.assertEqual(self.daraja.counters['connections'], 1)
+
+
+def stk_callback(checkout_request_id, result_code=0, receipt='NLJ7RT61SV'):
+    callback = {
+        'MerchantRequestID': 'merchant-1',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == 0 else 'Request cancelled by user',
+    }
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 150},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'PhoneNumber', 'Value': 254712345678},
+        ]}
+    return json.dumps({'Body': {'stkCallback': callback}})
+
+
+class MpesaCallbackTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.daraja = FakeDaraja().start()
+        cls.addClassCleanup(cls.daraja.stop)
+
+    def setUp(self):
+        settings = override_settings(
+            MPESA_API_BASE_URL=self.daraja.url, MPESA_CONSUMER_KEY='key', MPESA_CONSUMER_SECRET='secret',
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        reset_gateway()
+        self.addCleanup(reset_gateway)
+        self.daraja.results.clear()
+        self.url = reverse('mpesa_callback')
+
+    def payment(self, code, status='Pending (STK Sent)', age=timedelta(0)):
+        payment = MpesaTransaction.objects.create(
+            transaction_code=code, phone_number='254712345678', amount=150, status=status
+        )
+        MpesaTransaction.objects.filter(pk=payment.pk).update(created_at=timezone.now() - age)
+        return payment
+
+    def post(self, body):
+        return self.client.post(self.url, body, content_type='application/json')
+
+    def test_callback_is_acknowledged_then_applied_once(self):
+        payment = self.payment('ws_CO_1')
+        with self.assertNumQueries(1):
+            response = self.post(stk_callback('ws_CO_1'))
+        self.assertEqual(response.json(), {'ResultCode': 0, 'ResultDesc': 'Accepted'})
+        self.post(stk_callback('ws_CO_1', receipt='OTHER'))
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+
+        counts = process_callbacks()
+        self.assertEqual((counts['applied'], counts['duplicate']), (1, 1))
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.receipt_number), ('Completed', 'NLJ7RT61SV'))
+
+        # Redelivery after the payment settled changes nothing.
+        self.post(stk_callback('ws_CO_1', result_code=1032))
+        self.assertEqual(process_callbacks()['duplicate'], 1)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'Completed')
+        self.assertFalse(MpesaCallback.objects.filter(processed_at__isnull=True).exists())
+
+    def test_batch_is_applied_in_constant_queries(self):
+        payments = [self.payment(f'ws_CO_{n}') for n in range(20)]
+        for n, payment in enumerate(payments):
+            self.post(stk_callback(payment.transaction_code, result_code=0 if n % 2 else 1032))
+        self.post('not json')
+        with self.assertNumQueries(10):
+            counts = process_callbacks(batch_size=100)
+        self.assertEqual((counts['applied'], counts['invalid']), (20, 1))
+        self.assertEqual(MpesaTransaction.objects.filter(status='Completed').count(), 10)
+        self.assertEqual(MpesaTransaction.objects.filter(status='Cancelled').count(), 10)
+
+    def test_callback_before_its_payment_is_retried(self):
+        self.post(stk_callback('ws_CO_early'))
+        self.assertEqual(process_callbacks()['waiting'], 1)
+        payment = self.payment('ws_CO_early')
+        self.assertEqual(process_callbacks()['applied'], 1)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'Completed')
+
+        self.post(stk_callback('ws_CO_unknown'))
+        MpesaCallback.objects.filter(outcome='').update(received_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(process_callbacks()['orphan'], 1)
+
+    def test_oversized_callback_is_refused(self):
+        response = self.post('x' * 70000)
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(MpesaCallback.objects.exists())
+
+    def test_sweeper_queries_overdue_payments(self):
+        overdue = self.payment('ws_CO_late', age=timedelta(minutes=5))
+        processing = self.payment('ws_CO_busy', age=timedelta(minutes=5))
+        recent = self.payment('ws_CO_new')
+        stuck = self.payment(None, status='Queued', age=timedelta(hours=1))
+        self.daraja.results['ws_CO_late'] = (1, 'The balance is insufficient for the transaction.')
+
+        counts = sweep_pending_payments()
+        self.assertEqual(counts, {'settled': 1, 'expired': 1, 'pending': 1})
+        self.assertEqual(self.daraja.counters['stk_queries'], 2)
+        for payment, status in ((overdue, 'Failed'), (processing, 'Pending (STK Sent)'),
+                                (recent, 'Pending (STK Sent)'), (stuck, 'Failed')):
+            payment.refresh_from_db()
+            self.assertEqual(payment.status, status)
+
+        # A late callback for a swept payment is a duplicate.
+        self.post(stk_callback('ws_CO_late'))
+        self.assertEqual(process_callbacks()['duplicate'], 1)
+
+
+
+class ConcurrentCallbackTest(TransactionTestCase):
+    def test_parallel_runs_apply_each_callback_once(self):
+        for n in range(40):
+            MpesaTransaction.objects.create(
+                transaction_code=f'ws_CO_{n}', phone_number='254712345678', amount=150, status='Pending (STK Sent)'
+            )
+            MpesaCallback.objects.create(body=stk_callback(f'ws_CO_{n}'))
+
+        def run(_):
+            try:
+                return retry_when_locked(lambda: process_callbacks(batch_size=50), attempts=200)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            runs = list(pool.map(run, range(4)))
+
+        self.assertEqual(sum(counts['applied'] for counts in runs), 40)
+        self.assertEqual(sum(counts['duplicate'] for counts in runs), 0)
+        self.assertEqual(set(MpesaCallback.objects.values_list('outcome', flat=True)), {MpesaCallback.APPLIED})
+
+class TransactionHistoryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('0712345678', password='pw')
+        self.client.force_login(self.user)
+
+    def test_to_e164(self):
+        for raw in ('0712 345 678', '254712345678', '+254 712-345-678', '00254712345678', '712345678'):
+            self.assertEqual(to_e164(raw), '+254712345678')
+        self.assertEqual(to_e164('call me'), '')
+        vendor = WaterVendor(phone_number='+254 712 345 678')
+        self.assertEqual(vendor.whatsapp_number, '254712345678')
+
+    def test_history_pages_through_own_payments(self):
+        other = User.objects.create_user('other', password='pw')
+        MpesaTransaction.objects.bulk_create(
+            [MpesaTransaction(phone_number='+254712345678', amount=n + 1, user=self.user) for n in range(25)]
+            + [MpesaTransaction(phone_number='+254722000000', amount=999, user=other)]
+        )
+        url = reverse('transaction_history')
+        with self.assertNumQueries(3):  # session, user and the page, vendors joined in
+            first = self.client.get(url)
+        self.assertEqual(len(first.context['transactions']), 20)
+        second = self.client.get(url, {'cursor': first.context['next_cursor']})
+        amounts = [t.amount for t in first.context['transactions']] + [t.amount for t in second.context['transactions']]
+        self.assertEqual(sorted(amounts), list(range(1, 26)))
+        self.assertIsNone(second.context['next_cursor'])
+        self.assertEqual(self.client.get(url, {'cursor': 'garbage'}).status_code, 404)
+
+    def test_history_uses_user_and_phone_indexes(self):
+        sql, params = user_payments(self.user).order_by('-created_at', '-id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        # An index search per branch, no table scan.
+        self.assertIn('MULTI-INDEX OR', plan)
+        self.assertIn('mpesa_phone_created_idx', plan)
+        self.assertNotIn('SCAN waterapp_mpesatransaction', plan)
+
+    def test_history_includes_anonymous_donations_from_own_number(self):
+        MpesaTransaction.objects.create(phone_number='+254712345678', amount=5, user=self.user)
+        MpesaTransaction.objects.create(phone_number='+254722000000', amount=999)
+        self.client.logout()
+        self.client.post(reverse('donate'), {'phone': '0712 345 678', 'amount': '50'})
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('transaction_history'))
+        self.assertEqual(sorted(t.amount for t in response.context['transactions']), [5, 50])
+
+    def test_signup_links_earlier_payments(self):
+        MpesaTransaction.objects.create(phone_number='+254733111222', amount=10)
+        MpesaTransaction.objects.create(phone_number='+254799000000', amount=20)
+        self.client.logout()
+        self.client.post(reverse('signup'), {
+            'username': '0733111222', 'email': 'new@example.com',
+            'password1': 'a-Strong-pass-123', 'password2': 'a-Strong-pass-123',
+        })
+        user = User.objects.get(email='new@example.com')
+        self.assertEqual(list(user.mpesa_transactions.values_list('amount', flat=True)), [10])
+        self.assertEqual(link_payments(User.objects.create_user('no-phone')), 0)
+
+
+class OpenIssueCountTest(TestCase):
+    def setUp(self):
+        self.source = WaterSource.objects.create(name="Alpha Tap", source_type='TP', latitude=-1.28, longitude=36.82)
+        self.other = WaterSource.objects.create(name="Beta Well", source_type='WL', latitude=-1.29, longitude=36.83)
+
+    def count(self, source):
+        return WaterSource.objects.values_list('open_issue_count', flat=True).get(pk=source.pk)
+
+    def test_count_follows_issue_changes(self):
+        first = IssueReport.objects.create(water_source=self.source, description="Leak")
+        IssueReport.objects.create(water_source=self.source, description="Dry", priority_level=3)
+        IssueReport.objects.create(water_source=self.source, description="Old", is_resolved=True)
+        self.assertEqual(self.count(self.source), 2)
+
+        first.is_resolved = True
+        first.save(update_fields=['is_resolved'])
+        self.assertEqual(self.count(self.source), 1)
+        first = IssueReport.objects.get(pk=first.pk)
+        first.is_resolved, first.water_source = False, self.other
+        first.save()
+        self.assertEqual((self.count(self.source), self.count(self.other)), (1, 1))
+        IssueReport.objects.get(pk=first.pk).delete()
+        self.assertEqual(self.count(self.other), 0)
+
+        # A stale full save of the source does not write back an old count.
+        stale = WaterSource.objects.get(pk=self.source.pk)
+        IssueReport.objects.create(water_source=self.source, description="Again")
+        stale.description = "Edited"
+        stale.save()
+        self.assertEqual(self.count(self.source), 2)
+
+        log_repair(self.source, RepairLog(work_done="Fixed"))
+        self.assertEqual(self.count(self.source), 0)
+
+    def counters(self, source):
+        return WaterSource.objects.values_list(
+            'open_low_count', 'open_medium_count', 'open_high_count', 'max_open_priority'
+        ).get(pk=source.pk)
+
+    def test_priority_counters(self):
+        low = IssueReport.objects.create(water_source=self.source, description="Drip")
+        high = IssueReport.objects.create(water_source=self.source, description="Dry", priority_level=3)
+        self.assertEqual(self.counters(self.source), (1, 0, 1, 3))
+
+        high.is_resolved = True
+        high.save(update_fields=['is_resolved'])
+        self.assertEqual(self.counters(self.source), (1, 0, 0, 1))
+        low.priority_level = 2
+        low.save()
+        self.assertEqual(self.counters(self.source), (0, 1, 0, 2))
+        self.assertEqual(self.count(self.source), 1)
+
+        # The issue row and its counter update commit or roll back together.
+        with mock.patch('waterapp.signals.issue_changed', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            IssueReport.objects.create(water_source=self.source, description="Lost")
+        self.assertFalse(IssueReport.objects.filter(description="Lost").exists())
+
+    def test_reconcile_finds_and_fixes_drift(self):
+        IssueReport.objects.create(water_source=self.source, description="Leak", priority_level=2)
+        WaterSource.objects.filter(pk=self.source.pk).update(open_issue_count=7, open_medium_count=0)
+        WaterSource.objects.filter(pk=self.other.pk).update(max_open_priority=3)
+
+        out = io.StringIO()
+        call_command('reconcile_issue_counts', '--check', stdout=out)
+        self.assertIn("2 sources have drifted", out.getvalue())
+        self.assertEqual(self.count(self.source), 7)
+
+        self.assertEqual(sorted(reconcile()), sorted([self.source.pk, self.other.pk]))
+        self.assertEqual((self.count(self.source), self.counters(self.source)), (1, (0, 1, 0, 2)))
+        self.assertEqual(self.counters(self.other), (0, 0, 0, 0))
+        self.assertEqual(reconcile(), [])
+        self.assertEqual(recompute_open_issue_counts(), 2)
+
+    def test_views_read_the_counters(self):
+        IssueReport.objects.create(water_source=self.source, description="Dry", priority_level=3)
+        for n in range(5):
+            IssueReport.objects.create(water_source=self.source, description=f"Old {n}", is_resolved=True)
+
+        response = self.client.get(reverse('water_source_detail', args=[self.source.pk]))
+        self.assertEqual([issue.description for issue in response.context['open_issues']], ["Dry"])
+        with self.assertNumQueries(2):  # the source and its repairs; no issue query without open issues
+            self.client.get(reverse('water_source_detail', args=[self.other.pk]))
+
+        point = next(p for p in map_data.serialize_sources(WaterSource.objects.all()) if p['id'] == self.source.pk)
+        self.assertEqual((point['open_issues'], point['priority']), (1, 3))
+        stats = compute_dashboard_stats()
+        self.assertEqual(stats['open_issues'], 1)
+        self.assertEqual([row['count'] for row in stats['open_by_priority']], [0, 0, 1])
+
+    def test_list_is_paged_by_name_and_cached(self):
+        WaterSource.objects.bulk_create([
+            WaterSource(name=f"Source {n:02d}", source_type='TP', latitude=-1.3, longitude=36.8) for n in range(25)
+        ])
+        IssueReport.objects.create(water_source=self.source, description="Leak")
+        url = reverse('water_source_list')
+        first = self.client.get(url)
+        self.assertContains(first, "1 Open Issue(s)")
+        names = [s.name for s in first.context['sources']]
+        self.assertEqual(names[:3], ["Alpha Tap", "Beta Well", "Source 00"])
+        second = self.client.get(url, {'cursor': first.context['next_cursor']})
+        self.assertEqual(len(names) + len(second.context['sources']), 27)
+        self.assertIsNone(second.context['next_cursor'])
+        self.assertEqual(self.client.get(url, {'cursor': 'bad'}).status_code, 404)
+
+        # A repeat is two cache reads (the version and the page) until a source or issue changes.
+        with self.assertNumQueries(2):
+            self.assertContains(self.client.get(url), "Alpha Tap")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.source.name = "Zulu Tap"
+            self.source.save()
+        self.assertNotContains(self.client.get(url), "Alpha Tap")
+
+        response = self.client.get(url, {'q': 'beta'})
+        self.assertEqual([s.name for s in response.context['sources']], ["Beta Well"])
+
+
+class PublicPageCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.source = WaterSource.objects.create(name="Alpha Tap", source_type='TP', latitude=-1.28, longitude=36.82)
+        self.vendor = WaterVendor.objects.create(
+            user=User.objects.create_user('vendor', password='pass12345'),
+            business_name="Maji Safi", phone_number="0712345678", location_name="Kibera", is_verified=True,
+        )
+
+    def get(self, name, *args):
+        return self.client.get(reverse(name, args=args))
+
+    def test_anonymous_pages_are_served_from_cache(self):
+        # A hit is one cache read for the namespace versions (if any) and one for the page.
+        pages = [('index', (), 2), ('vendor_list', (), 2), ('about', (), 1), ('legal_page', ('terms',), 1)]
+        for name, args, queries in pages:
+            first = self.get(name, *args)
+            self.assertEqual(first['X-Page-Cache'], 'miss')
+            self.assertIn('Cookie', first['Vary'])
+            with self.assertNumQueries(queries):
+                second = self.get(name, *args)
+            self.assertEqual(second['X-Page-Cache'], 'hit')
+            self.assertIn('Cookie', second['Vary'])
+            self.assertEqual(second.content, first.content)
+
+    def test_model_changes_retire_only_their_pages(self):
+        self.get('index'), self.get('vendor_list')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.source.name = "Alpha Kiosk"
+            self.source.save()
+        index = self.get('index')
+        self.assertEqual(index['X-Page-Cache'], 'miss')
+        self.assertContains(index, "Alpha Kiosk")
+        self.assertEqual(self.get('vendor_list')['X-Page-Cache'], 'hit')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.vendor.business_name = "Maji Bora"
+            self.vendor.save()
+        self.assertContains(self.get('vendor_list'), "Maji Bora")
+        self.assertEqual(self.get('index')['X-Page-Cache'], 'miss')
+
+    def test_signed_in_users_get_fresh_pages(self):
+        self.get('index')
+        self.client.login(username='vendor', password='pass12345')
+        response = self.get('index')
+        self.assertNotIn('X-Page-Cache', response)
+        self.assertIn('Cookie', response['Vary'])
+        self.assertContains(response, 'vendor')
+        self.client.logout()
+        self.assertEqual(self.get('index')['X-Page-Cache'], 'hit')
+
+    def test_unknown_legal_page_shows_privacy_policy(self):
+        self.assertContains(self.get('legal_page', 'nonsense'), "Privacy Policy")
+
+
+class LiveMapStreamTest(TestCase):
+    def setUp(self):
+        self.url = reverse('water_source_map_stream')
+        self.source = WaterSource.objects.create(name="Kibera Tap", source_type='TP', latitude=-1.31, longitude=36.78)
+        self.vendor = WaterVendor.objects.create(
+            user=User.objects.create_user('vendor', password='pass12345'),
+            business_name="Maji Safi", phone_number="0712345678", is_verified=True,
+        )
+        # Settled history, so the broker's late-commit re-read starts after it.
+        WaterSourceStatusEvent.objects.update(at=timezone.now() - timedelta(minutes=1))
+        poll = mock.patch.object(live_map.broker, 'poll_seconds', 0.02)
+        poll.start()
+        self.addCleanup(poll.stop)
+
+    async def read(self, chunks):
+        return (await asyncio.wait_for(anext(chunks), 5)).decode()
+
+    async def test_changes_are_pushed_to_connected_clients(self):
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = response.streaming_content
+        try:
+            self.assertEqual(await self.read(chunks), "retry: 3000\n\n")
+            self.assertTrue((await self.read(chunks)).startswith("event: ready\nid: "))
+
+            self.source.status = 'C'
+            await self.source.asave()
+            event = await self.read(chunks)
+            self.assertTrue(event.startswith("event: source\n"))
+            self.assertEqual(json.loads(event.split('data: ')[1]), {
+                'id': self.source.pk, 'status': 'Contaminated', 'color': 'danger',
+            })
+
+            self.vendor.price_per_20l = 60
+            await self.vendor.asave()
+            self.vendor.is_open = False
+            await self.vendor.asave()
+            event = await self.read(chunks)
+            self.assertTrue(event.startswith("event: vendor\n"))
+            self.assertEqual(json.loads(event.split('data: ')[1]), {'id': self.vendor.pk, 'open': False})
+        finally:
+            await chunks.aclose()
+            await live_map.broker.aclose()
+
+    async def test_resume_replays_missed_events(self):
+        cursor = await sync_to_async(live_map.latest_cursor)()
+        for status in ('C', 'O'):
+            self.source.status = status
+            await self.source.asave()
+        response = await self.async_client.get(self.url, headers={'Last-Event-ID': str(cursor)})
+        chunks = response.streaming_content
+        try:
+            await self.read(chunks)
+            replayed = [await self.read(chunks), await self.read(chunks)]
+            self.assertEqual([json.loads(e.split('data: ')[1])['color'] for e in replayed], ['danger', 'success'])
+            self.assertIn(f"id: {await sync_to_async(live_map.latest_cursor)()}\n", replayed[1])
+        finally:
+            await chunks.aclose()
+
+        response = await self.async_client.get(self.url, headers={'Last-Event-ID': 'garbage'})
+        chunks = response.streaming_content
+        try:
+            await self.read(chunks)
+            self.assertTrue((await self.read(chunks)).startswith("event: reset\n"))
+        finally:
+            await chunks.aclose()
+            await live_map.broker.aclose()
+
+    async def test_slow_client_is_dropped_at_a_full_queue(self):
+        broker = live_map.LiveMapBroker(queue_size=2)
+        slow, fast = broker.subscribe(), broker.subscribe()
+        try:
+            events = [live_map.Event('source', i, timezone.now(), {}) for i in range(3)]
+            broker.publish(events[:2])
+            await fast.queue.get(), await fast.queue.get()
+            broker.publish(events[2:])
+            self.assertTrue(slow.overflowed)
+            self.assertFalse(fast.overflowed)
+            self.assertEqual((await fast.queue.get()).id, 2)
+        finally:
+            await broker.aclose()
+
+    def test_vendor_events_only_for_toggles_and_not_under_wsgi(self):
+        self.vendor.is_open = False
+        self.vendor.save()
+        self.vendor.save()
+        self.assertEqual(list(VendorStatusEvent.objects.values_list('is_open', flat=True)), [False])
+        self.assertEqual(self.client.get(self.url).status_code, 204)
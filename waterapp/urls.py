@@ -12,8 +12,12 @@ urlpatterns = [
 
     path('map/', views.water_source_map, name='water_source_map'),
     path('api/map-data/', views.water_source_map_data, name='water_source_map_data'),
+    path('api/map-data/changes/', views.water_source_map_changes, name='water_source_map_changes'),
+    path('api/map-data/stream/', views.water_source_map_stream, name='water_source_map_stream'),
+    path('api/nearest/', views.nearest_water_api, name='nearest_water'),
 
     path('sources/', views.water_source_list, name='water_source_list'),
+    path('api/search/', views.search_suggestions, name='search_suggestions'),
     path('sources/<int:pk>/', views.water_source_detail, name='water_source_detail'),
     path('sources/add/', views.water_source_create_update, name='water_source_create'),
     path('sources/edit/<int:pk>/', views.water_source_create_update, name='water_source_update'),
@@ -23,16 +27,24 @@ urlpatterns = [
     path('repair/log/<int:source_pk>/', views.repair_log_create, name='repair_log_create'),
     path('issue/resolve/<int:pk>/', views.issue_toggle_resolve, name='issue_toggle_resolve'),
     path('admin/export/issues/', views.export_issues_csv, name='export_issues_csv'),
+    path('admin/export/data/<str:dataset>/', views.export_data, name='export_data'),
     
     path('dashboard/', views.dashboard, name='dashboard'),
+    path('dashboard/analytics/', views.analytics_dashboard, name='analytics'),
+    path('api/analytics/', views.analytics_api, name='analytics_api'),
     path('vendors/', views.vendor_list, name='vendor_list'),
     path('partner/', views.vendor_signup, name='vendor_signup'),
     path('vendor/edit/', views.vendor_profile_edit, name='vendor_profile_edit'),
     path('vendor/<int:pk>/', views.vendor_public_profile, name='vendor_public_profile'),
+    path('api/vendor/<int:pk>/reviews/', views.vendor_reviews_api, name='vendor_reviews_api'),
+    path('api/my-issues/', views.my_issues_api, name='my_issues_api'),
     path('api/track-click/<int:vendor_id>/', views.track_vendor_click, name='track_vendor_click'),
 
     path('donate/', views.donate, name='donate'),
     path('pay/<int:vendor_id>/', views.initiate_payment, name='initiate_payment'),
+    path('pay/status/<str:reference>/', views.payment_status_page, name='payment_status_page'),
+    path('api/payments/<str:reference>/', views.payment_status_api, name='payment_status_api'),
+    path('api/mpesa/callback/', views.mpesa_callback, name='mpesa_callback'),
     path('my-transactions/', views.transaction_history, name='transaction_history'),
     path('vendor/report-issue/', views.vendor_report_issue, name='vendor_report_issue'),
 ]
\ No newline at end of file
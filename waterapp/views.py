@@ -1,20 +1,40 @@
-import threading
-from django.shortcuts import render, get_object_or_404, redirect
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, get_object_or_404, redirect, aget_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.db.models import Count, Q
-from django.http import JsonResponse, HttpResponse
+from django.db import transaction
+from django.db.models import F
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, JsonResponse, HttpResponse, StreamingHttpResponse
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied
-from django.core.mail import send_mail
 from django.conf import settings
-import csv 
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
+from django.urls import reverse
 from django.utils import timezone
-from datetime import timedelta
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.contrib.auth.models import User
-from .models import WaterSource, IssueReport, RepairLog, WaterVendor, VendorClickLog, VendorReview, MpesaTransaction
-from .mpesa_views import trigger_stk_push
+from .models import WaterSource, IssueReport, WaterVendor, MpesaCallback
+from . import live_map
+from .map_data import MapQueryError, acached_map_payload, amap_payload_etag, changes_since, parse_viewport, parse_zoom
+from .page_cache import cache_anonymous_page, cached_fragment
+from .analytics import AnalyticsQueryError, analytics_summary, parse_analytics_query
+from .clicks import click_buffer, click_chart
+from .ratings import with_average_rating
+from .repairs import log_repair
+from .exports import ExportError, export_response, parse_filters
+from .nearest import nearest_water, parse_nearest_query
+from .outbox import queue_email
+from .pagination import InvalidCursor, keyset_page
+from .payment_callbacks import MAX_CALLBACK_BYTES
+from .payments import (
+    PaymentError, aqueue_stk_push, link_payments, payment_from_reference, payment_reference, payment_status,
+    user_payments,
+)
+from .search import search
+from .stats import get_dashboard_stats
 from .forms import (
     IssueReportForm, 
     WaterSourceForm, 
@@ -29,37 +49,62 @@ from .forms import (
     VendorIssueReportForm
 )
 
-class EmailThread(threading.Thread):
-    def __init__(self, subject, plain_message, recipient_emails, html_message):
-        self.subject = subject
-        self.plain_message = plain_message
-        self.recipient_emails = recipient_emails
-        self.html_message = html_message
-        threading.Thread.__init__(self)
-
-    def run(self):
-        try:
-            send_mail(
-                self.subject,
-                self.plain_message,
-                settings.EMAIL_HOST_USER,
-                self.recipient_emails,
-                html_message=self.html_message,
-                fail_silently=False
-            )
-            print(f"[SUCCESS] Email sent successfully to: {self.recipient_emails}")
-        except Exception as e:
-            print(f"[EMAIL FAILURE] Could not send email: {e}")
-def notify_maintenance_team(request, report, source_name, source_type):
-    staff_members = User.objects.filter(is_staff=True).exclude(email='')
-    recipient_emails = [user.email for user in staff_members]
+REVIEW_ORDERING = ('-created_at', '-id')
+ISSUE_ORDERING = ('-reported_at', '-id')
+PAYMENT_ORDERING = ('-created_at', '-id')
+SOURCE_ORDERING = ('name', 'id')
+SOURCE_LIST_CACHE_TIMEOUT = 60 * 60
+
+
+def _html_page(queryset, ordering, request):
+    try:
+        return keyset_page(queryset, ordering, request.GET.get('cursor'))
+    except InvalidCursor:
+        raise Http404("Invalid page cursor.")
+
+
+def _json_page(queryset, ordering, request, serialize):
+    try:
+        page = keyset_page(queryset, ordering, request.GET.get('cursor'))
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+        'results': [serialize(item) for item in page.items],
+        'next_cursor': page.next_cursor,
+    })
+
+
+def _user_issues(user):
+    return IssueReport.objects.filter(reporter=user).select_related('water_source', 'vendor')
+
+
+def _serialize_issue(issue):
+    return {
+        'id': issue.pk,
+        'target': issue.water_source.name if issue.water_source else issue.vendor.business_name,
+        'description': issue.description,
+        'is_resolved': issue.is_resolved,
+        'reported_at': issue.reported_at.isoformat(),
+    }
+
+
+def _serialize_review(review):
+    return {
+        'id': review.pk,
+        'author': review.author.username,
+        'rating': review.rating,
+        'comment': review.comment,
+        'created_at': review.created_at.isoformat(),
+    }
 
+def notify_maintenance_team(request, report, source_name, source_type):
+    """Queues the new-issue alert for every staff member with an email address."""
+    recipient_emails = list(
+        User.objects.filter(is_staff=True).exclude(email='').values_list('email', flat=True)
+    )
     if not recipient_emails:
-        print("[WARNING] No staff members found with valid emails. Notification skipped.")
         return
 
-    print(f"[INFO] Preparing to send email to {len(recipient_emails)} staff members.")
-
     context = {
         'source_name': source_name,
         'source_type': source_type,
@@ -74,37 +119,25 @@ def notify_maintenance_team(request, report, source_name, source_type):
     plain_message = strip_tags(html_message)
 
     subject = f"ACTION REQUIRED: {source_type} Issue at {source_name}"
+    queue_email(subject, plain_message, recipient_emails, html_message)
 
-    try:
-        send_mail(
-            subject,
-            plain_message,
-            settings.EMAIL_HOST_USER,
-            recipient_emails,
-            html_message=html_message,
-            fail_silently=False
-        )
-        print(f"DEBUG: Email sent successfully to {recipient_emails}")
-    except Exception as e:
-        print(f"DEBUG CRITICAL FAILURE: {e}")
-
+@cache_anonymous_page('dashboard', 'sources', 'vendors')
 def index(request):
-    total_sources = WaterSource.objects.count()
-    open_issues = IssueReport.objects.filter(is_resolved=False).count()
-    operational_sources = WaterSource.objects.filter(status='O').count()
+    stats = get_dashboard_stats()
     live_status_sources = WaterSource.objects.all().order_by('-last_updated')[:5]
 
     vendors = WaterVendor.objects.filter(is_verified=True)[:6]
 
     context = {
-        'total_sources': total_sources,
-        'open_issues': open_issues,
-        'operational_sources': operational_sources,
+        'total_sources': stats['total_sources'],
+        'open_issues': stats['open_issues'],
+        'operational_sources': stats['operational_sources'],
         'live_status_sources': live_status_sources,
         'vendors': vendors, 
     }
     return render(request, 'waterapp/index.html', context)
 
+@cache_anonymous_page()
 def about(request):
     return render(request, 'waterapp/about.html')
 
@@ -112,67 +145,154 @@ def signup(request):
     if request.method == 'POST':
         form = SignUpForm(request.POST)
         if form.is_valid():
-            form.save()
+            link_payments(form.save())
             return redirect('login')
     else:
         form = SignUpForm()
     return render(request, 'registration/signup.html', {'form': form})
 
 
+def _source_list_page(request):
+    """(cards html, next cursor) for a page of the list, rendered once per list version."""
+    def render_page():
+        page = _html_page(WaterSource.objects.all(), SOURCE_ORDERING, request)
+        return render_to_string('waterapp/water_source_cards.html', {'sources': page.items}), page.next_cursor
+
+    cursor = request.GET.get('cursor') or ''
+    return cached_fragment('source-list', ('sources',), render_page, cursor, timeout=SOURCE_LIST_CACHE_TIMEOUT)
+
+
 def water_source_list(request):
-    sources = WaterSource.objects.all()
+    """
+    Sources by name, a keyset page at a time; ``?q=`` shows the best
+    search matches instead.
+    """
     query = request.GET.get('q')
     if query:
-        sources = sources.filter(
-            Q(name__icontains=query) |
-            Q(description__icontains=query)
-        )
+        cards = render_to_string('waterapp/water_source_cards.html', {'sources': search('source', query), 'query': query})
+        next_cursor = None
+    else:
+        cards, next_cursor = _source_list_page(request)
+    return render(request, 'waterapp/water_source_list.html', {'cards': cards, 'next_cursor': next_cursor})
 
-    sources = sources.annotate(
-        num_open_issues=Count('issues', filter=Q(issues__is_resolved=False))
-    )
-    return render(request, 'waterapp/water_source_list.html', {'sources': sources})
+def search_suggestions(request):
+    """
+    Autocomplete for the search boxes: ``?q=<partial text>`` returns up to
+    eight matching sources and vendors (or only ``?kind=source|vendor``),
+    best first, typos allowed.
+    """
+    query = request.GET.get('q', '').strip()
+    kind = request.GET.get('kind')
+    if len(query) < 2:
+        return JsonResponse({'results': []})
+
+    matches = []
+    if kind in (None, 'source'):
+        matches += search('source', query, limit=8, prefix=True)
+    if kind in (None, 'vendor'):
+        vendors = WaterVendor.objects.filter(is_open=True, is_verified=True)
+        matches += search('vendor', query, vendors, limit=8, prefix=True)
+    matches.sort(key=lambda obj: -obj.search_score)
+    results = [
+        {
+            'type': 'source',
+            'id': obj.pk,
+            'label': obj.name,
+            'detail': obj.get_source_type_display(),
+            'url': reverse('water_source_detail', args=[obj.pk]),
+        } if isinstance(obj, WaterSource) else {
+            'type': 'vendor',
+            'id': obj.pk,
+            'label': obj.business_name,
+            'detail': obj.location_name,
+            'url': reverse('vendor_public_profile', args=[obj.pk]),
+        }
+        for obj in matches[:8]
+    ]
+    return JsonResponse({'results': results})
 
 def water_source_map(request):
     return render(request, 'waterapp/water_source_map.html')
 
-def water_source_map_data(request):
-    sources = WaterSource.objects.all()
-    
-    vendors = WaterVendor.objects.filter(
-        is_open=True, 
-        is_verified=True
-    ).exclude(latitude__isnull=True).exclude(longitude__isnull=True)
-    
-    data = []
-    for s in sources:
-        data.append({
-            'type': 'source', 
-            'id': s.pk,
-            'name': s.name,
-            'lat': float(s.latitude),
-            'lon': float(s.longitude),
-            'status': s.get_status_display(),
-            'color': s.status_color
-        })
-
-    for v in vendors:
-        data.append({
-            'type': 'vendor',
-            'id': v.pk,
-            'name': v.business_name,
-            'lat': float(v.latitude),
-            'lon': float(v.longitude),
-            'status': f"Selling @ KES {v.price_per_20l}/20L",
-            'phone': v.whatsapp_number,
-            'color': 'info'
-        })
-        
-    return JsonResponse(data, safe=False)
+async def water_source_map_data(request):
+    """
+    Map markers as JSON. Pass ``?bbox=west,south,east,north`` or
+    ``?lat=&lon=&radius=`` (km) to get only the points in the viewport, and
+    ``?zoom=`` to get sources as server-side clusters when zoomed out.
+
+    Async: a cached payload or a 304 is served without leaving the event loop.
+    """
+    try:
+        viewport = parse_viewport(request.GET)
+        zoom = parse_zoom(request.GET)
+    except MapQueryError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    compressed = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    payload_tag = await amap_payload_etag(viewport, zoom)
+    etag = f'"{payload_tag}-gz"' if compressed else f'"{payload_tag}"'
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        body = await acached_map_payload(payload_tag, viewport, zoom, compressed)
+        response = HttpResponse(body, content_type='application/json')
+        if compressed:
+            response['Content-Encoding'] = 'gzip'
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
 
+async def water_source_map_stream(request):
+    """
+    Live source status and vendor open/closed changes as Server-Sent
+    Events; see ``live_map``. Resumes from the ``Last-Event-ID`` header.
+    """
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker would be held for the life of the connection.
+        # 204 tells EventSource not to reconnect.
+        return HttpResponse(status=204)
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    response = StreamingHttpResponse(live_map.stream(last_event_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def water_source_map_changes(request):
+    """
+    Delta sync for offline map copies: ``?since=<cursor>`` returns only the
+    points upserted or removed since the cursor of a previous response.
+    """
+    try:
+        changes = changes_since(request.GET.get('since'))
+    except MapQueryError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(changes)
+
+def nearest_water_api(request):
+    """
+    The closest operational sources and open, verified vendors to
+    ``?lat=&lon=``: ``k`` of each (default 5), or only one ``kind``.
+    ``sort=cost&qty=N`` ranks vendors within ``radius`` km by total price.
+    """
+    try:
+        query = parse_nearest_query(request.GET)
+    except MapQueryError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(nearest_water(**query))
+
+@cache_anonymous_page('vendors')
 def vendor_list(request):
     vendors = WaterVendor.objects.filter(is_open=True, is_verified=True)
-    return render(request, 'waterapp/vendor_list.html', {'vendors': vendors})
+    sort = request.GET.get('sort')
+    query = request.GET.get('q')
+    if query:
+        vendors = search('vendor', query, vendors)
+    elif sort == 'rating':
+        vendors = with_average_rating(vendors).order_by(F('avg_rating').desc(nulls_last=True), '-rating_count')
+    elif sort == 'price':
+        vendors = vendors.order_by('price_per_20l')
+    return render(request, 'waterapp/vendor_list.html', {'vendors': vendors, 'sort': sort, 'query': query})
 
 def vendor_signup(request):
     if request.method == 'POST':
@@ -186,8 +306,12 @@ def vendor_signup(request):
     return render(request, 'waterapp/vendor_signup.html', {'form': form})
 
 def water_source_detail(request, pk):
-    source = get_object_or_404(WaterSource.objects.prefetch_related('issues', 'repairs'), pk=pk)
-    open_issues = [issue for issue in source.issues.all() if not issue.is_resolved]
+    source = get_object_or_404(WaterSource, pk=pk)
+    # The counters say whether there is anything to fetch; resolved history is never loaded.
+    open_issues = (
+        source.issues.filter(is_resolved=False).order_by('-priority_level', '-reported_at')
+        if source.open_issue_count else []
+    )
     repair_history = source.repairs.all()
     
     context = {
@@ -204,13 +328,14 @@ def issue_report_create(request):
         if form.is_valid():
             report = form.save(commit=False)
             report.reporter = request.user 
-            report.save()
-            notify_maintenance_team(
-                request, 
-                report, 
-                report.water_source.name, 
-                "Public Source"
-            )
+            with transaction.atomic():
+                report.save()
+                notify_maintenance_team(
+                    request, 
+                    report, 
+                    report.water_source.name, 
+                    "Public Source"
+                )
 
             messages.success(request, "Report submitted! Technicians have been notified.")
             return redirect('index')
@@ -221,39 +346,25 @@ def issue_report_create(request):
 @login_required
 def dashboard(request):
     if request.user.is_staff:
-        sources = WaterSource.objects.all().order_by('name')
-        open_issues = IssueReport.objects.filter(is_resolved=False).order_by('-priority_level', '-reported_at')
-        
-        status_counts = WaterSource.objects.values('status').annotate(count=Count('status'))
-        source_type_counts = WaterSource.objects.values('source_type').annotate(count=Count('source_type'))
+        stats = get_dashboard_stats()
+        open_issues = IssueReport.objects.filter(
+            is_resolved=False
+        ).select_related('water_source', 'vendor').order_by('-priority_level', '-reported_at')
         
         context = {
-            'sources': sources,
             'open_issues': open_issues,
-            'status_counts': list(status_counts),
-            'source_type_counts': list(source_type_counts),
-            'total_sources': sources.count(),
-            'total_open_issues': open_issues.count(),
+            'status_counts': stats['status_counts'],
+            'source_type_counts': stats['source_type_counts'],
+            'total_sources': stats['total_sources'],
+            'total_open_issues': stats['open_issues'],
+            'open_by_priority': stats['open_by_priority'],
         }
         return render(request, 'waterapp/dashboard.html', context)
     
     elif hasattr(request.user, 'vendor_profile'):
         vendor = request.user.vendor_profile
         
-        today = timezone.now().date()
-        dates = [today - timedelta(days=i) for i in range(6, -1, -1)]
-        
-        chart_labels = []
-        chart_data = []
-        
-        for d in dates:
-            chart_labels.append(d.strftime('%a')) 
-            
-            count = VendorClickLog.objects.filter(
-                vendor=vendor,
-                timestamp__date=d
-            ).count()
-            chart_data.append(count)
+        chart_labels, chart_data = click_chart(vendor)
 
         context = {
             'vendor': vendor,
@@ -264,7 +375,7 @@ def dashboard(request):
         return render(request, 'waterapp/vendor_dashboard.html', context)
 
     else:
-        user_issues = IssueReport.objects.filter(reporter=request.user).order_by('-reported_at')
+        issues_page = _html_page(_user_issues(request.user), ISSUE_ORDERING, request)
         resolved_notifications = IssueReport.objects.filter(
             reporter=request.user, 
             is_resolved=True
@@ -272,7 +383,8 @@ def dashboard(request):
         available_sources = WaterSource.objects.filter(status='O').order_by('-last_updated')[:3]
         
         context = {
-            'user_issues': user_issues,
+            'user_issues': issues_page.items,
+            'next_cursor': issues_page.next_cursor,
             'resolved_notifications': resolved_notifications,
             'available_sources': available_sources,
         }
@@ -322,14 +434,14 @@ def vendor_report_issue(request):
             report = form.save(commit=False)
             report.vendor = vendor 
             report.reporter = request.user
-            report.save()
-            
-            notify_maintenance_team(
-                request, 
-                report, 
-                vendor.business_name, 
-                "Commercial Vendor"
-            )
+            with transaction.atomic():
+                report.save()
+                notify_maintenance_team(
+                    request, 
+                    report, 
+                    vendor.business_name, 
+                    "Commercial Vendor"
+                )
 
             messages.success(request, "Repair request submitted! Technicians have been notified.")
             return redirect('dashboard')
@@ -404,7 +516,7 @@ def request_verification(request, pk):
             https://water-management-system-ouep.onrender.com/admin/waterapp/watersource/{source.pk}/change/
             """
             
-            EmailThread(subject, email_body, [settings.EMAIL_HOST_USER], None).start()
+            queue_email(subject, email_body, [settings.EMAIL_HOST_USER])
             messages.success(request, "Verification request sent successfully!")
                 
             return redirect('water_source_detail', pk=pk)
@@ -423,18 +535,8 @@ def repair_log_create(request, source_pk):
     if request.method == 'POST':
         form = RepairLogForm(request.POST)
         if form.is_valid():
-            log = form.save(commit=False)
+            resolved_count = log_repair(source, form.save(commit=False), request.user)
 
-            log.water_source = source
-            log.technician = request.user 
-            log.save()
-            
-            source.status = 'O'
-            source.save()
-            open_issues = source.issues.filter(is_resolved=False)
-            resolved_count = open_issues.count()
-            open_issues.update(is_resolved=True)
-            
             messages.success(
                 request, 
                 f"Repair logged! Source marked 'Operational' and {resolved_count} issues were automatically resolved."
@@ -451,33 +553,63 @@ def issue_toggle_resolve(request, pk):
     issue = get_object_or_404(IssueReport, pk=pk)
     if request.method == 'POST':
         issue.is_resolved = not issue.is_resolved
-        issue.save()
+        issue.save(update_fields=['is_resolved'])
     return redirect('dashboard')
 
 @login_required
-def export_issues_csv(request):
+def analytics_dashboard(request):
     if not request.user.is_staff:
         raise PermissionDenied("You do not have permission to access this page.")
-        
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="open_issues_report.csv"'
+    try:
+        query = parse_analytics_query(request.GET)
+    except AnalyticsQueryError as e:
+        messages.error(request, str(e))
+        query = parse_analytics_query({})
+    context = {
+        'summary': analytics_summary(**query),
+        'stats': get_dashboard_stats(),
+        'source_types': WaterSource.SOURCE_TYPES,
+    }
+    return render(request, 'waterapp/analytics.html', context)
 
-    writer = csv.writer(response)
+@login_required
+def analytics_api(request):
+    """
+    Downtime, issue, MTTR and repair cost facts per day, per source type and
+    for the worst sources, over ``start``..``end`` and optionally one ``type``.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': "Staff only."}, status=403)
+    try:
+        query = parse_analytics_query(request.GET)
+    except AnalyticsQueryError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(analytics_summary(**query))
 
-    writer.writerow(['ID', 'Source', 'Priority', 'Description', 'Reported At'])
+def _export(request, dataset, default_status=None, filename=None):
+    if not request.user.is_staff:
+        raise PermissionDenied("You do not have permission to access this page.")
 
-    issues = IssueReport.objects.filter(is_resolved=False).select_related('water_source')
-    
-    for issue in issues:
-        writer.writerow([
-            issue.pk,
-            issue.water_source.name,
-            issue.priority_level,
-            issue.description,
-            issue.reported_at.strftime("%Y-%m-%d %H:%M")
-        ])
+    try:
+        filters = parse_filters(request.GET)
+        if default_status:
+            filters.setdefault('status', default_status)
+        return export_response(dataset, request.GET.get('format', 'csv'), filename, **filters)
+    except ExportError as e:
+        return HttpResponse(str(e), status=400, content_type='text/plain')
 
-    return response
+@login_required
+def export_data(request, dataset):
+    """
+    Staff export of issues, repairs, orders or payments, streamed as
+    ``?format=csv`` (default) or ``xlsx`` and filtered by ``start``/``end``
+    dates (YYYY-MM-DD) and ``status``.
+    """
+    return _export(request, dataset)
+
+@login_required
+def export_issues_csv(request):
+    return _export(request, 'issues', default_status='open', filename='open_issues_report')
 
 def contact(request):
     if request.method == 'POST':
@@ -495,7 +627,7 @@ def contact(request):
             
             subject = f"New Contact: {form.cleaned_data['subject']}"
             
-            EmailThread(subject, plain_message, [settings.EMAIL_HOST_USER], html_message).start()
+            queue_email(subject, plain_message, [settings.EMAIL_HOST_USER], html_message)
 
             messages.success(request, "Your message has been sent.")
             return redirect('contact')
@@ -504,95 +636,95 @@ def contact(request):
 
     return render(request, 'waterapp/contact.html', {'form': form})
 
-def legal_page(request, page_type):
-    h_style = "fw-bold text-dark mt-4 mb-3"
-    p_style = "text-muted mb-3"
-    ul_style = "text-muted mb-4"
-
-    content = {
-        'privacy': {
-            'title': 'Privacy Policy',
-            'updated': 'Last Updated: December 22, 2025',
-            'body': f"""
-                <p class="{p_style}">At WaterConnect, we prioritize the protection of your personal data. This policy outlines how we handle your information, particularly regarding our Water Vendor and M-Pesa payment services.</p>
-                
-                <h4 class="{h_style}">1. Information We Collect</h4>
-                <ul class="{ul_style}">
-                    <li><strong>Account Data:</strong> Username, email address and phone number.</li>
-                    <li><strong>Transaction Data:</strong> M-Pesa transaction codes, amounts and timestamps.</li>
-                    <li><strong>Location Data:</strong> GPS coordinates for water delivery and mapping services.</li>
-                </ul>
-
-                <h4 class="{h_style}">2. How We Share Data with Vendors</h4>
-                <p class="{p_style}">WaterConnect acts as a bridge between you and independent Water Vendors. When you place an order:</p>
-                <ul class="{ul_style}">
-                    <li><strong>Phone Number:</strong> Your phone number is shared with the specific vendor you selected to facilitate delivery.</li>
-                    <li><strong>Location:</strong> Your delivery location is shared with the vendor for logistics purposes.</li>
-                </ul>
-                <p class="{p_style}">We do not sell your personal data to third-party advertisers.</p>
-
-                <h4 class="{h_style}">3. M-Pesa Payment Data</h4>
-                <p class="{p_style}">Payments are processed securely via Safaricom's Daraja API. We store transaction records for account history and dispute resolution purposes only.</p>
-            """
-        },
-        'terms': {
-            'title': 'Terms of Service',
-            'updated': 'Last Updated: December 22, 2025',
-            'body': f"""
-                <p class="{p_style}">Welcome to WaterConnect. By using our platform to locate water sources or order refills, you agree to these terms.</p>
-
-                <h4 class="{h_style}">1. Platform Role & Liability</h4>
-                <p class="{p_style}">WaterConnect is a technology platform that connects users with independent Water Vendors. We are <strong>not</strong> the seller of the water.</p>
-                <ul class="{ul_style}">
-                    <li><strong>Quality:</strong> While we verify vendors, we are not liable for the quality or safety of the water delivered by independent vendors.</li>
-                    <li><strong>Delivery:</strong> Delivery times and fulfillment are the responsibility of the vendor.</li>
-                </ul>
-
-                <h4 class="{h_style}">2. M-Pesa Payments & Refunds</h4>
-                <p class="{p_style}">All payments made via M-Pesa on WaterConnect are directed to the platform or the vendor as specified.</p>
-                <ul class="{ul_style}">
-                    <li><strong>Disputes:</strong> If a vendor fails to deliver after payment, please report the issue via your Dashboard within 24 hours.</li>
-                    <li><strong>Refunds:</strong> Refunds are processed at the discretion of the admin after verifying the claim with the vendor. Reversals are subject to M-Pesa transaction fees.</li>
-                </ul>
-
-                <h4 class="{h_style}">3. User Conduct</h4>
-                <p class="{p_style}">You agree not to submit false reports, harass vendors or attempt to bypass the platform's payment system for orders initiated here.</p>
-            """
-        },
-        'cookies': {
-            'title': 'Cookie Policy',
-            'updated': 'Last Updated: December 22, 2025',
-            'body': f"""
-                <p class="{p_style}">We use cookies to improve your experience on WaterConnect.</p>
-
-                <h4 class="{h_style}">1. Essential Cookies</h4>
-                <p class="{p_style}">These are required for you to log in, view your dashboard and process M-Pesa payments securely.</p>
-
-                <h4 class="{h_style}">2. Analytics</h4>
-                <p class="{p_style}">We use anonymous cookies to understand how many users are viewing the map and vendor profiles to improve our services.</p>
-            """
-        }
+# Built once at import rather than per request.
+_H_STYLE = "fw-bold text-dark mt-4 mb-3"
+_P_STYLE = "text-muted mb-3"
+_UL_STYLE = "text-muted mb-4"
+
+LEGAL_PAGES = {
+    'privacy': {
+        'title': 'Privacy Policy',
+        'updated': 'Last Updated: December 22, 2025',
+        'body': f"""
+            <p class="{_P_STYLE}">At WaterConnect, we prioritize the protection of your personal data. This policy outlines how we handle your information, particularly regarding our Water Vendor and M-Pesa payment services.</p>
+            
+            <h4 class="{_H_STYLE}">1. Information We Collect</h4>
+            <ul class="{_UL_STYLE}">
+                <li><strong>Account Data:</strong> Username, email address and phone number.</li>
+                <li><strong>Transaction Data:</strong> M-Pesa transaction codes, amounts and timestamps.</li>
+                <li><strong>Location Data:</strong> GPS coordinates for water delivery and mapping services.</li>
+            </ul>
+
+            <h4 class="{_H_STYLE}">2. How We Share Data with Vendors</h4>
+            <p class="{_P_STYLE}">WaterConnect acts as a bridge between you and independent Water Vendors. When you place an order:</p>
+            <ul class="{_UL_STYLE}">
+                <li><strong>Phone Number:</strong> Your phone number is shared with the specific vendor you selected to facilitate delivery.</li>
+                <li><strong>Location:</strong> Your delivery location is shared with the vendor for logistics purposes.</li>
+            </ul>
+            <p class="{_P_STYLE}">We do not sell your personal data to third-party advertisers.</p>
+
+            <h4 class="{_H_STYLE}">3. M-Pesa Payment Data</h4>
+            <p class="{_P_STYLE}">Payments are processed securely via Safaricom's Daraja API. We store transaction records for account history and dispute resolution purposes only.</p>
+        """
+    },
+    'terms': {
+        'title': 'Terms of Service',
+        'updated': 'Last Updated: December 22, 2025',
+        'body': f"""
+            <p class="{_P_STYLE}">Welcome to WaterConnect. By using our platform to locate water sources or order refills, you agree to these terms.</p>
+
+            <h4 class="{_H_STYLE}">1. Platform Role & Liability</h4>
+            <p class="{_P_STYLE}">WaterConnect is a technology platform that connects users with independent Water Vendors. We are <strong>not</strong> the seller of the water.</p>
+            <ul class="{_UL_STYLE}">
+                <li><strong>Quality:</strong> While we verify vendors, we are not liable for the quality or safety of the water delivered by independent vendors.</li>
+                <li><strong>Delivery:</strong> Delivery times and fulfillment are the responsibility of the vendor.</li>
+            </ul>
+
+            <h4 class="{_H_STYLE}">2. M-Pesa Payments & Refunds</h4>
+            <p class="{_P_STYLE}">All payments made via M-Pesa on WaterConnect are directed to the platform or the vendor as specified.</p>
+            <ul class="{_UL_STYLE}">
+                <li><strong>Disputes:</strong> If a vendor fails to deliver after payment, please report the issue via your Dashboard within 24 hours.</li>
+                <li><strong>Refunds:</strong> Refunds are processed at the discretion of the admin after verifying the claim with the vendor. Reversals are subject to M-Pesa transaction fees.</li>
+            </ul>
+
+            <h4 class="{_H_STYLE}">3. User Conduct</h4>
+            <p class="{_P_STYLE}">You agree not to submit false reports, harass vendors or attempt to bypass the platform's payment system for orders initiated here.</p>
+        """
+    },
+    'cookies': {
+        'title': 'Cookie Policy',
+        'updated': 'Last Updated: December 22, 2025',
+        'body': f"""
+            <p class="{_P_STYLE}">We use cookies to improve your experience on WaterConnect.</p>
+
+            <h4 class="{_H_STYLE}">1. Essential Cookies</h4>
+            <p class="{_P_STYLE}">These are required for you to log in, view your dashboard and process M-Pesa payments securely.</p>
+
+            <h4 class="{_H_STYLE}">2. Analytics</h4>
+            <p class="{_P_STYLE}">We use anonymous cookies to understand how many users are viewing the map and vendor profiles to improve our services.</p>
+        """
     }
-    
-    data = content.get(page_type)
-    if not data:
-        data = content['privacy']
-        
+}
+
+
+@cache_anonymous_page()
+def legal_page(request, page_type):
+    data = LEGAL_PAGES.get(page_type, LEGAL_PAGES['privacy'])
     return render(request, 'waterapp/legal_page.html', {'data': data})
 
-def track_vendor_click(request, vendor_id):
-    vendor = get_object_or_404(WaterVendor, pk=vendor_id)
-    VendorClickLog.objects.create(vendor=vendor)
-    return JsonResponse({'status': 'success'})
+async def track_vendor_click(request, vendor_id):
+    """
+    Queues the click for a batched write instead of touching the database on
+    the request thread; see ``clicks.ClickBuffer``. Async since queueing never
+    blocks, so it needs no thread under ASGI.
+    """
+    if not click_buffer.add(vendor_id):
+        return JsonResponse({'status': 'busy'}, status=503)
+    return JsonResponse({'status': 'success'}, status=202)
 
 def vendor_public_profile(request, pk):
     vendor = get_object_or_404(WaterVendor, pk=pk)
-    reviews = vendor.reviews.all()
-    
-    average_rating = 0
-    if reviews.exists():
-        total_stars = sum([r.rating for r in reviews])
-        average_rating = round(total_stars / reviews.count(), 1)
+    reviews_page = _html_page(vendor.reviews.select_related('author'), REVIEW_ORDERING, request)
 
     if request.method == 'POST' and request.user.is_authenticated:
         form = VendorReviewForm(request.POST)
@@ -608,88 +740,104 @@ def vendor_public_profile(request, pk):
 
     context = {
         'vendor': vendor,
-        'reviews': reviews,
-        'average_rating': average_rating,
+        'reviews': reviews_page.items,
+        'next_cursor': reviews_page.next_cursor,
+        'average_rating': vendor.average_rating,
         'form': form,
         'star_range': range(1, 6),
     }
     return render(request, 'waterapp/vendor_public_profile.html', context)
 
 
+def vendor_reviews_api(request, pk):
+    """Infinite-scroll feed of a vendor's reviews, newest first; pass ``?cursor=`` from the previous page."""
+    vendor = get_object_or_404(WaterVendor, pk=pk)
+    return _json_page(vendor.reviews.select_related('author'), REVIEW_ORDERING, request, _serialize_review)
+
+
 @login_required
-def initiate_payment(request, vendor_id):
-    vendor = get_object_or_404(WaterVendor, pk=vendor_id)
-    
-    if request.method == "POST":
-        phone = request.POST.get('phone')
-        custom_amount = request.POST.get('amount') 
-        
-        response = trigger_stk_push(
-            phone_number=phone,
-            amount=custom_amount,
-            account_reference=f"Pay {vendor.business_name}",
-            transaction_desc="Water Payment"
+def my_issues_api(request):
+    """Infinite-scroll feed of the current user's issue reports, newest first."""
+    return _json_page(_user_issues(request.user), ISSUE_ORDERING, request, _serialize_issue)
+
+
+async def _queue_payment(request, account_reference, description, vendor=None):
+    """Queues the STK push for a payment form; returns the payment or None after flashing the error."""
+    user = await request.auser()
+    try:
+        return await aqueue_stk_push(
+            request.POST.get('phone'), request.POST.get('amount'), account_reference, description, vendor,
+            user=user if user.is_authenticated else None,
+            on_event_loop=isinstance(request, ASGIRequest),
         )
-        
-        if response and response.response_code == "0":
-            MpesaTransaction.objects.create(
-                phone_number=phone,
-                amount=custom_amount,
-                vendor=vendor,
-                status="Pending (STK Sent)",
-                transaction_code=response.checkout_request_id
-            )
-            messages.success(request, f"STK Push sent to {phone}. Please enter your PIN!")
-        else:
-            error_msg = response.error_message if response else "Connection Failed"
-            messages.error(request, f"M-Pesa Error: {error_msg}")
-            
-        return redirect('vendor_public_profile', pk=vendor_id)
+    except PaymentError as e:
+        messages.error(request, str(e))
+        return None
+
+@login_required
+async def initiate_payment(request, vendor_id):
+    vendor = await aget_object_or_404(WaterVendor, pk=vendor_id)
     
-    initial_phone = request.user.username if request.user.username.isdigit() else ""
+    if request.method == "POST":
+        payment = await _queue_payment(request, f"Pay {vendor.business_name}", "Water Payment", vendor)
+        if payment:
+            return redirect('payment_status_page', reference=payment_reference(payment))
+        return redirect('initiate_payment', vendor_id=vendor_id)
     
-    return render(request, 'waterapp/payment_form.html', {
+    # Templates read the session (user, messages), which is sync-only.
+    return await sync_to_async(render)(request, 'waterapp/payment_form.html', {
         'vendor': vendor, 
         'user': request.user
     })
 
 
-def donate(request):
+async def donate(request):
     if request.method == 'POST':
-        phone = request.POST.get('phone')
-        amount = request.POST.get('amount')
-        
-        response = trigger_stk_push(
-            phone_number=phone,
-            amount=amount,
-            account_reference="Donation",
-            transaction_desc="Community Support"
-        )
-        
-        if response and response.response_code == "0":
-            MpesaTransaction.objects.create(
-                phone_number=phone,
-                amount=amount,
-                status="Pending (STK Sent)",
-                transaction_code=response.checkout_request_id
-            )
-            messages.success(request, f"Thank you! STK Push sent to {phone}.")
-        else:
-            error_msg = response.error_message if response else "Connection Failed"
-            messages.error(request, f"Failed: {error_msg}")
-            
-        return redirect('index')
+        payment = await _queue_payment(request, "Donation", "Community Support")
+        if payment:
+            return redirect('payment_status_page', reference=payment_reference(payment))
+        return redirect('donate')
+
+    return await sync_to_async(render)(request, 'waterapp/donate.html')
+
+def payment_status_page(request, reference):
+    payment = payment_from_reference(reference)
+    if payment is None:
+        raise Http404("Unknown payment.")
+    return render(request, 'waterapp/payment_status.html', {
+        'payment': payment,
+        'status': payment_status(payment),
+        'status_url': reverse('payment_status_api', args=[reference]),
+    })
+
+def payment_status_api(request, reference):
+    """Polled by the payment page until the STK push has a final result."""
+    payment = payment_from_reference(reference)
+    if payment is None:
+        return JsonResponse({'error': "Unknown payment."}, status=404)
+    return JsonResponse(payment_status(payment))
 
-    return render(request, 'waterapp/donate.html')
+@csrf_exempt
+@require_POST
+def mpesa_callback(request):
+    """
+    Daraja's STK result callback. The body is only stored; the
+    ``process_mpesa_callbacks`` worker applies it, so Safaricom gets its
+    acknowledgement without waiting on payment updates.
+    """
+    if len(request.body) > MAX_CALLBACK_BYTES:
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': "Payload too large"}, status=413)
+    MpesaCallback.objects.create(body=request.body.decode('utf-8', 'replace'))
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': "Accepted"})
 
 @login_required
 def transaction_history(request):
-    user_phone = request.user.username
-    
-    transactions = MpesaTransaction.objects.filter(
-        phone_number=user_phone
-    ).order_by('-created_at')
-
+    """
+    The user's payments, newest first: an index search on user and, for
+    unclaimed payments from their number, on (phone_number, created_at).
+    """
+    page = _html_page(user_payments(request.user).select_related('vendor'), PAYMENT_ORDERING, request)
     return render(request, 'waterapp/transaction_history.html', {
-        'transactions': transactions
+        'transactions': page.items,
+        'next_cursor': page.next_cursor,
     })
\ No newline at end of file
@@ -18,7 +18,6 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'waterapp',
-    'django_daraja',
 ]
 
 MIDDLEWARE = [
@@ -59,6 +58,21 @@ DATABASES = {
     )
 }
 
+# Shared by all workers so that cache version bumps are seen everywhere.
+# Run `python manage.py createcachetable` once when using the default.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'waterconnect_cache'),
+    }
+}
+
+# 'Order Now' clicks are queued in memory and written in batches
+# (see waterapp/clicks.py). Clicks beyond MAX_PENDING are dropped.
+CLICK_BUFFER_BATCH_SIZE = 200
+CLICK_BUFFER_FLUSH_INTERVAL = 2.0
+CLICK_BUFFER_MAX_PENDING = 10000
+
 LOGIN_REDIRECT_URL = 'index' 
 LOGOUT_REDIRECT_URL = 'index'
 LOGIN_URL = 'login'
@@ -151,4 +165,9 @@ MPESA_CONSUMER_KEY = os.environ.get("MPESA_CONSUMER_KEY")
 MPESA_CONSUMER_SECRET = os.environ.get("MPESA_CONSUMER_SECRET")
 MPESA_SHORTCODE = os.environ.get("MPESA_EXPRESS_SHORTCODE", "174379")
 MPESA_PASSKEY = os.environ.get("MPESA_PASSKEY", "bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919")
-MPESA_EXPRESS_URL = 'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
\ No newline at end of file
+MPESA_EXPRESS_URL = 'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
+# Overrides the Daraja host picked by MPESA_ENVIRONMENT (e.g. a local fake).
+MPESA_API_BASE_URL = os.environ.get("MPESA_API_BASE_URL")
+MPESA_CALLBACK_URL = os.environ.get("MPESA_CALLBACK_URL", "https://water-management-system-ouep.onrender.com/api/mpesa/callback/")
+# Threads per process sending queued STK pushes.
+MPESA_PUSH_WORKERS = int(os.environ.get("MPESA_PUSH_WORKERS", 8))
\ No newline at end of file